@@ -4,36 +4,108 @@ Created on Mon Aug 02 2021
 
 @author: jaeunkim
 """
+from pmt_measurement import PMTMeasurement
+from clocks import get_clock
+import numpy as np
+
 class PMT():
     def __init__(self, 
                  N_500us = 2,
                  T_500us = 50000-3-2,
                  max_run_count = 100,
-                 port = 'COM11'
+                 port = 'COM11',
+                 clock = None
                  ):
+        self.clock = get_clock() if clock is None else clock
         self.N_500us = N_500us
         self.T_500us = T_500us
         self.max_run_count = max_run_count
         self.port = port
         
         self.cnt = 0
+        self.N_1us = 2
+        self.num_run = 50
+        self.sequencer = None
+        
+    def __enter__(self):
+        return self.open()
+    
+    def __exit__(self, *exc):
+        self.close()
+        
+    def open(self):
+        if self.sequencer is None:
+            self.sequencer = DUMMY_SEQUENCER()
+        return self
+    
+    def close(self):
+        if self.sequencer is not None:
+            self.sequencer.close()
+            self.sequencer = None
+            
+    def is_open(self):
+        return self.sequencer is not None
     
     def setup_PMT_sp(self, 
                      N_1us = 2,
                      T_1us = 100-3-2,
                      num_run = 50,
                      ):
-        pass
+        self.N_1us = N_1us
+        self.num_run = num_run
 
-    def PMT_count_measure(self):
-        self.sequencer = DUMMY_SEQUENCER()
+    def PMT_count_measure(self, return_counts = False):
+        measurement = self.PMT_measure(keep_counts = True)
+        if return_counts:
+            return measurement.mean, measurement.counts
+        return measurement.mean
+    
+    def PMT_measure(self, keep_counts = False):
         self.cnt += 1
-        return self.cnt
+        start_time = self.clock.now()
+        counts = np.random.poisson(self.cnt, self.num_run).astype(np.int32)
+        return PMTMeasurement(counts, start_time, self.clock.now() - start_time, keep_counts)
+    
+    def PMT_line_measure(self, N_1us, num_windows, T_1us = 100-3-2,
+                         on_start = None, on_poll = None):
+        start_time = self.clock.now()
+        if on_start is not None:
+            on_start()
+        while self.clock.now() - start_time < num_windows * N_1us * 1e-6:
+            if on_poll is not None:
+                on_poll()
+            self.clock.sleep(0.01)
+        
+        self.cnt += 1
+        return (start_time, np.arange(num_windows, dtype=np.int32),
+                np.full(num_windows, self.cnt, dtype=np.int32))
+    
+    def PMT_stream(self, on_counts, should_stop, N_1us = None, T_1us = None):
+        if N_1us is None:
+            N_1us = self.N_1us
+        start_time = self.clock.now()
+        total_data_count = 0
+        previous_num_run, self.num_run = self.num_run, None  # like the free-running program of PMT_v3
+        try:
+            while not should_stop():
+                self.clock.sleep(0.01)
+                data_count = int((self.clock.now() - start_time) / (N_1us * 1e-6)) - total_data_count
+                if data_count > 0:
+                    self.cnt += 1
+                    on_counts(np.arange(total_data_count, total_data_count + data_count, dtype=np.int32),
+                              np.full(data_count, self.cnt, dtype=np.int32))
+                    total_data_count += data_count
+        finally:
+            self.num_run = previous_num_run
+        return total_data_count
 
 
 
 class DUMMY_SEQUENCER():
-    def release():
+    def release(self):
+        pass
+    
+    def close(self):
         pass
 
 
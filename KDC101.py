@@ -6,11 +6,14 @@ A module for controlling KDC101 motor device.
 """
 
 from ctypes import cdll, c_int, c_short, c_long, c_char_p, c_ushort, c_ulong, pointer
-from time import sleep
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+from threading import Lock, RLock, Thread
 
 from os import getcwd, chdir
 from os.path import abspath, dirname
 
+from clocks import get_clock
+
 def load_dll(dll_path='C:/Program Files/Thorlabs/Kinesis'):
         """Loads the dynamic linked library.
 
@@ -44,27 +47,40 @@ class KDC101:
     Methods
     -------
     get_serial_number       : () => str
-    get_position            : [bool] => float
+    get_position            : [bool, float] => float
     get_acc_and_vel         : () => (int, int)
+    get_next_message        : () => (int, int, int) or None
+    get_num_skipped_moves   : () => int
 
     set_acc_and_vel         : [int, int] => ()
+    set_move_tolerance      : number [, bool] => ()
     
     needs_home              : () => bool
     
     print_msg               : Any => ()
     open                    : [bool] => KDC101
     close                   : () => ()
-    start_polling           : [int] => int
+    start_polling           : [int, float] => int
+    wait_until_ready        : [float] => bool
     stop_polling            : () => ()
     open_and_start_polling  : [int] => KDC101
+    use_message_pump        : [MessagePump] => KDC101
+    add_message_callback    : callable => ()
     home                    : [bool, bool] => bool
-    move_to_position        : number [, bool, bool] => (int, int, int)
+    move_to_position        : number [, bool, bool, number] => (int, int, int)
+    move_to_position_async  : number [, bool, bool, number] => Future
     move_relative           : number [, bool, bool] => (int, int, int)
     stop_profiled           : () => ()
     """
 
     # device unit / millimeter
     DEVUNIT_RATIO = 34304
+    # velocity device unit / (mm/s), acceleration device unit / (mm/s^2)
+    VEL_DEVUNIT_RATIO = 772981.3692
+    ACC_DEVUNIT_RATIO = 263.8443072
+
+    # serializes TLI_BuildDeviceList() when devices are opened concurrently
+    __build_lock = Lock()
 
     # DLL object - will be loaded later.
     __lib = None
@@ -97,6 +113,9 @@ class KDC101:
             ERROR = 0
             STATUS = 1
 
+    # (type, id) of the messages which end a move: MOVED, STOPPED, LIMIT_UPDATED
+    MOVE_MESSAGES = [(2, 1), (2, 2), (2, 3)]
+
 
     def load_dll(dll_path):
         """Loads the dynamic linked library.
@@ -115,17 +134,38 @@ class KDC101:
         if KDC101.__lib is None:
             KDC101.__lib = load_dll(dll_path)
 
+    def use_library(lib):
+        """Replaces the DLL by another object with the same CC_ functions.
+
+        Used to run on a simulated device (see sim_hardware.SimKinesisLib).
+        Afterwards load_dll() does nothing.
+
+        Parameters
+        ----------
+        lib : object
+            provides the CC_ functions of the KCube DCServo DLL
+        """
+        KDC101.__lib = lib
+
     def get_serial_number(self):
         return self.__serno.value.decode()
 
-    def get_position(self, in_devunit=False):
+    def get_position(self, in_devunit=False, max_age=None):
         """Gets the current position of the motor.
 
+        The device updates the position only at the polling interval, hence
+        a cached value is returned if it is not older than max_age. The cache
+        is also refreshed whenever a move or homing is finished.
+
         Parameters
         ----------
         in_devunit : bool (default False)
             if this flag is set, returns pos in device unit
             o.w., returns pos in millimeter
+        max_age : float (optional)
+            the maximum age of the cached value in seconds
+            if None, the polling interval is used (no cache without polling)
+            if zero, always reads the position from the device
 
         Returns
         -------
@@ -134,7 +174,11 @@ class KDC101:
         int if in_devunit==True
             current position in device unit
         """
-        pos = self.__lib.CC_GetPosition(self.__serno)
+        if max_age is None:
+            max_age = self.__polling_interval
+        pos, read_time = self.__position
+        if pos is None or self.__clock.now() - read_time > max_age:
+            pos = self.__update_position()
         if not in_devunit:
             pos = self.__convert_to_mm(pos)
         return pos
@@ -154,6 +198,49 @@ class KDC101:
 
         return acc.value, vel.value
 
+    def get_next_message(self):
+        """Pops the oldest message from the device message queue without blocking.
+
+        Returns
+        -------
+        tuple (int, int, int)
+            (message type, message id, message data)
+        None
+            if the queue is empty
+        """
+        if self.__lib.CC_MessageQueueSize(self.__serno) <= 0:
+            return None
+
+        mtype, mid = c_short(), c_short()
+        mdata = c_long()
+        if not self.__lib.CC_GetNextMessage(self.__serno, pointer(mtype),
+                                            pointer(mid), pointer(mdata)):
+            return None
+        return mtype.value, mid.value, mdata.value
+
+    def get_num_skipped_moves(self):
+        """Returns how many moves have been skipped since they were already
+        within the tolerance (see set_move_tolerance).
+        """
+        return self.__num_skipped_moves
+
+    def set_move_tolerance(self, tolerance, in_devunit=False):
+        """Sets the default tolerance of move_to_position.
+
+        A move is skipped if its destination is within the tolerance of the
+        last commanded destination, or of the current position if the last
+        move did not finish normally.
+
+        Parameters
+        ----------
+        tolerance : number
+            tolerance in millimeters
+            if in_devunit is True, this is in device unit(check DEVUNIT_RATIO)
+        in_devunit : bool (default False)
+            if this flag is set, tolerance is interpretted in device unit
+        """
+        self.__move_tolerance = abs(self.__convert_to_devunit(tolerance, in_devunit))
+
     def set_acc_and_vel(self, acc=None, vel=None):
         """Sets acceleration and max-velocity of the motor.
 
@@ -222,15 +309,25 @@ class KDC101:
         """Closes the device communication.
 
         """
+        if self.__pump is not None:
+            self.__pump.unregister(self)
+            self.__pump = None
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=False)
+            self.__executor = None
         self.__lib.CC_Close(self.__serno)
 
-    def start_polling(self, interval=200):
+    def start_polling(self, interval=200, timeout=2):
         """Starts the internal polling loop to keep track on the device status.
         
+        Returns when the first status has arrived (see wait_until_ready()).
+        
         Parameters
         ----------
         interval : int (default 200)
             The polling rate in milliseconds
+        timeout : float (default 2)
+            the longest wait for the first status in seconds
         
         Raises
         ------
@@ -247,17 +344,46 @@ class KDC101:
             raise ValueError("polling interval must be positive integer.")
 
         success = self.__lib.CC_StartPolling(self.__serno, c_int(interval))
-        sleep(2)  # for stability
+        if success == 1 and not self.wait_until_ready(timeout):
+            self.print_msg("Warning: no status within {}s after starting polling.".format(timeout))
         if success != 1:
-            return -self.__lib.CC_PollingDuration(self.__serno)
+            current_interval = self.__lib.CC_PollingDuration(self.__serno)
+            self.__polling_interval = max(current_interval, 0) / 1000
+            return -current_interval
         else:
+            self.__polling_interval = interval / 1000
             return interval
 
+    def wait_until_ready(self, timeout=2):
+        """Waits until the device has reported its status by polling.
+
+        The DLL keeps the status bits at zero until the first status of the
+        device arrives, so this replaces a fixed delay after opening.
+
+        Parameters
+        ----------
+        timeout : float (default 2)
+            in seconds
+
+        Returns
+        -------
+        bool
+            whether the status arrived in time
+        """
+        deadline = self.__clock.now() + timeout
+        while self.__lib.CC_GetStatusBits(self.__serno) == 0:
+            if self.__clock.now() >= deadline:
+                return False
+            self.__clock.sleep(0.01)
+        self.__update_position()
+        return True
+
     def stop_polling(self):
         """Stops the internal polling loop.
 
         """
         self.__lib.CC_StopPolling(self.__serno)
+        self.__polling_interval = 0
 
     def open_and_start_polling(self, interval=200):
         """Opens and starts polling.
@@ -283,6 +409,43 @@ class KDC101:
 
         return self
 
+    def use_message_pump(self, pump=None):
+        """Lets a MessagePump thread receive the messages of this device.
+
+        Afterwards, waiting for a move or homing does not block in
+        CC_WaitForMessage and pending messages are dispatched instead of
+        being cleared. The device is unregistered when it is closed.
+
+        Parameters
+        ----------
+        pump : MessagePump (optional)
+            the pump to use; the shared one is used if it is None
+
+        Returns
+        -------
+        KDC101
+            returns self
+        """
+        if pump is None:
+            pump = MessagePump.shared()
+        self.__pump = pump
+        pump.register(self)
+        pump.add_callback(self, self.__on_message)
+        return self
+
+    def add_message_callback(self, callback):
+        """Registers a callback for every message of this device.
+
+        Parameters
+        ----------
+        callback : callable (KDC101, int, int, int) => Any
+            called with (device, message type, message id, message data)
+            from the message pump thread; it should return quickly
+        """
+        if self.__pump is None:
+            self.use_message_pump()
+        self.__pump.add_callback(self, callback)
+
     def home(self, force=False, verbose=False):
         """Homes the device - device will find 'home' and calibrates its
         zero position.
@@ -308,23 +471,28 @@ class KDC101:
         if verbose:
             self.print_msg("start homing...")
 
-        self.__clear_message_queue()
+        self.__last_target = None
+        self.__last_move = None
+        waiter = self.__prepare_wait([(2, 0), (2, 2)])
         err = self.__lib.CC_Home(self.__serno)
         if err != 0:
             raise ErrorCodeException(err)
 
         # wait for the homing process is complete
-        _, msg_id, _ = self.__wait_for([(2, 0), (2, 2)], verbose=verbose)
+        _, msg_id, _ = self.__wait_for([(2, 0), (2, 2)], verbose=verbose,
+                                       waiter=waiter)
 
         if verbose and msg_id == KDC101.MessageId.GenericMotor.HOMED:
             self.print_msg("homed.")
 
         return msg_id == KDC101.MessageId.GenericMotor.HOMED
 
-    def move_to_position(self, pos, in_devunit=False, verbose=False):
+    def move_to_position(self, pos, in_devunit=False, verbose=False,
+                         tolerance=None):
         """Moves the motor to the certain position.
         
         Waits until the moving process is finished.
+        The move is skipped if the motor is already within the tolerance.
 
         Parameters
         ----------
@@ -336,25 +504,66 @@ class KDC101:
             o.w., pos is interpretted in millimeter
         verbose : bool (default False)
             if this flag is set, status message is displayed
-        """
-        pos = self.__convert_to_devunit(pos, in_devunit)
+        tolerance : number (optional)
+            in the same unit as pos; the value of set_move_tolerance
+            (zero by default) is used if it is None
 
-        if verbose:
-            self.print_msg("moving to {:0.4f}mm..."
-                           .format(self.__convert_to_mm(pos)))
+        Returns
+        -------
+        tuple (int, int, int) or None
+            the message which finished the move, None if skipped
+        """
+        if self.__skips_move(pos, in_devunit, tolerance, verbose):
+            if self.__last_move is not None and not self.__last_move.done():
+                self.__clock.wait(self.__last_move)  # still moving there asynchronously
+            return None
 
-        self.__clear_message_queue()
-        err = self.__lib.CC_MoveToPosition(self.__serno, c_int(pos))
-        if err != 0:
-            raise ErrorCodeException(err)
+        waiter = self.__start_move_to_position(pos, in_devunit, verbose)
 
         # wait for the moving process is complete
-        res = self.__wait_for_move(verbose=verbose)
+        return self.__wait_for_move_and_report(verbose, waiter)
 
-        if verbose:
-            self.print_msg("moved.")
+    def move_to_position_async(self, pos, in_devunit=False, verbose=False,
+                               tolerance=None):
+        """Starts moving the motor to the certain position without waiting.
 
-        return res
+        The moving command is sent immediately and the waiting is done in
+        a background thread, hence several motors can move at the same time.
+        If the device uses a message pump, the pump resolves the future and
+        no thread is blocked.
+
+        Parameters
+        ----------
+        pos, in_devunit, verbose, tolerance
+            see move_to_position
+
+        Returns
+        -------
+        concurrent.futures.Future
+            its result() waits for the move and returns what
+            move_to_position returns; done() polls without blocking
+            if the move is skipped, the future of the ongoing move to the
+            same destination or an already finished one
+        """
+        if self.__skips_move(pos, in_devunit, tolerance, verbose):
+            if self.__last_move is not None and not self.__last_move.done():
+                return self.__last_move
+            skipped = Future()
+            skipped.set_result(None)
+            return skipped
+
+        waiter = self.__start_move_to_position(pos, in_devunit, verbose)
+
+        if waiter is not None:
+            waiter.add_done_callback(
+                lambda done: self.__wait_for_move_and_report(verbose, done))
+            self.__last_move = waiter
+            return waiter
+
+        if self.__executor is None:
+            self.__executor = ThreadPoolExecutor(max_workers=1)
+        self.__last_move = self.__executor.submit(self.__wait_for_move_in_background, verbose)
+        return self.__last_move
 
     def move_relative(self, disp, in_devunit=False, verbose=False):
         """Moves the motor relatively by the given displacement.
@@ -378,13 +587,15 @@ class KDC101:
             self.print_msg("moving by {:0.4f}mm..."
                            .format(self.__convert_to_mm(disp)))
 
-        self.__clear_message_queue()
+        self.__last_target = None
+        self.__last_move = None
+        waiter = self.__prepare_wait(self.MOVE_MESSAGES)
         err = self.__lib.CC_MoveRelative(self.__serno, c_int(disp))
         if err != 0:
             raise ErrorCodeException(err)
 
         # wait for the moving process is complete
-        res = self.__wait_for_move(verbose=verbose)
+        res = self.__wait_for_move(verbose=verbose, waiter=waiter)
 
         if verbose:
             self.print_msg("moved.")
@@ -405,8 +616,9 @@ class KDC101:
         ------
         FailedException - failed to build the device list
         """
-        if self.__lib.TLI_BuildDeviceList() != 0:
-            raise FailedException("build the device list.")
+        with KDC101.__build_lock:
+            if self.__lib.TLI_BuildDeviceList() != 0:
+                raise FailedException("build the device list.")
 
     def __convert_to_devunit(self, value, in_devunit=False):
         """Converts value into device unit.
@@ -449,7 +661,7 @@ class KDC101:
             value /= self.DEVUNIT_RATIO
         return value
 
-    def __init__(self, serno: str, force_load_dll=True):
+    def __init__(self, serno: str, force_load_dll=True, clock=None):
         """
         Parameters
         ----------
@@ -460,8 +672,20 @@ class KDC101:
             This is for debugging and developping.
             If this is False, then it does not raise Error even if it fails
             to load the DLL.
+
+        clock : RealClock or VirtualClock (optional)
+            for waiting and the age of the cached position; get_clock() if None
         """
+        self.__clock = get_clock() if clock is None else clock
         self.__serno = c_char_p(serno.encode())
+        self.__executor = None  # waits for asynchronous moves
+        self.__pump = None  # set by use_message_pump()
+        self.__polling_interval = 0  # in seconds, set by start_polling()
+        self.__position = (None, 0)  # cached (position in device unit, clock time)
+        self.__last_target = None  # last destination in device unit, None if unknown
+        self.__last_move = None  # Future of the asynchronous move to __last_target, None for other moves
+        self.__move_tolerance = 0  # in device unit
+        self.__num_skipped_moves = 0
 
     def __enter__(self):
         return self
@@ -474,7 +698,27 @@ class KDC101:
         self.stop_polling()
         self.close()
 
-    def __wait_for(self, target_tuples, verbose=True):
+    def __prepare_wait(self, target_tuples):
+        """Prepares waiting for the target messages of a command.
+
+        This should be called before sending the command. Without a message
+        pump, it clears the message queue. With a message pump, the pending
+        messages are dispatched first so that they are not taken as the
+        response of the command.
+
+        Returns
+        -------
+        Future or None
+            the waiter to pass to __wait_for, None without a message pump
+        """
+        if self.__pump is None:
+            self.__clear_message_queue()
+            return None
+
+        self.__pump.drain(self)
+        return self.__pump.expect(self, target_tuples)
+
+    def __wait_for(self, target_tuples, verbose=True, waiter=None):
         """Waits for the message which has the target message type
         and id. Multiple targets can be passed within a list.
 
@@ -485,6 +729,9 @@ class KDC101:
             if there is only one tuple, it can be simply passed by itself
         verbose : bool (default True)
             whether to print the received messages or not
+        waiter : Future (optional)
+            returned by __prepare_wait; if it is given, waits for it
+            instead of calling CC_WaitForMessage
 
         Returns
         -------
@@ -492,6 +739,13 @@ class KDC101:
             whole matched target message information
             (target_mtype, target_mid, target_mdata)
         """
+        if waiter is not None:
+            res = self.__clock.wait(waiter)
+            if verbose:
+                self.print_msg("  - received message[{}][{}]: {}".format(*res))
+            self.__update_position()
+            return res
+
         if not isinstance(target_tuples, list):
             target_tuples = [target_tuples]
 
@@ -504,9 +758,10 @@ class KDC101:
                 self.print_msg("  - received message[{}][{}]: {}"
                                .format(mtype.value, mid.value, mdata.value))
             if (mtype.value, mid.value) in target_tuples:
+                self.__update_position()
                 return mtype.value, mid.value, mdata.value
 
-    def __wait_for_move(self, verbose=False):
+    def __wait_for_move(self, verbose=False, waiter=None):
         """Waits for a moving process to be finished.
 
         If the motor reaches its revolution limit, show warning message.
@@ -516,7 +771,11 @@ class KDC101:
         verbose : bool (default False)
             it is passed to the function __wait_for
         """
-        res = self.__wait_for([(2, 1), (2, 2), (2, 3)], verbose=verbose)
+        res = self.__wait_for(self.MOVE_MESSAGES, verbose=verbose,
+                              waiter=waiter)
+        if res[1] != KDC101.MessageId.GenericMotor.MOVED:
+            # the destination is not reached
+            self.__last_target = None
         if res[1] == 2 and verbose:
             # message id 2 : Stopped
             self.print_msg("The motor has been stopped.")
@@ -528,6 +787,99 @@ class KDC101:
 
         return res
 
+    def __start_move_to_position(self, pos, in_devunit=False, verbose=False):
+        """Sends the moving command without waiting for it to finish.
+
+        Parameters
+        ----------
+        pos, in_devunit, verbose
+            see move_to_position
+
+        Returns
+        -------
+        Future or None
+            the waiter from __prepare_wait
+        """
+        pos = self.__convert_to_devunit(pos, in_devunit)
+
+        if verbose:
+            self.print_msg("moving to {:0.4f}mm..."
+                           .format(self.__convert_to_mm(pos)))
+
+        waiter = self.__prepare_wait(self.MOVE_MESSAGES)
+        self.__last_target = pos
+        self.__last_move = None  # set again by move_to_position_async
+        err = self.__lib.CC_MoveToPosition(self.__serno, c_int(pos))
+        if err != 0:
+            self.__last_target = None
+            raise ErrorCodeException(err)
+        return waiter
+
+    def __skips_move(self, pos, in_devunit, tolerance, verbose):
+        """Checks whether the motor is already within the tolerance of pos.
+        Counts the move as skipped if so.
+
+        Parameters
+        ----------
+        pos, in_devunit, verbose, tolerance
+            see move_to_position
+
+        Returns
+        -------
+        bool
+            whether the move should be skipped or not
+        """
+        pos = self.__convert_to_devunit(pos, in_devunit)
+        if tolerance is None:
+            tolerance = self.__move_tolerance
+        else:
+            tolerance = abs(self.__convert_to_devunit(tolerance, in_devunit))
+
+        reference = self.__last_target
+        if reference is None:
+            reference = self.get_position(in_devunit=True)
+        if abs(pos - reference) > tolerance:
+            return False
+
+        self.__num_skipped_moves += 1
+        if verbose:
+            self.print_msg("already at {:0.4f}mm, skip moving."
+                           .format(self.__convert_to_mm(pos)))
+        return True
+
+    def __wait_for_move_in_background(self, verbose=False):
+        try:
+            return self.__wait_for_move_and_report(verbose)
+        finally:
+            self.__clock.leave()  # the executor thread idles outside the clock
+
+    def __wait_for_move_and_report(self, verbose=False, waiter=None):
+        res = self.__wait_for_move(verbose=verbose, waiter=waiter)
+
+        if verbose:
+            self.print_msg("moved.")
+
+        return res
+
+    def __update_position(self):
+        """Reads the position from the device and caches it.
+
+        Returns
+        -------
+        int
+            current position in device unit
+        """
+        pos = self.__lib.CC_GetPosition(self.__serno)
+        self.__position = (pos, self.__clock.now())
+        return pos
+
+    def __on_message(self, device, mtype, mid, mdata):
+        """Message pump callback: refreshes the cached position whenever
+        the motor reports a change (e.g. moved by the front panel).
+        """
+        if mtype == KDC101.MessageType.GENERIC_MOTOR:
+            self.__update_position()
+
     def __clear_message_queue(self):
         """Clears the device message queue.
 
@@ -535,6 +887,150 @@ class KDC101:
         self.__lib.CC_ClearMessageQueue(self.__serno)
 
 
+class MessagePump:
+    """
+    A background thread which drains the message queues of KDC101 devices.
+
+    Each received message is routed to the waiters registered by expect()
+    and to the callbacks registered by add_callback(), hence many devices
+    can be served by a single thread without losing messages. A failing
+    callback or device is reported and skipped, so that the thread keeps
+    serving the others.
+
+    Methods
+    -------
+    shared          : () => MessagePump
+    register        : KDC101 => ()
+    unregister      : KDC101 => ()
+    add_callback    : KDC101, callable => ()
+    expect          : KDC101, list => Future
+    drain           : KDC101 => ()
+    stop            : () => ()
+    """
+
+    __shared = None
+    __shared_lock = Lock()
+
+    def shared():
+        """Returns the pump shared by all devices, creating it if needed.
+        """
+        with MessagePump.__shared_lock:  # devices may be set up concurrently
+            if MessagePump.__shared is None:
+                MessagePump.__shared = MessagePump()
+            return MessagePump.__shared
+
+    def __init__(self, interval=0.01, clock=None):
+        """
+        Parameters
+        ----------
+        interval : float (default 0.01)
+            the time between two sweeps over the devices in seconds
+        clock : RealClock or VirtualClock (optional)
+            get_clock() if None
+        """
+        self.interval = interval
+        self.clock = get_clock() if clock is None else clock
+        self.__devices = []
+        self.__waiters = {}  # device => list of (target_tuples, Future)
+        self.__callbacks = {}  # device => list of callables
+        self.__lock = RLock()
+        self.__thread = None
+
+    def register(self, device):
+        """Starts receiving the messages of the device.
+
+        The pump thread is started with the first device.
+        """
+        with self.__lock:
+            if device not in self.__devices:
+                self.__devices.append(device)
+                self.__waiters[device] = []
+                self.__callbacks[device] = []
+            if self.__thread is None:
+                self.__thread = Thread(target=self.__run, daemon=True)
+                self.__thread.start()
+                self.clock.wake(self.__thread)  # a virtual time waits for its first sweep
+
+    def unregister(self, device):
+        """Stops receiving the messages of the device.
+
+        The remaining waiters of the device fail with FailedException.
+        """
+        with self.__lock:
+            if device not in self.__devices:
+                return
+            try:
+                self.drain(device)
+            except Exception as e:
+                device.print_msg("failed to receive the last messages: {!r}".format(e))
+            for _, waiter in self.__waiters.pop(device):
+                if not waiter.done():
+                    waiter.set_exception(FailedException("receive the message"))
+            self.__callbacks.pop(device)
+            self.__devices.remove(device)
+
+    def add_callback(self, device, callback):
+        with self.__lock:
+            self.__callbacks[device].append(callback)
+
+    def expect(self, device, target_tuples):
+        """Returns a Future resolved by the first target message of the device.
+
+        Parameters
+        ----------
+        target_tuples : list of tuples (target_mtype, target_mid)
+            the Future result is the matched (mtype, mid, mdata)
+        """
+        waiter = Future()
+        with self.__lock:
+            self.__waiters[device].append((target_tuples, waiter))
+        return waiter
+
+    def drain(self, device):
+        """Dispatches all the pending messages of the device right now.
+        """
+        with self.__lock:
+            msg = device.get_next_message()
+            while msg is not None:
+                self.__dispatch(device, msg)
+                msg = device.get_next_message()
+
+    def stop(self):
+        """Stops the pump thread after the current sweep.
+        """
+        thread, self.__thread = self.__thread, None
+        if thread is not None:
+            thread.join()
+
+    def __run(self):
+        me = self.__thread
+        while self.__thread is me:
+            with self.__lock:
+                for device in list(self.__devices):
+                    try:
+                        self.drain(device)
+                    except Exception as e:  # the other devices are served anyway
+                        device.print_msg("failed to receive messages: {!r}".format(e))
+            self.clock.sleep(self.interval)
+
+    def __dispatch(self, device, msg):
+        waiters = self.__waiters[device]
+        for target in list(waiters):
+            if target[1].done():  # cancelled by the caller
+                waiters.remove(target)
+            elif tuple(msg[:2]) in target[0]:
+                waiters.remove(target)
+                try:
+                    target[1].set_result(msg)  # a thread waiting with clock.wait() holds the time from here
+                except InvalidStateError:  # cancelled meanwhile
+                    pass
+        for callback in self.__callbacks[device]:
+            try:
+                callback(device, *msg)
+            except Exception as e:
+                device.print_msg("message callback {!r} failed: {!r}".format(callback, e))
+
+
 class ErrorCodeException(Exception):
     def __init__(self, err_code, message=None):
         self.__err_code = err_code
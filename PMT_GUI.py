@@ -432,7 +432,9 @@ class ScanningThread(QThread):
 
     
     def setup_hardwares(self):
+        # one FPGA session shared with MyPMTThread; released by stop_thread_and_clean_up_hardware()
         self.pmt = PMT(port = self.fpga_com_port)
+        self.pmt.open()
  
         self.x_motor = KDC101(self.x_motor_serno)
         self.x_motor.load_dll()
@@ -481,15 +483,13 @@ class ScanningThread(QThread):
         self.running_flag = False
         
         if release_flag: # 
-            self.pmt.sequencer.close() # Release FPGA
-            self.pmt = None
+            self.pmt.close() # Release FPGA
         else:
-            self.pmt = PMT(port = self.fpga_com_port)
+            self.pmt.open()
                
         
     def clean_up_devices(self):
-        if not self.pmt == None:
-            self.pmt.sequencer.close()
+        self.pmt.close()
         self.x_motor.stop_polling()
         self.x_motor.close()
         self.y_motor.stop_polling()
@@ -10,8 +10,12 @@ PMT and KDC101 files should be in the same folder as this program
 """
 
 ################ Importing Sequencer Programs ###################
-import sys
+import sys, os
 sys.path.append("Q://Experiment_Scripts/Chamber_4G_SNU/SecularFreq/")
+SIMULATE = os.getenv("PMT_GUI_SIMULATE")  # run on sim_hardware instead of the devices; "virtual" for virtual time
+if SIMULATE:
+    import sim_hardware
+    sim_world = sim_hardware.install(virtual_time = SIMULATE == "virtual")
 from SequencerProgram_v1_07 import SequencerProgram, reg
 import SequencerUtility_v1_01 as su
 from ArtyS7_v1_02 import ArtyS7
@@ -19,8 +23,20 @@ import HardwareDefinition_SNU_v4_01 as hd
 
 ################# Importing Hardware APIs #######################
 from KDC101 import KDC101  # Thorlabs KDC101 Motor Controller
-# from PMT_v3 import PMT
-from DUMMY_PMT import PMT
+if SIMULATE:
+    from PMT_v3 import PMT
+else:
+    # from PMT_v3 import PMT
+    from DUMMY_PMT import PMT
+from scan_plan import ScanPlan, ORDERINGS
+from peak_search import PeakSearch
+from ion_tracker import IonTracker
+from scan_writer import ScanWriter
+from hardware_setup import bring_up
+from ring_buffer import RingBuffer, MinMaxHistory
+from pmt_measurement import PMTMeasurement
+from clocks import get_clock
+from spans import get_recorder
 
 ################ Importing GUI Dependencies #####################
 import os, time
@@ -30,7 +46,6 @@ from PyQt5.QtWidgets import *
 from PyQt5.QtCore    import *
 
 import numpy as np
-import pandas as pd
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
@@ -43,14 +58,16 @@ uifile = dirname + '/PMT_GUI.ui'
 Ui_Form, QtBaseClass = uic.loadUiType(uifile)
 
 #%% Temporary
-from threading import Thread
+from threading import Thread, current_thread
 
 
 class PMT_GUI(QtWidgets.QMainWindow, Ui_Form):
-    scan_request = pyqtSignal(float, float, float)
+    scan_request = pyqtSignal(int, int, int, float, float, float)  # scan_id, x_index, y_index, x_pos, y_pos, exposure_time
+    scan_plan_request = pyqtSignal(int, object, float, bool)  # scan_id, ScanPlan, exposure_time, line_scan_mode
     
     def closeEvent(self, e):
         self.scanning_thread.clean_up_devices()
+        self.scan_writer.stop()
         time.sleep(1)
         print("Cleaned hardwares.")
     
@@ -58,6 +75,8 @@ class PMT_GUI(QtWidgets.QMainWindow, Ui_Form):
         QtWidgets.QMainWindow.__init__(self, parent)
         self.setupUi(self)
         self.setWindowTitle(window_title)
+        self.clock = get_clock()  # same as the scanning thread, for the delay of its results
+        self.recorder = get_recorder()  # times the phases of the scan loop; see the timing panel
         
         # Read config file
         computer_name = os.getenv('COMPUTERNAME', 'defaultValue')
@@ -75,7 +94,7 @@ class PMT_GUI(QtWidgets.QMainWindow, Ui_Form):
         self.BTN_pause_or_resume_scanning.clicked.connect(self.pause_or_resume_scanning)
         self.BTN_go_to_max.clicked.connect(self.go_to_max)
         self.BTN_scan_vicinity.clicked.connect(self.scan_vicinity)
-        self.BTN_apply_plot_settings.clicked.connect(self.show_img)
+        self.BTN_apply_plot_settings.clicked.connect(self.apply_plot_settings)
         self.GUI_x_step.valueChanged.connect(self.update_gui_scan_settings_spinbox_stepsize)
         self.GUI_y_step.valueChanged.connect(self.update_gui_scan_settings_spinbox_stepsize)
         
@@ -84,13 +103,29 @@ class PMT_GUI(QtWidgets.QMainWindow, Ui_Form):
         self.y_pos_list = []
         self.pmt_exposure_time_in_ms = -1
         self.num_points_done = -1
+        self.scan_id = 0  # increased for every new scan range; results of other scans are ignored
         self.latest_count = -1
         self.scan_ongoing_flag = True  # pause/resume scanning
         self.mutex = QMutex()  # to avoid weird situations regarding pause
-        self.gotomax_rescan_radius = 1  # tile size to rescan in self.go_to_max()
-        self.currently_rescanning = False  # true during gotomax operation
-        self.save_file = str(pathlib.Path(__file__).parent.resolve()) + "/data/default.csv"
-        self.LBL_save_file.setText("DEFAULT FILE: ./data/default.csv")
+        self.gotomax_rescan_radius = 1  # each round of self.go_to_max() rescans (2 * radius + 1)^2 points
+        self.gotomax_max_rounds = 6
+        self.gotomax_uncertainty = None  # stop when the peak position is known within this; step / 8 if None
+        self.gotomax_fit_gaussian = True
+        self.gotomax_num_informative_points = None  # measure only this many points per round after a good fit
+        self.peak_search = None  # PeakSearch during gotomax operation
+        self.line_scan_mode = False  # acquire a whole row per sequencer run while X sweeps
+        self.scan_order = 'serpentine'  # see scan_plan.ORDERINGS
+        self.img_max_fps = 10  # redraws of the image per second at most
+        self.img_artist = None  # persistent AxesImage updated by show_img()
+        self.img_geometry = None  # (scan_id, flips) the axes of self.img_artist were made for
+        self.last_img_draw_time = 0
+        self.img_draw_pending = False
+        # each scan is saved as <save_file>_<start time>_scan<scan_id>.npy with a .json sidecar
+        self.save_file = str(pathlib.Path(__file__).parent.resolve()) + "/data/default"
+        self.LBL_save_file.setText("DEFAULT FILE: ./data/default_*.npy")
+        self.save_session = time.strftime("%Y%m%d_%H%M%S")  # so that a new session never overwrites old scans
+        self.scan_writer = ScanWriter()
+        self.scan_writer.start()
         
         # Setup: scanning thread
         self.scanning_thread = ScanningThread(x_motor_serno = self.x_motor_serno, y_motor_serno = self.y_motor_serno, fpga_com_port = self.fpga_com_port)
@@ -98,10 +133,14 @@ class PMT_GUI(QtWidgets.QMainWindow, Ui_Form):
         self.x_motor = self.scanning_thread.x_motor
         self.y_motor = self.scanning_thread.y_motor
         self.pmt = self.scanning_thread.pmt
+        self.statusbar.showMessage("Hardware ready in %.2f s" % self.scanning_thread.setup_time)
         
         # self.scanning_thread = ScanningThread(x_motor_serno = "27001495", y_motor_serno = "27000481", fpga_com_port = "COM7")
         self.scanning_thread.scan_result.connect(self.receive_result)
+        self.scanning_thread.plan_result.connect(self.receive_plan_result)
+        self.scanning_thread.tracking_result.connect(self.receive_tracking_result)
         self.scan_request.connect(self.scanning_thread.register_request)
+        self.scan_plan_request.connect(self.scanning_thread.register_plan)
         self.scanning_thread.running_flag = False
         
         # Get position of the stage and update scan settings accordingly
@@ -109,11 +148,18 @@ class PMT_GUI(QtWidgets.QMainWindow, Ui_Form):
         self.initialize_gui_scan_settings(float(self.LBL_X_pos.text()), float(self.LBL_Y_pos.text()), self.config_x_step, self.config_y_step)
         self.PMT_thread = MyPMTThread(self.pmt)
         self.PMT_thread.pmt_result.connect(self.PlotPMTResult)
-        self.PMT_counts_list = []
-        self.PMT_number_list = []
-        self.PMT_num = 1
+        self.PMT_thread.pmt_rate.connect(self.ShowPMTRate)
+        self.PMT_history_length = 100000  # samples kept for the live trace
+        self.PMT_max_display_points = 2000  # min/max decimation above this; None to draw every sample
+        self.PMT_counts = RingBuffer(self.PMT_history_length)
+        self.PMT_trace = MinMaxHistory(self.PMT_history_length, self.PMT_max_display_points)  # decimated as the samples arrive; None with no decimation
+        self.PMT_line, = self.ax_pmt.plot([], [], color='teal')
         self.PMT_vmin = 0
         self.PMT_vmax = 100
+        
+        self.timing_refresh_interval = 1000  # ms between updates of the timing panel
+        self.create_timing_panel()
+        self.create_scan_options_panel()
     
     def read_config(self, config_file):
         config = configparser.ConfigParser()
@@ -152,23 +198,42 @@ class PMT_GUI(QtWidgets.QMainWindow, Ui_Form):
     
     def update_scan_range(self, x_start, x_stop, x_step, y_start, y_stop, y_step, pmt_exposure_time_in_ms, num_run = 50):
         padding = 0.00001  # some small value to include the stop value in the scan range
+        x_pos_list = np.arange(x_start, x_stop + padding, x_step)
+        y_pos_list = np.arange(y_start, y_stop + padding, y_step)
+        self.set_scan_plan(ScanPlan(x_pos_list, y_pos_list, self.scan_order), pmt_exposure_time_in_ms, num_run)
         
+    def set_scan_plan(self, scan_plan, pmt_exposure_time_in_ms, num_run = 50):
         # update the variables related to the scan range
-        self.x_pos_list = np.arange(x_start, x_stop + padding, x_step)
-        self.y_pos_list = np.arange(y_start, y_stop + padding, y_step)
+        self.scan_plan = scan_plan
+        self.x_pos_list = scan_plan.x_pos_list
+        self.y_pos_list = scan_plan.y_pos_list
         self.x_num = len(self.x_pos_list)
         self.y_num = len(self.y_pos_list)
-        self.image = np.zeros((self.x_num, self.y_num))
+        self.image = np.zeros((self.x_num, self.y_num))  # mean count of each pixel
+        # per-run statistics of each pixel, parallel to self.image
+        self.image_std = np.full((self.x_num, self.y_num), np.nan)
+        self.image_min = np.full((self.x_num, self.y_num), np.nan)
+        self.image_max = np.full((self.x_num, self.y_num), np.nan)
+        self.dwell_map = np.zeros((self.x_num, self.y_num))  # exposure actually spent on each pixel in ms
+        self.measured = np.zeros((self.x_num, self.y_num), dtype=bool)
+        self.scan_writer.end_scan(self.scan_id, complete = False)  # if the previous scan was not finished
+        self.scan_id += 1
         
         # update PMT settings
         self.pmt_exposure_time_in_ms = pmt_exposure_time_in_ms
         self.scanning_thread.set_exposure_time(self.pmt_exposure_time_in_ms, num_run = num_run)
         
+        self.scan_writer.begin_scan("%s_%s_scan%d" % (self.save_file, self.save_session, self.scan_id), self.scan_id,
+                                    self.x_pos_list, self.y_pos_list,
+                                    {'exposure_time_in_ms': pmt_exposure_time_in_ms, 'num_run': num_run,
+                                     'order': str(scan_plan.order), 'num_points': len(scan_plan)})
+        
         # update scan_progress labels
         self.num_points_done = 0
+        self.num_failed_points = 0
         self.latest_count = 0
         self.update_progress_label()
-        self.LBL_total_points.setText(str(self.x_num * self.y_num))
+        self.LBL_total_points.setText(str(len(scan_plan)))
         
         print("updated scan range: ", self.x_pos_list, self.y_pos_list, self.pmt_exposure_time_in_ms)
         
@@ -178,96 +243,198 @@ class PMT_GUI(QtWidgets.QMainWindow, Ui_Form):
         self.update_scan_range(self.GUI_x_start.value(), self.GUI_x_stop.value(), self.GUI_x_step.value(),
                                self.GUI_y_start.value(), self.GUI_y_stop.value(), self.GUI_y_step.value(),
                                float(self.LE_pmt_exposure_time_in_ms.text()), num_run = 50)
-        # initiate scanning
+        self.start_plan()
+        
+    def start_plan(self, line_scan_mode = None):
+        """
+        hands the whole self.scan_plan to the scanning thread
+        the results come back in batches to receive_plan_result()
+        """
+        if line_scan_mode is None:
+            line_scan_mode = self.line_scan_mode
         if not self.scanning_thread.running_flag:
             self.scanning_thread.running_flag = True
             self.scanning_thread.start()
-        self.send_request()
+        self.scan_ongoing_flag = True
+        self.BTN_pause_or_resume_scanning.setText("Pause Scanning")
+        self.scan_plan_request.emit(self.scan_id, self.scan_plan, self.pmt_exposure_time_in_ms, line_scan_mode)
+        
+    def receive_result(self, scan_id, x_index, y_index, x_pos, y_pos, exposure_time, pmt_count):
+        # single measurement outside of a scan plan, e.g. moving to the max position after go_to_max
+        self.LBL_X_pos.setText("%.3f" % x_pos)
+        self.LBL_Y_pos.setText("%.3f" % y_pos)
+        self.latest_count = pmt_count
+        self.update_progress_label()
         
-    def send_request(self):
+    def receive_plan_result(self, scan_id, batch, finished):
         """
-        initiates a scan request to the scanning thread
-        calculates the scan position based on self.num_points_done
+        batch: rows of (x_index, y_index, x_pos, y_pos, mean, std, min, max, dwell_time, move_time, measure_time, end_time)
+        measured by the scanning thread (see ScanningThread.plan_result)
+        """
+        if scan_id != self.scan_id:  # e.g. a late result from before go_to_max
+            print("ignored results of another scan", scan_id)
+            return
+        
+        self.recorder.record('gui.signal_hop', batch[-1, 11], self.clock.now())
+        with self.recorder.span('gui.receive'):
+            self.update_with_plan_result(scan_id, batch, finished)
+        
+    def update_with_plan_result(self, scan_id, batch, finished):
+        """
+        applies a batch to the images, the progress and the scan file
         """
-        x_pos = self.x_pos_list[self.num_points_done % self.x_num]
-        y_pos = self.y_pos_list[self.num_points_done // self.x_num]
-        
-        # zigzag scanning to minimize backlash
-        if np.where(self.y_pos_list == y_pos)[0][0] % 2 == 1:  # for even-numbered rows
-            original_index = self.num_points_done % self.x_num
-            new_index = -1 * (original_index + 1)  # counting from the end of the list
-            x_pos = self.x_pos_list[new_index]  # overwriting x_pos
-            
-        self.scan_request.emit(x_pos, y_pos, self.pmt_exposure_time_in_ms)
-    
-    def receive_result(self, x_pos, y_pos, exposure_time, pmt_count):
         self.mutex.lock()
-        print("entered receive_result ", x_pos, y_pos, exposure_time, pmt_count, "self.num_points_done:", self.num_points_done)
         
         # update GUI (image & progress)
-        x_index = np.where(self.x_pos_list == x_pos)[0][0]
-        y_index = np.where(self.y_pos_list == y_pos)[0][0]
-        print('x, y', x_index, y_index)
-        self.image[x_index, y_index] = pmt_count
+        x_index, y_index = batch[:, 0].astype(int), batch[:, 1].astype(int)
+        self.image[x_index, y_index] = batch[:, 4]
+        self.image_std[x_index, y_index] = batch[:, 5]
+        self.image_min[x_index, y_index] = batch[:, 6]
+        self.image_max[x_index, y_index] = batch[:, 7]
+        self.dwell_map[x_index, y_index] = batch[:, 8]
+        # a failed pixel (nan mean) stays blank and unmeasured, so that go_to_max doesn't take it as data
+        failed = np.isnan(batch[:, 4])
+        self.measured[x_index[~failed], y_index[~failed]] = True
+        if failed.any():
+            self.num_failed_points += failed.sum()
+            self.statusbar.showMessage("%d pixels of this scan failed (FIFO errors)" % self.num_failed_points)
+        if self.peak_search is not None:
+            self.peak_search.add_results(batch[:, 2], batch[:, 3], batch[:, 4])
         
-        self.LBL_X_pos.setText("%.3f" % x_pos)
-        self.LBL_Y_pos.setText("%.3f" % y_pos)
+        self.LBL_X_pos.setText("%.3f" % batch[-1, 2])
+        self.LBL_Y_pos.setText("%.3f" % batch[-1, 3])
         
         self.show_img()
-        self.latest_count = pmt_count
-        self.num_points_done += 1
+        self.latest_count = batch[-1, 4]
+        self.num_points_done += len(batch)
         self.update_progress_label()
         
-        # send new request
-        if self.num_points_done < self.x_num * self.y_num:  # if scanning not finished
-            # check if scanning is not paused
-            if self.scan_ongoing_flag:
-                print("about to send a new request!")
-                self.send_request()
-        else:  # if scanning is done
-            if self.CB_auto_go_to_max.isChecked():
-                self.go_to_max()
-            if self.currently_rescanning:  # rescanning phase in gotomax is finished
-                true_x_argmax, true_y_argmax = np.unravel_index(np.argmax(self.image, axis=None), self.image.shape)
-                # sending motors to max position by making a measurement at that position
-                self.scan_request.emit(self.x_pos_list[true_x_argmax], self.y_pos_list[true_y_argmax], self.pmt_exposure_time_in_ms)
-                time.sleep(0.5)
-                self.currently_rescanning = False  # gotomax is done
-            self.scanning_thread.running_flag = False  # because scanning is done
-            
-        # save result only if a line is finished
-        if x_index == len(self.x_pos_list) - 1:  # end of a line
-            # put data into the correct shape
-            x_pos_list_np = np.array(self.x_pos_list)
-            y_pos_list_np = np.repeat(y_pos, len(self.x_pos_list))  # expanding a number to a list
-            exposure_time_list_np = np.repeat(exposure_time, len(self.x_pos_list))
-            pmt_count_list_np = self.image[:,y_index]
-            
-            # create dataframe & save
-            data_chunk_to_append = np.stack([x_pos_list_np, y_pos_list_np, 
-                                             exposure_time_list_np, pmt_count_list_np])
-            df = pd.DataFrame(data_chunk_to_append).transpose()
-    
-            try:
-                with open(self.save_file, 'a') as f:
-                    df.to_csv(f, index=False, header=False, line_terminator='\n')
-            except:
-                print("WARNING: cannot open savefile")
+        self.scan_writer.write(scan_id, batch)
+        
+        if finished:
+            self.scan_writer.end_scan(scan_id)
+            self.finish_scanning()
         
         self.mutex.unlock()
         
+    def finish_scanning(self):
+        if self.peak_search is not None:  # a round of gotomax is finished
+            self.continue_peak_search()
+        elif self.CB_auto_go_to_max.isChecked():
+            self.go_to_max()
+        print("skipped motor moves (x, y):", self.x_motor.get_num_skipped_moves(), self.y_motor.get_num_skipped_moves())
+            
     def change_save_file(self):
         # dialog to choose a file
         options = QFileDialog.Options()
         options |= QFileDialog.DontUseNativeDialog
-        self.save_file, _ = QFileDialog.getSaveFileName(self,"Save a .csv file", "","*.csv", options=options)
-        if not self.save_file:
+        save_file, _ = QFileDialog.getSaveFileName(self,"Choose a base name for the scan files", "","*.npy", options=options)
+        if not save_file:
             return  # user pressed "cancel"
+        self.save_file = os.path.splitext(save_file)[0]
 
         # show savefile path to GUI
-        self.LBL_save_file.setText(self.save_file)
+        self.LBL_save_file.setText(self.save_file + "_*.npy")
+    
+    def create_timing_panel(self):
+        """
+        a dock with the statistics of self.recorder, toggled by a button in the status bar
+        refreshed every timing_refresh_interval while visible
+        """
+        self.timing_dock = QDockWidget("Scan loop timing (ms)", self)
+        widget = QWidget()
+        layout = QVBoxLayout(widget)
+        self.TXT_timing = QPlainTextEdit()
+        self.TXT_timing.setReadOnly(True)
+        self.TXT_timing.setFont(QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.FixedFont))
+        layout.addWidget(self.TXT_timing)
+        buttons = QHBoxLayout()
+        BTN_export_trace = QPushButton("Export trace")
+        BTN_export_trace.clicked.connect(self.export_timing_trace)
+        BTN_clear_timing = QPushButton("Clear")
+        BTN_clear_timing.clicked.connect(self.clear_timing)
+        buttons.addWidget(BTN_export_trace)
+        buttons.addWidget(BTN_clear_timing)
+        layout.addLayout(buttons)
+        self.timing_dock.setWidget(widget)
+        
+        # floating, so that the fixed layout of the main window is not squeezed
+        self.addDockWidget(Qt.BottomDockWidgetArea, self.timing_dock)
+        self.timing_dock.setFloating(True)
+        self.timing_dock.resize(640, 300)
+        self.timing_dock.hide()
+        BTN_timing = QPushButton("Timing")
+        BTN_timing.clicked.connect(lambda: self.timing_dock.setVisible(not self.timing_dock.isVisible()))
+        self.statusbar.addPermanentWidget(BTN_timing)
+        
+        self.timing_timer = QTimer(self)
+        self.timing_timer.timeout.connect(self.show_timing)
+        self.timing_timer.start(self.timing_refresh_interval)
         
-        open (self.save_file + '.csv', 'w', encoding='ascii')
+    def show_timing(self):
+        if self.timing_dock.isVisible():
+            self.TXT_timing.setPlainText(self.recorder.format_stats())
+        
+    def export_timing_trace(self):
+        options = QFileDialog.Options()
+        options |= QFileDialog.DontUseNativeDialog
+        trace_file, _ = QFileDialog.getSaveFileName(self, "Export the spans as a Chrome trace",
+                                                    "trace_%s.json" % self.save_session, "*.json", options=options)
+        if not trace_file:
+            return
+        num_spans = self.recorder.export_chrome_trace(trace_file)
+        self.statusbar.showMessage("exported %d spans to %s" % (num_spans, trace_file))
+        
+    def clear_timing(self):
+        self.recorder.clear()
+        self.show_timing()
+    
+    def create_scan_options_panel(self):
+        """
+        a dock with the scan modes which have no place in the fixed layout, toggled by a button in the status bar
+        the widgets start from the current attributes and write them back through apply_scan_options()
+        """
+        self.scan_options_dock = QDockWidget("Scan options", self)
+        widget = QWidget()
+        layout = QFormLayout(widget)
+        self.CB_line_scan_mode = QCheckBox("Line scan (a whole row per sequencer run while X sweeps)")
+        self.CB_line_scan_mode.setChecked(self.line_scan_mode)
+        self.CB_line_scan_mode.toggled.connect(self.apply_scan_options)
+        layout.addRow(self.CB_line_scan_mode)
+        self.CBOX_scan_order = QComboBox()
+        self.CBOX_scan_order.addItems(list(ORDERINGS))
+        self.CBOX_scan_order.setCurrentText(self.scan_order)
+        self.CBOX_scan_order.currentTextChanged.connect(self.apply_scan_options)
+        layout.addRow("Scan order", self.CBOX_scan_order)
+        self.CB_adaptive_dwell = QCheckBox("Adaptive dwell (repeat a pixel until its count is precise enough; point scans only)")
+        self.CB_adaptive_dwell.setChecked(self.scanning_thread.adaptive_dwell)
+        self.CB_adaptive_dwell.toggled.connect(self.apply_scan_options)
+        layout.addRow(self.CB_adaptive_dwell)
+        self.CB_tracking = QCheckBox("Track the ion between scans (see start_tracking)")
+        self.CB_tracking.toggled.connect(self.set_tracking)
+        layout.addRow(self.CB_tracking)
+        self.SPB_PMT_history_length = QSpinBox()
+        self.SPB_PMT_history_length.setRange(1000, 10000000)
+        self.SPB_PMT_history_length.setSingleStep(10000)
+        self.SPB_PMT_history_length.setValue(self.PMT_history_length)
+        self.SPB_PMT_history_length.setSuffix(" samples")
+        self.SPB_PMT_history_length.editingFinished.connect(
+            lambda: self.SetPMTHistoryLength(self.SPB_PMT_history_length.value()))
+        layout.addRow("PMT trace history", self.SPB_PMT_history_length)
+        self.scan_options_dock.setWidget(widget)
+        
+        self.addDockWidget(Qt.BottomDockWidgetArea, self.scan_options_dock)
+        self.scan_options_dock.setFloating(True)
+        self.scan_options_dock.hide()
+        BTN_scan_options = QPushButton("Scan Options")
+        BTN_scan_options.clicked.connect(lambda: self.scan_options_dock.setVisible(not self.scan_options_dock.isVisible()))
+        self.statusbar.addPermanentWidget(BTN_scan_options)
+    
+    def apply_scan_options(self):
+        # the mode and the order take effect from the next scan, adaptive dwell from the next pixel
+        self.line_scan_mode = self.CB_line_scan_mode.isChecked()
+        self.scan_order = self.CBOX_scan_order.currentText()
+        self.scanning_thread.adaptive_dwell = self.CB_adaptive_dwell.isChecked()
     
     def create_canvas(self, frame):
         fig = plt.Figure(tight_layout=True)
@@ -282,7 +449,22 @@ class PMT_GUI(QtWidgets.QMainWindow, Ui_Form):
         
         return toolbar, ax, canvas
 
-    def show_img(self):
+    def show_img(self, ignore_rate_limit = False):
+        """
+        updates the image artist in place; the axes are rebuilt only when the scan geometry or flips change
+        redraws are capped at self.img_max_fps, and a skipped frame is drawn later by a single-shot timer
+        """
+        now = time.monotonic()  # the screen runs on the real time even with a virtual clock
+        if not ignore_rate_limit and now - self.last_img_draw_time < 1 / self.img_max_fps:
+            if not self.img_draw_pending:
+                self.img_draw_pending = True
+                QTimer.singleShot(int(1000 / self.img_max_fps), self.draw_pending_img)
+            return
+        self.last_img_draw_time = now
+        with self.recorder.span('gui.show_img'):
+            self.draw_img()
+        
+    def draw_img(self):
         # flip if necessary
         img = self.image.T
         if self.CB_flip_horizontally.isChecked():
@@ -290,55 +472,79 @@ class PMT_GUI(QtWidgets.QMainWindow, Ui_Form):
         if self.CB_flip_vertically.isChecked():
             img = np.flip(img, 0)
         
-        # show the image and the indices
-        self.ax.clear()
-        extent = np.array([self.x_pos_list[0]  - self.GUI_x_step.value()/2,
-                           self.x_pos_list[-1] + self.GUI_x_step.value()/2,
-                           self.y_pos_list[-1] + self.GUI_y_step.value()/2,
-                           self.y_pos_list[0]  - self.GUI_y_step.value()]).astype(np.float16)
-        print("extent", extent)
         if not self.CB_auto_minmax.isChecked():
             my_vmin, my_vmax = float(self.plot_min.text()), float(self.plot_max.text())
         else:
-            my_vmin, my_vmax = None, None
-        print("plot minmax settings", my_vmin, my_vmax)
-        self.ax.imshow(img, extent = extent,  # TODO should the indices also flip when the image is flipped?
-                        vmin = my_vmin, vmax = my_vmax)
-        self.ax.set_xticks(self.x_pos_list)
-        self.ax.set_yticks(self.y_pos_list)
+            my_vmin, my_vmax = np.nanmin(img), np.nanmax(img)
+        
+        geometry = (self.scan_id, self.CB_flip_horizontally.isChecked(), self.CB_flip_vertically.isChecked())
+        if self.img_artist is None or geometry != self.img_geometry:
+            # show the image and the indices
+            self.ax.clear()
+            # the step of the plan, which is finer than the GUI setting during go_to_max
+            x_step = self.x_pos_list[1] - self.x_pos_list[0] if self.x_num > 1 else self.GUI_x_step.value()
+            y_step = self.y_pos_list[1] - self.y_pos_list[0] if self.y_num > 1 else self.GUI_y_step.value()
+            extent = np.array([self.x_pos_list[0]  - x_step/2,
+                               self.x_pos_list[-1] + x_step/2,
+                               self.y_pos_list[-1] + y_step/2,
+                               self.y_pos_list[0]  - y_step/2]).astype(np.float16)
+            self.img_artist = self.ax.imshow(img, extent = extent,  # TODO should the indices also flip when the image is flipped?
+                                             vmin = my_vmin, vmax = my_vmax)
+            self.ax.set_xticks(self.x_pos_list)
+            self.ax.set_yticks(self.y_pos_list)
+            
+            # reduce clutter of labels
+            self.ax.tick_params(axis = 'x', labelrotation = 45)
+            self.img_geometry = geometry
+            self.canvas.draw()
+        else:
+            self.img_artist.set_data(img)
+            self.img_artist.set_clim(my_vmin, my_vmax)
+            self.canvas.draw_idle()
         
-        # reduce clutter of labels
-        self.ax.tick_params(axis = 'x', labelrotation = 45)
+    def draw_pending_img(self):
+        self.img_draw_pending = False
+        self.show_img(ignore_rate_limit = True)
         
-        self.canvas.draw()
+    def apply_plot_settings(self):
+        self.show_img(ignore_rate_limit = True)
     
     def go_to_max(self):
-        # define a small patch around the max position to rescan 
-        max_y_index, max_x_index = np.unravel_index(np.argmax(self.image.T, axis=None), self.image.T.shape)
-        
-        # ver.1: restrict rescan range inside the original scan range
-        # clipped_x_rescan_index = np.clip([max_x_index - self.gotomax_rescan_radius, max_x_index + self.gotomax_rescan_radius + 1], 0, self.x_num-1)
-        # clipped_y_rescan_index = np.clip([max_y_index - self.gotomax_rescan_radius, max_y_index + self.gotomax_rescan_radius + 1], 0, self.y_num-1)
-        # print("Found max value at (%d, %d)." % (self.x_pos_list[max_x_index], self.y_pos_list[max_y_index]))
-        # rescan_x_pos_list = self.x_pos_list[clipped_x_rescan_index[0]:clipped_x_rescan_index[1]]
-        # rescan_y_pos_list = self.x_pos_list[clipped_y_rescan_index[0]:clipped_y_rescan_index[1]]
-        
-        # ver.2: rescan range may extend outside the original scan range. I think this makes more sense
-        max_x_pos, max_y_pos = self.x_pos_list[max_x_index], self.y_pos_list[max_y_index]
-        x_step, y_step = float(self.LE_x_step.text()), float(self.LE_y_step.text()) 
-        x_rescan_radius = self.gotomax_rescan_radius * x_step
-        y_rescan_radius = self.gotomax_rescan_radius * y_step
-        
-        self.update_scan_range(max_x_pos - x_rescan_radius, max_x_pos + x_rescan_radius, x_step,
-                                max_y_pos - y_rescan_radius, max_y_pos + y_rescan_radius, y_step,
-                                float(self.LE_pmt_exposure_time_in_ms.text()))
-                                
-        # initiate scanning
-        self.currently_rescanning = True  # rescanning mode (to avoid recursively calling gotomax() forever)
-        if not self.scanning_thread.running_flag:
-            self.scanning_thread.running_flag = True
-            self.scanning_thread.start()
-        self.send_request()
+        """
+        coarse-to-fine search around the brightest pixel of the current image, then moves there
+        each round rescans a small patch with a smaller step, recentered on the max (or the Gaussian fit)
+        """
+        if not self.measured.any():  # e.g. every pixel failed
+            self.statusbar.showMessage("go to max: no measured pixel in the image")
+            return
+        # failed pixels are nan in the image and unmeasured ones are zero, so take the measured ones only
+        max_x_index, max_y_index = np.unravel_index(np.nanargmax(np.where(self.measured, self.image, np.nan)), self.image.shape)
+        x_step, y_step = self.GUI_x_step.value(), self.GUI_y_step.value()
+        
+        self.peak_search = PeakSearch(self.x_pos_list[max_x_index], self.y_pos_list[max_y_index], x_step, y_step,
+                                      radius = self.gotomax_rescan_radius, max_rounds = self.gotomax_max_rounds,
+                                      uncertainty_threshold = self.gotomax_uncertainty,
+                                      fit_gaussian = self.gotomax_fit_gaussian,
+                                      num_informative_points = self.gotomax_num_informative_points)
+        # the current image is the first round
+        x_index, y_index = np.nonzero(self.measured)
+        self.peak_search.add_results(self.x_pos_list[x_index], self.y_pos_list[y_index], self.image[x_index, y_index])
+        self.continue_peak_search()
+        
+    def continue_peak_search(self):
+        plan = self.peak_search.next_plan()
+        if plan is not None:
+            self.set_scan_plan(plan, float(self.LE_pmt_exposure_time_in_ms.text()))
+            self.start_plan(line_scan_mode = False)  # a round may measure only a few points
+            return
+        
+        # sending motors to max position by making a measurement at that position
+        # scan_id -1 as it is not a part of any scan
+        print("peak found at (%.4f, %.4f) +- (%.4f, %.4f) after %d points" % (
+              self.peak_search.x_center, self.peak_search.y_center,
+              self.peak_search.x_uncertainty, self.peak_search.y_uncertainty, self.peak_search.num_points))
+        self.scan_request.emit(-1, -1, -1, self.peak_search.x_center, self.peak_search.y_center, self.pmt_exposure_time_in_ms)
+        self.peak_search = None  # gotomax is done
     
     def scan_vicinity(self):
         x_pos = self.x_motor.get_position()
@@ -350,20 +556,47 @@ class PMT_GUI(QtWidgets.QMainWindow, Ui_Form):
                                 float(self.LE_pmt_exposure_time_in_ms.text()))
         
         # initiate scanning
-        if not self.scanning_thread.running_flag:
-            self.scanning_thread.running_flag = True
-            self.scanning_thread.start()
-        self.send_request()
+        self.start_plan()
         
     def pause_or_resume_scanning(self):
         print("entered pause_or_resume_scanning()")
         if self.scan_ongoing_flag:  # scanning -> pause
             self.scan_ongoing_flag = False
+            self.scanning_thread.pause_plan()
             self.BTN_pause_or_resume_scanning.setText("Resume Scanning")
         else:  # pause -> resume
             self.scan_ongoing_flag = True
+            self.scanning_thread.resume_plan()
             self.BTN_pause_or_resume_scanning.setText("Pause Scanning")
-            self.send_request()
+        
+    def start_tracking(self):
+        """
+        keeps the stage on the maximum in the background (see IonTracker); scans take priority
+        tune self.scanning_thread.tracker (dither, gain, duty_cycle, ...) before starting
+        """
+        if self.pmt_exposure_time_in_ms < 0:  # nothing scanned yet, so the PMT has no exposure setting
+            self.pmt_exposure_time_in_ms = float(self.LE_pmt_exposure_time_in_ms.text())
+            self.scanning_thread.set_exposure_time(self.pmt_exposure_time_in_ms, num_run = 50)
+        if not self.scanning_thread.running_flag:
+            self.scanning_thread.running_flag = True
+            self.scanning_thread.start()
+        self.scanning_thread.set_tracking(True)
+        
+    def stop_tracking(self):
+        self.scanning_thread.set_tracking(False)
+        
+    def set_tracking(self, tracking):
+        if tracking:
+            self.start_tracking()
+        else:
+            self.stop_tracking()
+        
+    def receive_tracking_result(self, x_pos, y_pos, dx, dy, count):
+        self.LBL_X_pos.setText("%.3f" % x_pos)
+        self.LBL_Y_pos.setText("%.3f" % y_pos)
+        self.latest_count = count
+        self.update_progress_label()
+        self.statusbar.showMessage("tracking: corrected by (%.4f, %.4f), count %.2f" % (dx, dy, count))
         
     def stop_scanning(self):
         if "Release" in self.BTN_stop_scanning.text():
@@ -385,8 +618,10 @@ class PMT_GUI(QtWidgets.QMainWindow, Ui_Form):
         print(x_pos, y_pos)
         self.BTN_SET_pos.setText("Moving..")
         self.BTN_READ_pos.setDisabled(True)
-        self.x_motor.move_to_position(x_pos)
-        self.y_motor.move_to_position(y_pos)
+        x_move = self.x_motor.move_to_position_async(x_pos)
+        y_move = self.y_motor.move_to_position_async(y_pos)
+        self.clock.wait(x_move)
+        self.clock.wait(y_move)
         print("returned from motor.move_to_position")
         self.BTN_SET_pos.setText("SET")
         self.BTN_READ_pos.setEnabled(True)
@@ -408,22 +643,46 @@ class PMT_GUI(QtWidgets.QMainWindow, Ui_Form):
         exp_time = float(self.TXT_exposure_time.text())
         self.scanning_thread.set_exposure_time(exp_time, avg_num)
         
-    def PlotPMTResult(self, count):
-        self.ax_pmt.clear()
-        if len(self.PMT_counts_list) > 50:
-            self.PMT_counts_list.pop(0)
-            self.PMT_number_list.pop(0)
-        self.PMT_num += 1
-        self.PMT_counts_list.append(count)
-        self.PMT_number_list.append(self.PMT_num)
-        
+    def PlotPMTResult(self, counts):
+        """
+        counts: the samples measured since the last frame (coalesced by MyPMTThread)
+        """
+        self.PMT_counts.extend(counts)
+        if self.PMT_trace is not None:
+            self.PMT_trace.extend(counts)
         
-        self.ax_pmt.plot(self.PMT_number_list, self.PMT_counts_list, color='teal')
+        if self.PMT_trace is None or len(self.PMT_counts) <= self.PMT_max_display_points:  # every sample
+            x_plot, y_plot = self.PMT_counts.get_indices(), self.PMT_counts.get()
+        else:
+            x_plot, y_plot = self.PMT_trace.get()
+        self.PMT_line.set_data(x_plot, y_plot)
+        self.ax_pmt.set_xlim(x_plot[0], max(x_plot[-1], x_plot[0] + 1))
         self.ax_pmt.set_ylim(self.PMT_vmin, self.PMT_vmax)
         
-        self.TXT_pmt_result.setText("%.2f" % (count))
+        self.TXT_pmt_result.setText("%.2f" % (counts[-1]))  # the newest sample, not the last decimation bin
+        
+        self.canvas_pmt.draw_idle()
+        self.PMT_thread.frame_done()
         
-        self.canvas_pmt.draw()
+    def ShowPMTRate(self, achieved_rate, dropped_frames):
+        self.statusbar.showMessage("PMT monitor: %.1f samples/s, %d display frames coalesced" % (achieved_rate, dropped_frames))
+        
+    def SetPMTHistoryLength(self, history_length):
+        """
+        keeps the latest samples when the new length is shorter
+        also takes a new PMT_max_display_points
+        """
+        old_counts = self.PMT_counts
+        self.PMT_history_length = history_length
+        self.PMT_counts = RingBuffer(history_length)
+        self.PMT_counts.num_appended = old_counts.num_appended - len(old_counts)
+        self.PMT_counts.extend(old_counts.get())
+        if self.PMT_max_display_points is not None:
+            self.PMT_trace = MinMaxHistory(history_length, self.PMT_max_display_points)
+            self.PMT_trace.num_appended = self.PMT_counts.num_appended - len(self.PMT_counts)
+            self.PMT_trace.extend(self.PMT_counts.get())
+        else:
+            self.PMT_trace = None
         
     def SetPMTMin(self):
         self.PMT_vmin = float(self.TXT_y_min.text())
@@ -443,59 +702,186 @@ class PMT_GUI(QtWidgets.QMainWindow, Ui_Form):
         
             
 class MyPMTThread(QThread):
-    
-    pmt_result = pyqtSignal(float)
+    """
+    Measures the PMT at target_rate (or back to back if None) and emits the samples in frames
+    In continuous mode, the sequencer runs free and each sample is the average of num_run windows
+    A new frame is emitted only after the GUI called frame_done(), so the samples pile up
+    in the next frame instead of flooding the event loop when the GUI can't keep up
+    """
+    pmt_result = pyqtSignal(object)  # np.ndarray of the counts since the last frame
+    pmt_rate = pyqtSignal(float, int)  # achieved samples per second, number of coalesced (dropped) frames
     
     def __init__(self, pmt):
         super().__init__()
         self.pmt = pmt
+        self.clock = get_clock()
         self.run_flag = False
+        self.continuous = False  # free-running sequencer without dead time (target_rate is ignored)
+        self.target_rate = None  # samples per second; None for back to back acquisition
+        self.frame_interval = 1 / 30  # emit frames at most this often
+        self.rate_report_interval = 1  # seconds
+        self.frame_pending = False  # True until the GUI has drawn the last frame
+        self.dropped_frames = 0
+        
+    def frame_done(self):
+        self.frame_pending = False
         
     def run(self):
-        while self.run_flag:
-            my_count = self.pmt.PMT_count_measure()
-            time.sleep(0.1)
-            self.pmt_result.emit(my_count)
+        self.frame_pending = False
+        self.dropped_frames = 0
+        self.samples = []
+        self.num_samples = 0
+        self.last_frame_time = self.last_report_time = self.clock.now()
+        
+        if self.continuous:
+            self.window_counts = np.zeros(0, dtype=np.int32)  # windows not averaged yet
+            # read before streaming: PMT_stream() selects the free-running program, whose num_run is None
+            self.windows_per_sample = self.pmt.num_run
+            self.pmt.PMT_stream(self.add_window_counts, lambda: not self.run_flag)
+        else:
+            next_sample_time = self.clock.now()
+            while self.run_flag:
+                if self.target_rate:
+                    wait_time = next_sample_time - self.clock.now()
+                    if wait_time > 0:
+                        self.clock.sleep(wait_time)
+                    # don't try to catch up after a slow measurement
+                    next_sample_time = max(next_sample_time, self.clock.now() - 1 / self.target_rate) + 1 / self.target_rate
+                
+                my_count = self.pmt.PMT_count_measure()
+                self.add_samples([np.nan if my_count is None else my_count])
+        
+        if self.samples:  # the rest
+            self.pmt_result.emit(np.array(self.samples))
+        self.clock.leave()
+            
+    def add_window_counts(self, tags, counts):
+        # average every num_run windows into one sample like PMT_count_measure()
+        self.window_counts = np.concatenate([self.window_counts, counts])
+        num_complete = len(self.window_counts) // self.windows_per_sample * self.windows_per_sample
+        if num_complete:
+            self.add_samples(self.window_counts[:num_complete].reshape(-1, self.windows_per_sample).mean(axis=1))
+            self.window_counts = self.window_counts[num_complete:]
+        
+    def add_samples(self, samples):
+        self.samples.extend(samples)
+        self.num_samples += len(samples)
+        
+        now = self.clock.now()
+        if now - self.last_frame_time >= self.frame_interval:
+            if self.frame_pending:  # the GUI is still busy with the last frame
+                self.dropped_frames += 1
+            else:
+                self.frame_pending = True
+                self.pmt_result.emit(np.array(self.samples))
+                self.samples = []
+            self.last_frame_time = now
+        if now - self.last_report_time >= self.rate_report_interval:
+            self.pmt_rate.emit(self.num_samples / (now - self.last_report_time), self.dropped_frames)
+            self.num_samples = 0
+            self.last_report_time = now
         
 class ScanningThread(QThread):
     """
     Communicates with relevant hardwares (PMT, motors)
-    Takes scan request by motor positions and emits scan result
+    Runs a whole scan plan by itself and emits the results in batches
+    Also takes a single scan request by motor positions and emits scan result
     """
-    scan_result = pyqtSignal(float, float, float, float)
+    scan_result = pyqtSignal(int, int, int, float, float, float, float)  # scan_id, x_index, y_index, x_pos, y_pos, exposure_time, pmt_count
+    tracking_result = pyqtSignal(float, float, float, float, float)  # x_pos, y_pos, dx, dy, pmt_count
+    plan_result = pyqtSignal(int, object, bool)  # scan_id, rows of (x_index, y_index, x_pos, y_pos, mean, std, min, max, dwell_time, move_time, measure_time, end_time), finished
+    # mean, std, min and max are nan for a pixel whose measurement failed (see measure_stats)
+    # dwell_time is in ms; move_time and measure_time are the seconds spent on the pixel (move_time is nan in line mode)
+    # and end_time is clock.now() when the pixel was done
     
-    def __init__(self, x_motor_serno, y_motor_serno, fpga_com_port):
+    def __init__(self, x_motor_serno, y_motor_serno, fpga_com_port, home_motors = False):
         super().__init__()
+        self.clock = get_clock()
+        self.recorder = get_recorder()
         
         # internal variables
         self.running_flag = False
         self.scan_todo_flag = False  # True when there's a scanning job to do
+        self.scan_id = -1
+        self.x_index = -1
+        self.y_index = -1
         self.x_pos = -1
         self.y_pos = -1
         self.cond = QWaitCondition()
         self.mutex = QMutex()
+        self.clock_thread = None  # the thread of run(), woken up on the clock by wake_up()
+        self.run_started = QSemaphore()  # released when run() is on the clock
+        
+        # scan plan: run point by point (or row by row in line mode) without GUI round trips
+        self.scan_plan = None  # None if there's no plan to run
+        self.plan_scan_id = -1
+        self.plan_line_mode = False
+        self.plan_rows = []  # y indices of the rows in the order of the plan (line mode)
+        self.plan_position = 0  # number of finished steps of the plan
+        self.plan_paused = False
+        self.plan_batch = []  # results not emitted yet
+        self.batch_interval = 0.1  # emit results at most every this many seconds
+        self.last_batch_time = 0
+        
+        # adaptive dwell (point mode only): repeat the measurement of a pixel until its count is good enough
+        self.adaptive_dwell = False
+        self.target_relative_error = 0.05  # Poisson error of the mean relative to the mean
+        self.max_dwell_factor = 10  # at most this many measurements per pixel
+        self.max_fifo_retries = 2  # measure a pixel again after a FIFO error at most this many times
+        self.background_count = None  # mean count clearly below this is background; estimated from the scan if None
+        self.background_factor = 2  # the estimate is this times the median pixel of the current plan
+        self.plan_means = []  # mean counts of the pixels of the current plan, for the background estimate
+        
+        # drift tracking while there's no other job
+        self.tracking = False
+        self.next_tracking_time = 0
         
         # hardware info
         self.x_motor_serno = x_motor_serno
         self.y_motor_serno = y_motor_serno
         self.fpga_com_port = fpga_com_port
+        self.home_motors = home_motors  # home the motors which need it during the setup
         
         self.setup_hardwares()
         self.num_run = 1
+        self.tracker = IonTracker(self.x_motor, self.y_motor, self.pmt)
 
     
     def setup_hardwares(self):
+        """
+        brings up the FPGA and the motors concurrently; each one is done as soon as it reports ready
+        the progress is printed and the total time is kept in self.setup_time
+        if any of them fails, the others are closed again before the error is raised
+        """
+        # one FPGA session shared with MyPMTThread; released by stop_thread_and_clean_up_hardware()
         self.pmt = PMT(port = self.fpga_com_port)
- 
         self.x_motor = KDC101(self.x_motor_serno)
-        self.x_motor.load_dll()
-        self.x_motor.open()
-        self.x_motor.start_polling()
-        
         self.y_motor = KDC101(self.y_motor_serno)
-        self.y_motor.load_dll()
-        self.y_motor.open()
-        self.y_motor.start_polling()
+        
+        start_time = self.clock.now()
+        bring_up({"FPGA": self.pmt.open,
+                  "X motor": lambda: self.setup_motor(self.x_motor),
+                  "Y motor": lambda: self.setup_motor(self.y_motor)},
+                 clock = self.clock,
+                 clean_ups = {"FPGA": self.pmt.close,
+                              "X motor": lambda: self.clean_up_motor(self.x_motor),
+                              "Y motor": lambda: self.clean_up_motor(self.y_motor)})
+        self.setup_time = self.clock.now() - start_time
+        
+    def setup_motor(self, motor):
+        motor.open()
+        try:
+            motor.start_polling()  # returns when the first status has arrived
+            motor.use_message_pump()  # one shared thread receives the messages of all motors
+            if self.home_motors and motor.needs_home():
+                motor.home()
+        except Exception:
+            self.clean_up_motor(motor)  # not left open by a failed setup
+            raise
+            
+    def clean_up_motor(self, motor):
+        motor.stop_polling()
+        motor.close()
         
     def set_exposure_time(self, exposure_time, num_run):
         self.exposure_time = exposure_time
@@ -503,57 +889,307 @@ class ScanningThread(QThread):
         N_1us = round(exposure_time // 0.001)
         self.pmt.setup_PMT_sp(N_1us = N_1us, num_run = num_run)
         
+    def start(self):
+        super().start()
+        self.run_started.acquire()  # so that wake_up() knows the thread
+        
     def run(self):
+        self.clock_thread = current_thread()
+        self.clock.enter()  # holds the time until there's no job to do
+        self.run_started.release()
         while self.running_flag:
             self.mutex.lock()
-            print("thread mutex locked")
-            if not self.scan_todo_flag:  # no job to do
-                self.cond.wait(self.mutex)  # wait for a job to do
-            else:  # there's a job to do
-                print("Going to the requested position")
+            if self.scan_todo_flag:  # there's a single point to measure
                 self.move_to_requested_position()  # should be atomic
-                print("Getting pmt count")
-                my_count = self.pmt.PMT_count_measure()  # should be atomic
+                with self.recorder.span('scan.measure'):
+                    my_count = self.pmt.PMT_count_measure()  # should be atomic
                 self.scan_todo_flag = False  # job done
-                self.scan_result.emit(self.x_pos, self.y_pos, self.exposure_time, my_count)
-            
-            # memo: the program breaks without the following line
-            self.mutex.unlock()
-            print("thread mutex unlocked")
+                self.scan_result.emit(self.scan_id, self.x_index, self.y_index,
+                                      self.x_pos, self.y_pos, self.exposure_time, my_count)
+                self.mutex.unlock()
+            elif self.scan_plan is not None and not self.plan_paused:
+                self.mutex.unlock()
+                self.run_plan_step()  # without the lock so that pause/abort never wait for the hardware
+            elif self.tracking and self.scan_plan is None:
+                wait_time = self.next_tracking_time - self.clock.now()
+                if wait_time > 0 and self.clock.virtual:  # waiting on the condition would stall the virtual time
+                    self.mutex.unlock()
+                    self.clock.sleep(wait_time)
+                elif wait_time > 0:  # keeping the duty cycle; a new job wakes us up
+                    self.cond.wait(self.mutex, int(wait_time * 1000) + 1)
+                    self.mutex.unlock()
+                else:
+                    self.mutex.unlock()
+                    self.run_tracking_step()
+            else:  # no job to do
+                self.clock.leave()  # wake_up() gives the time back with the job
+                self.cond.wait(self.mutex)  # wait for a job to do
+                self.mutex.unlock()
+        self.clock.leave()
             
-    def register_request(self, x_pos, y_pos, exposure_time):
+    def wake_up(self):
+        """
+        wakes run() up for a new job; the virtual time waits until it has started on it
+        """
+        self.clock.wake(self.clock_thread)
+        self.cond.wakeAll()
+        
+    def register_request(self, scan_id, x_index, y_index, x_pos, y_pos, exposure_time):
+        self.scan_id = scan_id
+        self.x_index = x_index
+        self.y_index = y_index
         self.x_pos = x_pos
         self.y_pos = y_pos
         self.exposure_time = exposure_time
         self.scan_todo_flag = True
-        self.cond.wakeAll()
-        print("registered on thread", x_pos, y_pos, exposure_time)
-
+        self.wake_up()
+        
+    def register_plan(self, scan_id, scan_plan, exposure_time, line_mode):
+        """
+        replaces the current plan (if any) with scan_plan and starts running it
+        in line mode, each step is a whole row acquired by acquire_line()
+        """
+        self.mutex.lock()
+        self.plan_scan_id = scan_id
+        self.exposure_time = exposure_time
+        self.plan_line_mode = line_mode
+        _, first_index = np.unique(scan_plan.y_index, return_index=True)
+        self.plan_rows = scan_plan.y_index[np.sort(first_index)]
+        self.plan_position = 0
+        self.plan_paused = False
+        self.plan_batch = []
+        self.plan_means = []
+        self.last_batch_time = self.clock.now()
+        self.scan_plan = scan_plan
+        self.wake_up()
+        self.mutex.unlock()
+        print("registered plan on thread", scan_id, len(scan_plan), exposure_time)
+        
+    def set_tracking(self, tracking):
+        self.mutex.lock()
+        self.tracking = tracking
+        self.next_tracking_time = 0
+        self.wake_up()
+        self.mutex.unlock()
+        
+    def run_tracking_step(self):
+        start_time = self.clock.now()
+        x_pos, y_pos, dx, dy, count = self.tracker.step()
+        self.next_tracking_time = self.clock.now() + self.tracker.wait_time(self.clock.now() - start_time)
+        if dx or dy:
+            print("tracking correction (%.4f, %.4f) to (%.4f, %.4f)" % (dx, dy, x_pos, y_pos))
+        self.tracking_result.emit(x_pos, y_pos, dx, dy, count)
+        
+    def pause_plan(self):
+        self.plan_paused = True  # takes effect after the current step
+        
+    def resume_plan(self):
+        self.mutex.lock()
+        self.plan_paused = False
+        self.wake_up()
+        self.mutex.unlock()
+        
+    def abort_plan(self):
+        self.mutex.lock()
+        self.scan_plan = None
+        self.plan_batch = []
+        self.wake_up()
+        self.mutex.unlock()
+        
+    def run_plan_step(self):
+        plan, scan_id, step = self.scan_plan, self.plan_scan_id, self.plan_position
+        if plan is None:  # aborted just now
+            return
+        
+        start_time = self.clock.now()
+        if self.plan_line_mode:
+            num_steps = len(self.plan_rows)
+            y_index = int(self.plan_rows[step])
+            y_pos = plan.y_pos_list[y_index]
+            with self.recorder.span('scan.line'):
+                line_stats = self.acquire_line(plan.x_pos_list, y_pos, self.exposure_time)
+            end_time = self.clock.now()
+            # moving and exposing overlap during a sweep; the row time is shared by its pixels
+            pixel_time = (end_time - start_time) / len(plan.x_pos_list)
+            results = [(x_index, y_index, x_pos, y_pos, *stats, self.exposure_time * self.num_run,
+                        np.nan, pixel_time, end_time)
+                       for x_index, (x_pos, stats) in enumerate(zip(plan.x_pos_list, line_stats))]
+        else:
+            num_steps = len(plan)
+            x_index, y_index, self.x_pos, self.y_pos = plan[step]
+            self.move_to_requested_position()
+            move_end_time = self.clock.now()
+            with self.recorder.span('scan.measure'):
+                stats = self.measure_stats()
+            end_time = self.clock.now()
+            if not np.isnan(stats[0]):  # failed pixels would skew the background estimate
+                self.plan_means.append(stats[0])
+            results = [(x_index, y_index, self.x_pos, self.y_pos, *stats,
+                        move_end_time - start_time, end_time - move_end_time, end_time)]
+        
+        self.mutex.lock()
+        if self.scan_plan is plan:  # not aborted or replaced meanwhile
+            self.plan_batch += results
+            self.plan_position = step + 1
+            finished = self.plan_position == num_steps
+            if finished or self.plan_paused or self.clock.now() - self.last_batch_time >= self.batch_interval:
+                self.plan_result.emit(scan_id, np.array(self.plan_batch, dtype=float), finished)
+                self.plan_batch = []
+                self.last_batch_time = self.clock.now()
+            if finished:
+                self.scan_plan = None
+        self.mutex.unlock()
+        
     def move_to_requested_position(self):
-        self.x_motor.move_to_position(self.x_pos)
-        self.y_motor.move_to_position(self.y_pos)
+        # both axes move at the same time
+        with self.recorder.span('scan.move'):
+            x_move = self.x_motor.move_to_position_async(self.x_pos)
+            y_move = self.y_motor.move_to_position_async(self.y_pos)
+            self.clock.wait(x_move)
+            self.clock.wait(y_move)
+        
+    def acquire_line(self, x_pos_list, y_pos, exposure_time):
+        """
+        scans a whole row with a single sequencer run while X sweeps at a constant velocity
+        each pixel gets about num_run exposure windows, binned by the X position at each window
+        the sweep starts from the end of the row closer to the current X position (zigzag)
+        returns (mean, std, min, max) of the counts per window for each X in x_pos_list
+        """
+        if len(x_pos_list) < 2:  # nothing to sweep
+            self.x_pos, self.y_pos = x_pos_list[0], y_pos
+            self.move_to_requested_position()
+            return np.array([self.measure_stats()[:4]])
+        
+        N_1us = round(exposure_time // 0.001)
+        window_time = N_1us * 1e-6  # in seconds
+        x_step = x_pos_list[1] - x_pos_list[0]
+        velocity = abs(x_step) / (self.num_run * window_time)  # mm/s
+        
+        # run-up distance to reach the constant velocity before the first pixel
+        acc_devunit, vel_devunit = self.x_motor.get_acc_and_vel()
+        acc = acc_devunit / KDC101.ACC_DEVUNIT_RATIO  # mm/s^2
+        margin = abs(x_step) / 2 + velocity**2 / (2 * acc)
+        x_ends = [x_pos_list[0] - np.sign(x_step) * margin, x_pos_list[-1] + np.sign(x_step) * margin]
+        x_now = self.x_motor.get_position()
+        if abs(x_now - x_ends[1]) < abs(x_now - x_ends[0]):
+            x_ends.reverse()
+        
+        self.x_pos, self.y_pos = x_ends[0], y_pos
+        self.move_to_requested_position()
+        
+        sweep_time = abs(x_ends[1] - x_ends[0]) / velocity + velocity / acc
+        num_windows = int(np.ceil(1.1 * sweep_time / window_time))  # 10% more for the latency
+        
+        # position readback only changes at the polling interval, so keep the first time of each value
+        track = []
+        def sample_position():
+            x = self.x_motor.get_position(max_age=0)
+            if not track or track[-1][1] != x:
+                track.append((self.clock.now(), x))
+        
+        sweep = []
+        self.x_motor.set_acc_and_vel(vel=int(velocity * KDC101.VEL_DEVUNIT_RATIO))
+        try:
+            start_time, tags, counts = self.pmt.PMT_line_measure(
+                N_1us, num_windows,
+                on_start=lambda: sweep.append(self.x_motor.move_to_position_async(x_ends[1])),
+                on_poll=sample_position)
+            for move in sweep:
+                self.clock.wait(move)
+        finally:
+            self.x_motor.set_acc_and_vel(vel=vel_devunit)
+        self.x_pos = x_ends[1]
+        sample_position()
+        
+        track = np.array(track)
+        window_pos = np.interp(start_time + (tags + 0.5) * window_time, track[:, 0], track[:, 1])
+        return bin_counts_by_position(window_pos, counts, x_pos_list)
+    
+    def measure_stats(self):
+        """
+        returns (mean, std, min, max, dwell_time) of the runs at the current position
+        a measurement with a FIFO error is repeated up to max_fifo_retries times; if it still fails,
+        the statistics are nan, which flags the pixel as failed to the consumers of plan_result
+        with adaptive_dwell, measures again until the Poisson relative error reaches target_relative_error,
+        the pixel is clearly background, or max_dwell_factor measurements are done
+        dwell_time is the total exposure in ms
+        """
+        chunks = []
+        num_fifo_errors = 0
+        while True:
+            measurement = self.pmt.PMT_measure(keep_counts = True)
+            if measurement is None:  # FIFO error
+                num_fifo_errors += 1
+                if num_fifo_errors > self.max_fifo_retries:
+                    break
+                continue
+            chunks.append(measurement.counts.copy())  # the PMT reuses its buffer
+            if not self.adaptive_dwell or len(chunks) >= self.max_dwell_factor or self.dwell_is_enough(np.concatenate(chunks)):
+                break
+        
+        dwell_time = len(chunks) * self.exposure_time * self.num_run
+        if not chunks:
+            print("pixel at (%.4f, %.4f) failed after %d FIFO errors" % (self.x_pos, self.y_pos, num_fifo_errors))
+            return (np.nan,) * 4 + (dwell_time,)
+        measurement = PMTMeasurement(np.concatenate(chunks), 0, 0)
+        return measurement.mean, measurement.std, measurement.min, measurement.max, dwell_time
+    
+    def dwell_is_enough(self, counts):
+        total_count = counts.sum()
+        if total_count * self.target_relative_error**2 >= 1:  # 1/sqrt(N) <= target
+            return True
+        
+        background_count = self.background_count
+        if background_count is None and len(self.plan_means) >= 10:
+            background_count = self.background_factor * np.nanmedian(self.plan_means)
+        if background_count is None:
+            return False
+        mean = total_count / len(counts)
+        poisson_sem = np.sqrt(max(mean, 1) / len(counts))
+        return mean + 3 * poisson_sem < background_count  # clearly background
     
     def stop_thread_and_clean_up_hardware(self, release_flag):
         self.running_flag = False
+        self.abort_plan()
         
         print(release_flag)
 
+        # keep the same PMT object so that MyPMTThread keeps sharing the session
         if release_flag: # 
-            self.pmt.sequencer.close() # Release FPGA
-            self.pmt = None
+            self.pmt.close() # Release FPGA
         else:
-            if not self.pmt:
-                self.pmt = PMT(port = self.fpga_com_port)
-                print("Acquired PMT", self.pmt)
-                self.set_exposure_time(self.exposure_time, num_run = 50)
+            self.pmt.open()
+            print("Acquired PMT", self.pmt)
         
     def clean_up_devices(self):
-        if not self.pmt == None:
-            self.pmt.sequencer.close()
-        self.x_motor.stop_polling()
-        self.x_motor.close()
-        self.y_motor.stop_polling()
-        self.y_motor.close()
+        self.pmt.close()
+        self.clean_up_motor(self.x_motor)
+        self.clean_up_motor(self.y_motor)
+        
+def bin_counts_by_position(window_pos, counts, pos_list):
+    """
+    bins the counts of the windows falling into each pixel of the equally spaced pos_list
+    returns an array of (mean, std, min, max) per pixel
+    pixels without any window get zero mean and nan for the rest; std is nan for a single window
+    """
+    step = pos_list[1] - pos_list[0]
+    index = np.rint((window_pos - pos_list[0]) / step).astype(int)
+    inside = (index >= 0) & (index < len(pos_list))
+    index, counts = index[inside], counts[inside].astype(float)
+    
+    count_sum = np.bincount(index, weights=counts, minlength=len(pos_list))
+    square_sum = np.bincount(index, weights=counts**2, minlength=len(pos_list))
+    num_windows = np.bincount(index, minlength=len(pos_list))
+    mean = np.divide(count_sum, num_windows, out=np.zeros(len(pos_list)), where=num_windows > 0)
+    variance = np.divide(square_sum - num_windows * mean**2, num_windows - 1,
+                         out=np.full(len(pos_list), np.nan), where=num_windows > 1)
+    
+    count_min = np.full(len(pos_list), np.inf)
+    count_max = np.full(len(pos_list), -np.inf)
+    np.minimum.at(count_min, index, counts)
+    np.maximum.at(count_max, index, counts)
+    count_min[num_windows == 0] = count_max[num_windows == 0] = np.nan
+    return np.column_stack([mean, np.sqrt(np.maximum(variance, 0)), count_min, count_max])
         
 if __name__ == "__main__":
     app = QtWidgets.QApplication.instance()
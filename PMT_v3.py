@@ -11,109 +11,370 @@ from SequencerProgram_v1_07 import SequencerProgram, reg
 import HardwareDefinition_1S_test as hd
 import SequencerUtility_v1_01 as su
 from ArtyS7_v1_02 import ArtyS7
+from pmt_measurement import PMTMeasurement
+from clocks import get_clock
+from spans import get_recorder
 import numpy as np
 import time
+import threading
+from collections import OrderedDict
 
 class PMT():
-    def __init__(self, port = 'COM7'):
+    def __init__(self, port = 'COM7', sp_cache_size = 8,
+                 poll_interval = 0.0005, max_poll_interval = 0.01, clock = None, recorder = None):
         self.port = port
+        self.clock = get_clock() if clock is None else clock  # polling waits and timestamps
+        self.recorder = get_recorder() if recorder is None else recorder  # times the phases of a measurement
         self.run_counter = reg[0]
         self.wait_counter = reg[1]
+        self.loop_register = reg[2]  # stays 0 so that a free-running program always branches back
         self.PMT_sp= SequencerProgram()
         
         # scanning thread should call this function AFTER scan settings are given by the user
         # self.setup_PMT_sp() 
+        self.sp_params = None  # (N_1us, T_1us, num_run) of the current PMT_sp
+        self.sp_cache = OrderedDict()  # LRU cache of built programs keyed by sp_params
+        self.sp_cache_size = sp_cache_size
         
-    #  def __del__(self):
-    #    self.sequencer.close
+        # FPGA session: opened once and shared by every thread using this PMT
+        self.sequencer = None
+        self.resident_sp_params = None  # sp_params of the program uploaded to the FPGA
+        self.lock = threading.RLock()
+        
+        # FIFO reading: per-run counts of the latest measurement and polling period in seconds
+        self.counts = np.zeros(0, dtype=np.int32)
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        
+    def __enter__(self):
+        return self.open()
+    
+    def __exit__(self, *exc):
+        self.close()
+        
+    def open(self):
+        """Opens the FPGA and checks its version. Does nothing if already opened.
+        
+        The sequencer program is uploaded lazily by PMT_count_measure().
+        """
+        with self.lock:
+            if self.sequencer is None:
+                with self.recorder.span('pmt.open'):
+                    self.sequencer = ArtyS7(self.port)
+                    self.sequencer.check_version(hd.HW_VERSION)
+                self.resident_sp_params = None
+        return self
+    
+    def close(self):
+        """Releases the FPGA so that other programs can use it."""
+        with self.lock:
+            if self.sequencer is not None:
+                self.sequencer.close()
+                self.sequencer = None
+            self.resident_sp_params = None
+            
+    def is_open(self):
+        return self.sequencer is not None
 
     def setup_PMT_sp(self, 
                      N_1us = 2,
                      T_1us = 100-3-2,
                      num_run = 50,
                      ):
+        """Selects the sequencer program for the given exposure settings.
+        
+        Programs are kept in an LRU cache keyed by (N_1us, T_1us, num_run), so
+        switching back to a recent setting costs only an upload, or nothing if
+        the program is still resident on the FPGA. num_run = None selects the
+        free-running program used by PMT_stream().
+        """
+        key = (N_1us, T_1us, num_run)
+        with self.lock:
+            if key in self.sp_cache:
+                self.sp_cache.move_to_end(key)
+            else:
+                self.sp_cache[key] = self._build_PMT_sp(N_1us, T_1us, num_run)
+                if len(self.sp_cache) > self.sp_cache_size:
+                    self.sp_cache.popitem(last=False)  # least recently used
+            
+            self.PMT_sp = self.sp_cache[key]
+            self.sp_params = key
+            self.N_1us, self.T_1us, self.num_run = key
+        
+    def _build_PMT_sp(self, N_1us, T_1us, num_run):
         print("setup_PMT_sp: ", N_1us, T_1us, num_run)
-        self.N_1us = N_1us
-        self.T_1us = T_1us
-        self.num_run = num_run
+        sp = SequencerProgram()
         
-        self.PMT_sp.load_immediate(self.run_counter, 0, 'reg[0] will be used for run number')
+        sp.load_immediate(self.run_counter, 0, 'reg[0] will be used for run number')
         
         # Start of the repeating part
-        self.PMT_sp.repeat_run = \
+        sp.repeat_run = \
         \
-        self.PMT_sp.load_immediate(self.wait_counter, 0)
-        self.PMT_sp.trigger_out([hd.PMT1_counter_reset], 'Reset single counter')
-        self.PMT_sp.set_output_port(hd.counter_control_port, [(hd.PMT1_counter_enable, 1), ], 'Start counter')
+        sp.load_immediate(self.wait_counter, 0)
+        sp.trigger_out([hd.PMT1_counter_reset], 'Reset single counter')
+        sp.set_output_port(hd.counter_control_port, [(hd.PMT1_counter_enable, 1), ], 'Start counter')
         
-        self.PMT_sp.repeat_wait = \
+        sp.repeat_wait = \
         \
-        self.PMT_sp.wait_n_clocks(self.T_1us, 'Wait for 100 * 10 ns unconditionally')
-        self.PMT_sp.add(self.wait_counter, self.wait_counter, 1)
-        self.PMT_sp.branch_if_less_than('repeat_wait', self.wait_counter, self.N_1us)
+        sp.wait_n_clocks(T_1us, 'Wait for 100 * 10 ns unconditionally')
+        sp.add(self.wait_counter, self.wait_counter, 1)
+        sp.branch_if_less_than('repeat_wait', self.wait_counter, N_1us)
         
-        self.PMT_sp.set_output_port(hd.counter_control_port, [(hd.PMT1_counter_enable, 0), ], 'Stop counter')
+        sp.set_output_port(hd.counter_control_port, [(hd.PMT1_counter_enable, 0), ], 'Stop counter')
         
-        self.PMT_sp.read_counter(reg[10], hd.PMT1_counter_result)
-        self.PMT_sp.write_to_fifo(self.run_counter, reg[10], reg[10], 10, 'Counts within 1 ms')
+        sp.read_counter(reg[10], hd.PMT1_counter_result)
+        sp.write_to_fifo(self.run_counter, reg[10], reg[10], 10, 'Counts within 1 ms')
         
         
         # Decide whether we will repeat running
-        self.PMT_sp.decide_repeat = \
+        sp.decide_repeat = \
         \
-        self.PMT_sp.add(self.run_counter, self.run_counter, 1, 'run_counter++')
-        self.PMT_sp.branch_if_less_than('repeat_run', self.run_counter, self.num_run)
-        self.PMT_sp.stop()
+        sp.add(self.run_counter, self.run_counter, 1, 'run_counter++')
+        if num_run is None:  # free-running until stopped by the host
+            sp.load_immediate(self.loop_register, 0)
+            sp.branch_if_less_than('repeat_run', self.loop_register, 1, 'Always repeat')
+        else:
+            sp.branch_if_less_than('repeat_run', self.run_counter, num_run)
+        sp.stop()
         
         #print("setup complete")
+        return sp
      
     def flush_out_FIFO(self, debug = False):
         pass
 #        self.sequencer.flush_Output_FIFO(debug= debug)
         
-    def PMT_count_measure(self):
+    def PMT_count_measure(self, return_counts = False):
+        """Runs the sequencer program once and returns the averaged count.
         
-        self.sequencer = ArtyS7(self.port)
-        self.sequencer.check_version(hd.HW_VERSION)
-        self.PMT_sp.program(show=False, target=self.sequencer)
+        If the session is already opened by open(), it is reused and the program
+        is uploaded only when it has changed. Otherwise the FPGA is opened and
+        closed within this call.
         
-        self.sequencer.auto_mode()
-        self.sequencer.send_command('START SEQUENCER')
+        If return_counts is True, returns (average, counts) where counts is the
+        per-run np.int32 vector. counts is the internal buffer, so it is only
+        valid until the next measurement; copy it if you want to keep it.
         
-        data_count = self.sequencer.fifo_data_length()
-        data = self.sequencer.read_fifo_data(data_count)
-        total_data_count = data_count
+        Use PMT_measure() for the other statistics of the runs.
+        """
+        measurement = self.PMT_measure()
+        average = None if measurement is None else measurement.mean
         
-        while self.sequencer.sequencer_running_status() == 'running':
-            data_count = self.sequencer.fifo_data_length()
-            data += self.sequencer.read_fifo_data(data_count)
-            total_data_count += data_count
+        if return_counts:
+            return average, self.counts
+        return average
         
-        data_count = self.sequencer.fifo_data_length()
-        while data_count > 0:
-            data += self.sequencer.read_fifo_data(data_count)
-            total_data_count += data_count
-            data_count = self.sequencer.fifo_data_length()
+    def PMT_measure(self, keep_counts = False):
+        """Runs the sequencer program once like PMT_count_measure().
+        
+        Parameters
+        ----------
+        keep_counts : bool (default False)
+            keep the per-run counts in the result; this is the internal
+            buffer (no copy), valid only until the next measurement
+        
+        Returns
+        -------
+        PMTMeasurement or None
+            the statistics of the runs, or None if the FIFO did not give
+            exactly num_run entries
+        """
+        with self.lock:
+            temporary_session = not self.is_open()
+            if temporary_session:
+                self.open()
+            try:
+                return self._run_PMT_sp(keep_counts)
+            finally:
+                if temporary_session:
+                    self.close()
         
-        if total_data_count == self.num_run:
-            print('FIFO data length:', total_data_count)
+    def PMT_line_measure(self, N_1us, num_windows, T_1us = 100-3-2,
+                         on_start = None, on_poll = None):
+        """Records num_windows consecutive exposure windows within a single run.
+        
+        Used for line scans: the motor sweeps while the windows are recorded,
+        and each FIFO entry is tagged with its window index by the run counter.
+        The previously selected program is selected again afterwards.
+        
+        Parameters
+        ----------
+        N_1us : int
+            exposure of each window in microseconds
+        num_windows : int
+            number of windows in the run
+        on_start : callable (optional)
+            called right after the sequencer is started, e.g. to start a sweep
+        on_poll : callable (optional)
+            called at every FIFO poll, e.g. to sample the motor position
+        
+        Returns
+        -------
+        tuple (float, np.ndarray, np.ndarray)
+            (start_time, tags, counts) where start_time is self.clock.now()
+            at the start of the sequencer, tags the window indices and counts
+            the counts of the windows actually read from the FIFO
+        """
+        with self.lock:
+            previous_sp_params = self.sp_params
+            self.setup_PMT_sp(N_1us = N_1us, T_1us = T_1us, num_run = num_windows)
+            counts = np.zeros(num_windows, dtype=np.int32)
+            tags = np.zeros(num_windows, dtype=np.int32)
             
-        else:
+            temporary_session = not self.is_open()
+            if temporary_session:
+                self.open()
+            try:
+                start_time = self._start_PMT_sp()
+                if on_start is not None:
+                    on_start()
+                with self.recorder.span('pmt.drain_line'):
+                    total_data_count = self._drain_FIFO(counts, tags, on_poll)
+            finally:
+                if temporary_session:
+                    self.close()
+                if previous_sp_params is not None:
+                    self.setup_PMT_sp(*previous_sp_params)
+        
+        if total_data_count != num_windows:
+            print("Error: FIFO data length:", total_data_count)
+        total_data_count = min(total_data_count, num_windows)
+        return start_time, tags[:total_data_count], counts[:total_data_count]
+        
+    def PMT_stream(self, on_counts, should_stop, N_1us = None, T_1us = None):
+        """Streams the counts of back-to-back exposure windows until should_stop() returns True.
+        
+        A free-running program loops on the sequencer without stopping, so
+        there is no dead time for re-arming between batches; the host only
+        drains the FIFO. The FPGA is kept by this call (other threads wait on
+        the lock) and the previously selected program is selected again afterwards.
+        
+        Parameters
+        ----------
+        on_counts : callable
+            called as on_counts(tags, counts) with np.int32 arrays of every
+            batch read from the FIFO; tags are the window numbers, so a gap
+            means that the FIFO has overflowed
+        should_stop : callable
+            checked at every FIFO poll
+        N_1us, T_1us : int (optional)
+            exposure settings of each window; the current ones if None
+        
+        Returns
+        -------
+        int
+            total number of windows read
+        """
+        with self.lock:
+            previous_sp_params = self.sp_params
+            if N_1us is None:
+                N_1us = self.N_1us
+            if T_1us is None:
+                T_1us = self.T_1us
+            self.setup_PMT_sp(N_1us = N_1us, T_1us = T_1us, num_run = None)
+            
+            temporary_session = not self.is_open()
+            if temporary_session:
+                self.open()
+            stopping = False
+            total_data_count = 0
+            interval = self.poll_interval
+            try:
+                self._start_PMT_sp()
+                while True:
+                    if not stopping and should_stop():
+                        self.sequencer.send_command('STOP SEQUENCER')
+                        stopping = True
+                    running = self.sequencer.sequencer_running_status() == 'running'
+                    data_count = self.sequencer.fifo_data_length()
+                    
+                    if data_count > 0:
+                        entries = self.sequencer.read_fifo_data(data_count)
+                        tags = np.array([entry[0] for entry in entries], dtype=np.int32)
+                        counts = np.array([entry[1] for entry in entries], dtype=np.int32)
+                        total_data_count += len(entries)
+                        on_counts(tags, counts)
+                        interval = self.poll_interval
+                    elif not running:
+                        return total_data_count
+                    else:
+                        self.clock.sleep(interval)
+                        interval = min(2 * interval, self.max_poll_interval)
+            finally:
+                if not stopping and self.is_open():  # e.g. on_counts raised
+                    self.sequencer.send_command('STOP SEQUENCER')
+                if temporary_session:
+                    self.close()
+                if previous_sp_params is not None:
+                    self.setup_PMT_sp(*previous_sp_params)
+        
+    def _start_PMT_sp(self):
+        if self.resident_sp_params != self.sp_params:
+            with self.recorder.span('pmt.upload'):
+                self.PMT_sp.program(show=False, target=self.sequencer)
+            self.resident_sp_params = self.sp_params
+        
+        with self.recorder.span('pmt.start'):
+            self.sequencer.auto_mode()
+            start_time = self.clock.now()
+            self.sequencer.send_command('START SEQUENCER')
+        return start_time
+        
+    def _run_PMT_sp(self, keep_counts = False):
+        if len(self.counts) != self.num_run:
+            self.counts = np.zeros(self.num_run, dtype=np.int32)
+        
+        start_time = self._start_PMT_sp()
+        
+        with self.recorder.span('pmt.drain'):
+            total_data_count = self._drain_FIFO(self.counts)
+        duration = self.clock.now() - start_time
+        
+        if total_data_count != self.num_run:
             print("Error: FIFO data length:", total_data_count)
             return None
-		
-        self.sequencer.close()
-		
-        real_data = []
-        for n in range(len(data)):
-            real_data.append(data[n][1])
         
-        # PMT_count
-        print(np.average(real_data))
-        return np.average(real_data)
+        return PMTMeasurement(self.counts, start_time, duration, keep_counts)
+    
+    def _drain_FIFO(self, counts, tags = None, on_poll = None):
+        """Reads the FIFO into counts until the sequencer stops and the FIFO is empty.
+        
+        While the FIFO is empty, polls with an exponential backoff from
+        poll_interval up to max_poll_interval instead of spinning.
+        Entries beyond len(counts) are counted but discarded.
+        If tags is given, the run counter of each entry is stored in it.
+        If on_poll is given, it is called at every poll.
+        
+        Returns
+        -------
+        int
+            total number of FIFO entries read
+        """
+        total_data_count = 0
+        interval = self.poll_interval
+        while True:
+            # check the status first so that the data written before stopping is not missed
+            running = self.sequencer.sequencer_running_status() == 'running'
+            data_count = self.sequencer.fifo_data_length()
+            if on_poll is not None:
+                on_poll()
+            
+            if data_count > 0:
+                for entry in self.sequencer.read_fifo_data(data_count):
+                    if total_data_count < len(counts):
+                        counts[total_data_count] = entry[1]
+                        if tags is not None:
+                            tags[total_data_count] = entry[0]
+                    total_data_count += 1
+                interval = self.poll_interval
+            elif not running:
+                return total_data_count
+            else:
+                self.clock.sleep(interval)
+                interval = min(2 * interval, self.max_poll_interval)
         
 #%%
 if __name__ == '__main__':
-    my_pmt = PMT(port = 'COM7')
-    my_pmt.setup_PMT_sp(N_1us = 3)
-    count = my_pmt.PMT_count_measure()
+    with PMT(port = 'COM7') as my_pmt:
+        my_pmt.setup_PMT_sp(N_1us = 3)
+        count = my_pmt.PMT_count_measure()
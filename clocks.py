@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+A module for the time source of the acquisition, motor and GUI-timing code.
+
+Every timing (timestamps, polling, waiting for the hardware) goes through
+a clock object instead of the time module, so that the whole program can
+run on a virtual time with the simulated hardware (see sim_hardware):
+sleeping costs no real time, but everything reported (durations, dwell
+times, timestamps) is in modeled seconds.
+
+The components take the clock at construction; if not given, the default
+one of get_clock() is used, so set_clock() has to be called first:
+    clocks.set_clock(clocks.VirtualClock())
+
+For the virtual time to be reproducible, a thread which the clock has
+released must wait through the clock (sleep(), wait() on a Future) and
+call leave() before it blocks on anything else or finishes; a thread which
+wakes up another one by other means calls wake() for it.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import TimeoutError
+
+
+class RealClock:
+    """
+    The real time.
+
+    Attributes
+    ----------
+    virtual : bool
+        False; sleeping really waits
+
+    Methods
+    -------
+    now         : () => float
+    time        : () => float
+    sleep       : float => ()
+    wait        : Future [, float] => object
+    enter       : () => bool
+    leave       : () => ()
+    wake        : Thread => ()
+    """
+    virtual = False
+
+    def now(self):
+        """Returns a monotonic time in seconds for measuring intervals.
+        """
+        return time.perf_counter()
+
+    def time(self):
+        """Returns the wall-clock time in seconds since the epoch, e.g. for logs.
+        """
+        return time.time()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def wait(self, future, timeout=None):
+        """Returns future.result(timeout), waiting in the time of the clock.
+        """
+        return future.result(timeout)
+
+    def enter(self):
+        """Tells that this thread runs on the clock from now on (see VirtualClock).
+
+        Returns True if it did already.
+        """
+        return False
+
+    def leave(self):
+        """Tells that this thread stops running on the clock (see VirtualClock).
+        """
+        pass
+
+    def wake(self, thread):
+        """Tells that this thread has just woken up thread by other means (see VirtualClock).
+        """
+        pass
+
+
+class VirtualClock:
+    """
+    A virtual time shared by the threads which wait on it.
+
+    The time only moves when no thread holds it: then it jumps to the
+    earliest wake-up of the sleeping threads, and those threads are
+    released. A thread holds the time from its release until it waits on
+    the clock again (sleep() or wait()), calls leave() or finishes, so its
+    work takes no virtual time however long it takes in real time, and the
+    same program gives the same virtual times on any host.
+
+    A thread waiting on a Future with wait() holds the time again as soon as
+    the Future is resolved (if it held it before), so the thread resolving
+    it needs nothing special. enter() makes a thread hold the time, e.g.
+    before starting threads which must all be running before the time goes
+    on, and wake() makes a thread hold it when it is woken up by other means
+    (e.g. a condition variable) while it is not waiting on the clock.
+
+    A thread holding the time must not block on something which only a
+    thread waiting on the clock can release (e.g. a lock held by a sleeping
+    thread). If the time is held for more than stall_timeout seconds of real
+    time, the holders are reported and dropped so that the program goes on,
+    at the cost of the reproducibility.
+
+    Attributes
+    ----------
+    virtual : bool
+        True; sleeping costs no real time
+    stall_timeout : float
+        in seconds of real time
+
+    Methods
+    -------
+    now         : () => float
+    time        : () => float
+    sleep       : float => ()
+    wait        : Future [, float] => object
+    enter       : () => bool
+    leave       : () => ()
+    wake        : Thread => ()
+    """
+    virtual = True
+
+    def __init__(self, start=0.0, stall_timeout=10.0):
+        """
+        Parameters
+        ----------
+        start : float (default 0.0)
+            the initial value of now()
+        stall_timeout : float (default 10.0)
+            in seconds of real time
+        """
+        self.stall_timeout = stall_timeout
+        self.__now = start
+        self.__epoch = time.time() - start  # time() starts at the real wall-clock time
+        self.__cond = threading.Condition()
+        self.__sleepers = []  # heap of (wake-up time, sequence number, Thread, holds the time after the release)
+        self.__sequence = itertools.count()
+        self.__holders = {}  # thread ident => Thread, the threads holding the time
+        self.__waiting = set()  # idents of the threads waiting on the clock
+        self.__last_change = time.perf_counter()  # real time of the last change of the holders or the time
+
+    def now(self):
+        return self.__now
+
+    def time(self):
+        return self.__epoch + self.__now
+
+    def sleep(self, seconds):
+        with self.__cond:
+            entry = self.__begin_wait(self.__now + max(seconds, 0), holds=True)
+            while self.__now < entry[0]:
+                self.__advance()
+                if self.__now < entry[0]:
+                    self.__cond.wait(self.stall_timeout)
+            self.__end_wait(entry)
+
+    def wait(self, future, timeout=None):
+        me = threading.current_thread()
+        with self.__cond:
+            holds = me.ident in self.__holders
+            deadline = None if timeout is None else self.__now + max(timeout, 0)
+            entry = self.__begin_wait(deadline, holds)
+        pending = [True]
+
+        def resolved(_):
+            with self.__cond:
+                if pending[0]:
+                    if holds:  # goes on before the time does
+                        self.__hold(me)
+                    self.__cond.notify_all()
+
+        future.add_done_callback(resolved)  # called right away if already done
+        with self.__cond:
+            while not future.done() and (entry is None or self.__now < entry[0]):
+                self.__advance()
+                if not future.done() and (entry is None or self.__now < entry[0]):
+                    self.__cond.wait(self.stall_timeout)
+            pending[0] = False
+            self.__end_wait(entry)
+            if not future.done():
+                raise TimeoutError()
+        return future.result()
+
+    def enter(self):
+        me = threading.current_thread()
+        with self.__cond:
+            held = me.ident in self.__holders
+            self.__hold(me)
+            return held
+
+    def leave(self):
+        with self.__cond:
+            self.__release(threading.get_ident())
+
+    def wake(self, thread):
+        with self.__cond:
+            if thread is not None and thread.ident not in self.__waiting:
+                self.__hold(thread)
+
+    def __begin_wait(self, wake_time, holds):
+        me = threading.current_thread()
+        self.__release(me.ident)
+        self.__waiting.add(me.ident)
+        if wake_time is None:
+            return None
+        entry = (wake_time, next(self.__sequence), me, holds)
+        heapq.heappush(self.__sleepers, entry)
+        return entry
+
+    def __end_wait(self, entry):
+        self.__waiting.discard(threading.get_ident())
+        if entry is not None:
+            self.__sleepers.remove(entry)
+            heapq.heapify(self.__sleepers)
+        self.__cond.notify_all()
+
+    def __hold(self, thread):
+        self.__holders[thread.ident] = thread
+        self.__last_change = time.perf_counter()
+
+    def __release(self, ident):
+        if self.__holders.pop(ident, None) is not None:
+            self.__last_change = time.perf_counter()
+            self.__cond.notify_all()
+
+    def __advance(self):
+        for ident, thread in list(self.__holders.items()):
+            if not thread.is_alive():
+                self.__release(ident)
+        if self.__holders and time.perf_counter() - self.__last_change > self.stall_timeout:
+            print("VirtualClock: the time has been held for %.0f s by %s; going on without them"
+                  % (self.stall_timeout, ", ".join(thread.name for thread in self.__holders.values())))
+            self.__holders.clear()
+        if self.__holders or not self.__sleepers:
+            return
+
+        wake_time = self.__sleepers[0][0]
+        if wake_time > self.__now:
+            self.__now = wake_time
+            self.__last_change = time.perf_counter()
+        # the released threads hold the time until they wait again, even before they get to run
+        for entry_time, _, thread, holds in self.__sleepers:
+            if entry_time <= self.__now and holds:
+                self.__hold(thread)
+        self.__cond.notify_all()
+
+
+_default_clock = RealClock()
+
+
+def get_clock():
+    """Returns the default clock; a RealClock unless set_clock() was called.
+    """
+    return _default_clock
+
+
+def set_clock(clock):
+    """Sets the default clock used by the components created afterwards.
+    """
+    global _default_clock
+    _default_clock = clock
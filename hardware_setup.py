@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+A module for bringing up several devices at the same time.
+
+Each device has its own bring-up function (e.g. open a KDC101, start polling
+and wait for its first status; open the FPGA and check its version) which
+runs in its own thread, so the startup takes as long as the slowest device
+instead of the sum of all of them. The bring-up functions should wait for
+the devices to be ready instead of sleeping for a fixed time.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Semaphore
+
+from clocks import get_clock
+
+
+def print_progress(name, state, elapsed_time, error=None):
+    """The default progress report of bring_up().
+    """
+    if error is None:
+        print("[%6.2f s] %s: %s" % (elapsed_time, name, state))
+    else:
+        print("[%6.2f s] %s: %s (%s: %s)" % (elapsed_time, name, state, type(error).__name__, error))
+
+
+def bring_up(tasks, on_progress=print_progress, clock=None, clean_ups=None):
+    """Runs the bring-up functions of the devices concurrently.
+
+    Waits for all of them even if some fail, so that no device is left
+    half-initialized in the background. If any of them fails, the devices
+    which came up are cleaned up before raising.
+
+    Parameters
+    ----------
+    tasks : dict
+        {name: callable} of the bring-up functions, called without arguments
+    on_progress : callable (default print_progress)
+        called as on_progress(name, state, elapsed_time, error) from the
+        worker threads, where state is 'started', 'ready', 'failed' or
+        'cleaned up' (or 'clean-up failed', from the calling thread),
+        elapsed_time is in seconds since the call of bring_up() and error is
+        the exception of a failure (otherwise None); None for no report
+    clock : RealClock or VirtualClock (optional)
+        get_clock() if None
+    clean_ups : dict (optional)
+        {name: callable} undoing the bring-up functions (e.g. stop polling
+        and close), called for the tasks which succeeded if another one
+        failed; the errors of the clean-ups are only reported
+
+    Returns
+    -------
+    dict
+        {name: return value} of the bring-up functions
+
+    Raises
+    ------
+    Exception - the error of the first failed task (in the order of tasks)
+        after all the tasks have finished and the others are cleaned up
+    """
+    clock = get_clock() if clock is None else clock
+    start_time = clock.now()
+
+    def report(name, state, error=None):
+        if on_progress is not None:
+            on_progress(name, state, clock.now() - start_time, error)
+
+    def run(name, task):
+        clock.enter()
+        started.release()
+        try:
+            report(name, 'started')
+            try:
+                result = task()
+            except Exception as e:
+                report(name, 'failed', e)
+                raise
+            report(name, 'ready')
+            return result
+        finally:
+            clock.leave()  # the worker idles outside the clock
+
+    if not tasks:
+        return {}
+    started = Semaphore(0)
+    held = clock.enter()  # a virtual time waits until all of them are running
+    try:
+        with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+            futures = {name: executor.submit(run, name, task) for name, task in tasks.items()}
+            for _ in tasks:
+                started.acquire()
+            for name, future in futures.items():
+                try:
+                    clock.wait(future)  # wait for every task before raising
+                except Exception:
+                    pass
+            failed = [name for name, future in futures.items() if future.exception() is not None]
+            if failed:
+                for name, clean_up in (clean_ups or {}).items():
+                    if name in futures and name not in failed:
+                        try:
+                            clean_up()
+                        except Exception as e:
+                            report(name, 'clean-up failed', e)
+                        else:
+                            report(name, 'cleaned up')
+                raise futures[failed[0]].exception()
+            results = {name: future.result() for name, future in futures.items()}
+    finally:
+        if not held:
+            clock.leave()
+    return results
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+A module for keeping the stage on the fluorescence maximum.
+
+IonTracker is a hill climber: each step dithers X and Y around the current
+position, estimates the gradient from the count differences and moves
+toward the maximum. It only uses the KDC101 and PMT interfaces, so it can
+run in the scanning thread between other jobs.
+"""
+
+import numpy as np
+
+from clocks import get_clock
+
+
+class IonTracker:
+    """
+    A dithering hill-climbing tracker for slow drifts of the ion position.
+
+    Attributes
+    ----------
+    dither : float
+        the distance of the dither points from the center, in mm
+    gain : float
+        the correction is gain * (c+ - c-) / (c+ + c-) along each axis, in
+        mm; about sigma^2 / dither of the spot for a Newton-like step
+    max_step : float
+        the largest correction of a single step along each axis, in mm
+    significance : float
+        correct an axis only if its count difference exceeds this many
+        standard errors
+    duty_cycle : float
+        the fraction of the time spent tracking (see wait_time)
+    log : list of tuple
+        (clock.time(), x, y, dx, dy, count) of every step
+
+    Methods
+    -------
+    step      : () => (float, float, float, float, float)
+    wait_time : float => float
+    """
+
+    def __init__(self, x_motor, y_motor, pmt, dither=0.002, gain=None,
+                 max_step=None, significance=2, duty_cycle=0.2, clock=None):
+        """
+        Parameters
+        ----------
+        x_motor, y_motor : KDC101
+            the stages
+        pmt : PMT
+            measures with the current exposure settings
+        dither : float (default 0.002)
+            in mm
+        gain, max_step : float (optional)
+            in mm; dither and 2 * dither if None
+        significance : float (default 2)
+        duty_cycle : float (default 0.2)
+        clock : RealClock or VirtualClock (optional)
+            timestamps the log; get_clock() if None
+        """
+        self.x_motor = x_motor
+        self.y_motor = y_motor
+        self.pmt = pmt
+        self.dither = dither
+        self.gain = dither if gain is None else gain
+        self.max_step = 2 * dither if max_step is None else max_step
+        self.significance = significance
+        self.duty_cycle = duty_cycle
+        self.clock = get_clock() if clock is None else clock
+        self.log = []
+
+    def step(self):
+        """Dithers around the current position and moves toward the maximum.
+
+        Returns
+        -------
+        tuple
+            (x, y, dx, dy, count): the new position, the correction and
+            the mean count of the dither points; a correction is 0 when the
+            count difference was not significant or a measurement failed
+        """
+        x, y = self.x_motor.get_position(), self.y_motor.get_position()
+        dither_points = [(x + self.dither, y), (x - self.dither, y),
+                         (x, y + self.dither), (x, y - self.dither)]
+        measurements = []
+        for dither_x, dither_y in dither_points:
+            self.__move_to(dither_x, dither_y)
+            measurements.append(self.pmt.PMT_measure())
+
+        dx = self.__correction(measurements[0], measurements[1])
+        dy = self.__correction(measurements[2], measurements[3])
+        self.__move_to(x + dx, y + dy)
+
+        means = [m.mean for m in measurements if m is not None]
+        count = np.mean(means) if means else np.nan
+        self.log.append((self.clock.time(), x + dx, y + dy, dx, dy, count))
+        return x + dx, y + dy, dx, dy, count
+
+    def wait_time(self, step_duration):
+        """Returns how long to wait after a step of step_duration seconds to keep the duty cycle.
+        """
+        return step_duration * (1 - self.duty_cycle) / self.duty_cycle
+
+    def __correction(self, plus, minus):
+        if plus is None or minus is None or plus.mean + minus.mean <= 0:
+            return 0
+        difference = plus.mean - minus.mean
+        if abs(difference) <= self.significance * np.sqrt(self.__variance(plus) + self.__variance(minus)):
+            return 0
+        return float(np.clip(self.gain * difference / (plus.mean + minus.mean), -self.max_step, self.max_step))
+
+    def __variance(self, measurement):
+        # Poisson variance of the mean if the runs do not give a spread (e.g. a single run)
+        if np.isfinite(measurement.sem):
+            return measurement.sem**2
+        return max(measurement.mean, 1) / measurement.num_run
+
+    def __move_to(self, x, y):
+        x_move = self.x_motor.move_to_position_async(x)
+        y_move = self.y_motor.move_to_position_async(y)
+        self.clock.wait(x_move)
+        self.clock.wait(y_move)
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+A module for locating the brightest spot (e.g. an ion) with few measurements.
+
+PeakSearch is a coarse-to-fine search: each round scans a small patch
+around the current estimate, then the estimate is recentered and the step
+shrinks. Optionally a 2D Gaussian is fitted to every point measured so far,
+which gives a sub-step position with an uncertainty, and the next round
+measures only the points which tell the most about the peak position.
+
+PeakSearch does not talk to the hardware; it gives ScanPlans and takes the
+results, so it runs on top of the usual scanning thread.
+"""
+
+import numpy as np
+
+from scan_plan import ScanPlan
+
+
+def gaussian_2d(x, y, amplitude, x0, y0, x_sigma, y_sigma, background):
+    return background + amplitude * np.exp(-(x - x0)**2 / (2 * x_sigma**2) - (y - y0)**2 / (2 * y_sigma**2))
+
+
+def fit_gaussian_2d(x, y, z, p0, max_iterations=100):
+    """Least-squares fit of gaussian_2d to the points (x, y, z).
+
+    Levenberg-Marquardt with the analytic Jacobian, so that scipy is not
+    needed.
+
+    Parameters
+    ----------
+    x, y, z : np.ndarray
+        the positions and the counts of the points
+    p0 : sequence of 6 numbers
+        initial (amplitude, x0, y0, x_sigma, y_sigma, background)
+
+    Returns
+    -------
+    (np.ndarray, np.ndarray) or None
+        the parameters and their covariance matrix, or None if there are
+        too few points or the fit did not converge
+    """
+    num_params = 6
+    if len(z) <= num_params:
+        return None
+
+    def residual_and_jacobian(p):
+        amplitude, x0, y0, x_sigma, y_sigma, _ = p
+        e = np.exp(-(x - x0)**2 / (2 * x_sigma**2) - (y - y0)**2 / (2 * y_sigma**2))
+        jacobian = np.column_stack([e,
+                                    amplitude * e * (x - x0) / x_sigma**2,
+                                    amplitude * e * (y - y0) / y_sigma**2,
+                                    amplitude * e * (x - x0)**2 / x_sigma**3,
+                                    amplitude * e * (y - y0)**2 / y_sigma**3,
+                                    np.ones_like(x)])
+        return z - gaussian_2d(x, y, *p), jacobian
+
+    p = np.array(p0, dtype=float)
+    residual, jacobian = residual_and_jacobian(p)
+    cost = residual @ residual
+    damping = 1e-3
+    converged = False
+    for _ in range(max_iterations):
+        hessian = jacobian.T @ jacobian
+        try:
+            step = np.linalg.solve(hessian + damping * np.diag(np.diag(hessian) + 1e-12), jacobian.T @ residual)
+        except np.linalg.LinAlgError:
+            return None
+        new_p = p + step
+        new_residual, new_jacobian = residual_and_jacobian(new_p)
+        new_cost = new_residual @ new_residual
+        if new_cost < cost:
+            converged = cost - new_cost <= 1e-10 * cost or np.all(abs(step) <= 1e-8 * (abs(p) + 1e-12))
+            p, residual, jacobian, cost = new_p, new_residual, new_jacobian, new_cost
+            damping /= 10
+            if converged:
+                break
+        else:
+            damping *= 10
+            if damping > 1e10:  # no better point nearby
+                converged = True
+                break
+    if not converged:
+        return None
+
+    try:
+        covariance = np.linalg.inv(jacobian.T @ jacobian) * cost / (len(z) - num_params)
+    except np.linalg.LinAlgError:
+        return None
+    p[3:5] = abs(p[3:5])
+    return p, covariance
+
+
+class PeakSearch:
+    """
+    A coarse-to-fine search for the brightest position.
+
+    Usage: call next_plan(), measure the plan and pass the results to
+    add_results(); repeat until next_plan() returns None. Then
+    (x_center, y_center) is the peak position.
+
+    Attributes
+    ----------
+    x_center, y_center : float
+        the current estimate of the peak position
+    x_step, y_step : float
+        the step of the next round
+    x_uncertainty, y_uncertainty : float
+        the uncertainty of the estimate; from the fit if the latest fit was
+        accepted, otherwise half of the step of the latest round
+    fit : np.ndarray or None
+        (amplitude, x0, y0, x_sigma, y_sigma, background) of the latest
+        accepted Gaussian fit
+    num_rounds : int
+        the number of plans given so far
+    num_points : int
+        the number of points measured so far
+
+    Methods
+    -------
+    add_results : (array-like, array-like, array-like) => ()
+    next_plan   : () => ScanPlan or None
+    """
+
+    def __init__(self, x_center, y_center, x_step, y_step, radius=1, shrink=0.5,
+                 max_rounds=6, uncertainty_threshold=None, fit_gaussian=False,
+                 num_informative_points=None):
+        """
+        Parameters
+        ----------
+        x_center, y_center : float
+            the initial guess
+        x_step, y_step : float
+            the step of the first round
+        radius : int (default 1)
+            each round scans (2 * radius + 1)^2 points around the estimate
+        shrink : float (default 0.5)
+            the step is multiplied by this after a round whose maximum was
+            not on the edge of the patch
+        max_rounds : int (default 6)
+            give up refining after this many rounds
+        uncertainty_threshold : float (optional)
+            stop when both uncertainties are below this; min(x_step, y_step) / 8 if None
+        fit_gaussian : bool (default False)
+            refine the estimate by fitting a 2D Gaussian to all points
+        num_informative_points : int (optional)
+            after a successful fit, measure only this many points of a
+            (2 * radius + 3)^2 patch, chosen by the Fisher information
+            about the peak position; the full patch if None
+        """
+        self.x_center, self.y_center = float(x_center), float(y_center)
+        self.x_step, self.y_step = float(x_step), float(y_step)
+        self.radius = radius
+        self.shrink = shrink
+        self.max_rounds = max_rounds
+        if uncertainty_threshold is None:
+            uncertainty_threshold = min(abs(self.x_step), abs(self.y_step)) / 8
+        self.uncertainty_threshold = uncertainty_threshold
+        self.fit_gaussian = fit_gaussian
+        self.num_informative_points = num_informative_points
+
+        self.x_uncertainty = self.y_uncertainty = np.inf
+        self.fit = None
+        self.num_rounds = 0
+        self.num_points = 0
+        self.__points = np.zeros((0, 3))  # (x_pos, y_pos, count) of every point
+        self.__round_start = 0  # index of the first point of the latest round
+
+    def add_results(self, x_pos, y_pos, counts):
+        """Adds measured points; points with nan counts are ignored.
+        """
+        points = np.column_stack([x_pos, y_pos, counts]).astype(float)
+        points = points[np.isfinite(points[:, 2])]
+        self.__points = np.concatenate([self.__points, points])
+        self.num_points = len(self.__points)
+
+    def next_plan(self):
+        """Updates the estimate with the results so far and returns the plan of the next round.
+
+        Returns
+        -------
+        ScanPlan or None
+            None when the peak is located within uncertainty_threshold or
+            max_rounds plans have been given (also if some rounds gave no
+            valid point)
+        """
+        if len(self.__points) > self.__round_start:
+            self.__update_estimate()
+            if max(self.x_uncertainty, self.y_uncertainty) < self.uncertainty_threshold:
+                return None
+        if self.num_rounds >= self.max_rounds:
+            return None
+
+        if self.fit is not None and self.num_informative_points:
+            plan = self.__patch_plan(self.radius + 1)
+            plan = plan.subset(self.__informative_steps(plan))
+        else:
+            plan = self.__patch_plan(self.radius)
+        self.__round_start = len(self.__points)
+        self.num_rounds += 1
+        return plan
+
+    def __update_estimate(self):
+        latest = self.__points[self.__round_start:]
+        x, y, z = latest[np.argmax(latest[:, 2])]
+        on_edge = ((x == latest[:, 0].min() or x == latest[:, 0].max()) and np.ptp(latest[:, 0]) > 0
+                   or (y == latest[:, 1].min() or y == latest[:, 1].max()) and np.ptp(latest[:, 1]) > 0)
+        self.x_center, self.y_center = x, y
+        self.x_uncertainty, self.y_uncertainty = abs(self.x_step) / 2, abs(self.y_step) / 2
+
+        self.fit = None
+        if self.fit_gaussian:
+            self.__fit(latest)
+
+        if not on_edge:  # the peak is inside the patch; otherwise just recenter and look again
+            self.x_step *= self.shrink
+            self.y_step *= self.shrink
+
+    def __fit(self, latest):
+        x, y, z = self.__points.T
+        p0 = [z.max() - z.min(), self.x_center, self.y_center,
+              2 * abs(self.x_step), 2 * abs(self.y_step), z.min()]
+        result = fit_gaussian_2d(x, y, z, p0)
+        if result is None:
+            return
+        p, covariance = result
+        x_uncertainty, y_uncertainty = np.sqrt(np.diag(covariance)[1:3])
+
+        # accept only a bright spot centered within the latest patch (plus a step)
+        inside = (latest[:, 0].min() - abs(self.x_step) <= p[1] <= latest[:, 0].max() + abs(self.x_step)
+                  and latest[:, 1].min() - abs(self.y_step) <= p[2] <= latest[:, 1].max() + abs(self.y_step))
+        if p[0] > 0 and inside and np.isfinite(x_uncertainty) and np.isfinite(y_uncertainty):
+            self.fit = p
+            self.x_center, self.y_center = p[1], p[2]
+            self.x_uncertainty, self.y_uncertainty = x_uncertainty, y_uncertainty
+
+    def __patch_plan(self, radius):
+        offsets = np.arange(-radius, radius + 1)
+        return ScanPlan(self.x_center + offsets * self.x_step, self.y_center + offsets * self.y_step)
+
+    def __informative_steps(self, plan):
+        # Fisher information about (x0, y0) of each point under Poisson noise, from the fitted model
+        amplitude, x0, y0, x_sigma, y_sigma, background = self.fit
+        e = np.exp(-(plan.x_pos - x0)**2 / (2 * x_sigma**2) - (plan.y_pos - y0)**2 / (2 * y_sigma**2))
+        expected = np.maximum(background + amplitude * e, 1e-9)
+        information = ((amplitude * e * (plan.x_pos - x0) / x_sigma**2)**2
+                       + (amplitude * e * (plan.y_pos - y0) / y_sigma**2)**2) / expected
+
+        center = np.argmin((plan.x_pos - self.x_center)**2 + (plan.y_pos - self.y_center)**2)
+        information[center] = np.inf  # keep measuring the top for the amplitude
+        chosen = np.argsort(information)[::-1][:self.num_informative_points]
+        return np.sort(chosen)  # keep the order of the plan
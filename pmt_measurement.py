@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+A module for the result of a PMT measurement.
+
+A PMTMeasurement holds the statistics of the per-run counts of one
+sequencer run, so that callers don't need to measure again to know how
+noisy a point was. It is shared by PMT_v3 and DUMMY_PMT.
+"""
+
+import numpy as np
+
+
+class PMTMeasurement:
+    """
+    The statistics of the per-run counts of a single measurement.
+
+    Attributes
+    ----------
+    mean, std, sem : float
+        the average, the sample standard deviation and the standard error
+        of the mean of the counts; std and sem are nan for a single run
+    min, max : int
+        the smallest and the largest count
+    num_run : int
+        the number of runs
+    counts : np.ndarray or None
+        the per-run counts if kept; this may be the internal buffer of the
+        PMT (no copy), valid only until the next measurement
+    start_time : float
+        clock.now() of the PMT when the sequencer was started
+    duration : float
+        seconds from the start of the sequencer to the end of reading
+    """
+
+    def __init__(self, counts, start_time, duration, keep_counts=False):
+        """
+        Parameters
+        ----------
+        counts : np.ndarray
+            the per-run counts; must not be empty
+        start_time, duration : float
+            timing of the measurement
+        keep_counts : bool (default False)
+            keep a reference to counts in self.counts
+        """
+        self.num_run = len(counts)
+        self.mean = float(np.mean(counts))
+        if self.num_run > 1:
+            self.std = float(np.std(counts, ddof=1))
+            self.sem = self.std / np.sqrt(self.num_run)
+        else:
+            self.std = self.sem = np.nan
+        self.min = int(np.min(counts))
+        self.max = int(np.max(counts))
+        self.counts = counts if keep_counts else None
+        self.start_time = start_time
+        self.duration = duration
+
+    def __float__(self):
+        return self.mean
+
+    def __repr__(self):
+        return "PMTMeasurement(mean={:.3f}, std={:.3f}, num_run={}, duration={:.4f})".format(
+            self.mean, self.std, self.num_run, self.duration)
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+A module for fixed-capacity sample histories.
+
+A RingBuffer keeps the latest samples of a stream in a preallocated NumPy
+array, so appending never allocates or shifts memory no matter how long
+the stream runs. minmax_decimate reduces a long trace to a few thousand
+points for display while keeping every spike visible, and MinMaxHistory
+does the same incrementally, so each new frame costs only its own samples.
+"""
+
+import numpy as np
+
+
+class RingBuffer:
+    """
+    A fixed-capacity FIFO of numbers; the oldest samples are overwritten.
+
+    Attributes
+    ----------
+    capacity : int
+        the maximum number of samples kept
+    num_appended : int
+        the number of samples appended since the last clear()
+
+    Methods
+    -------
+    append      : number => ()
+    extend      : array-like => ()
+    clear       : () => ()
+    get         : () => np.ndarray
+    get_indices : () => np.ndarray
+    __len__     : () => int
+    """
+
+    def __init__(self, capacity, dtype=float):
+        """
+        Parameters
+        ----------
+        capacity : int
+            the maximum number of samples kept
+        dtype : data-type (default float)
+            the type of the samples
+        """
+        if capacity < 1:
+            raise ValueError("capacity should be positive.")
+        self.capacity = int(capacity)
+        self.__data = np.zeros(self.capacity, dtype=dtype)
+        self.num_appended = 0
+
+    def __len__(self):
+        return min(self.num_appended, self.capacity)
+
+    def append(self, value):
+        self.__data[self.num_appended % self.capacity] = value
+        self.num_appended += 1
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=self.__data.dtype).ravel()
+        if len(values) > self.capacity:  # only the latest ones survive anyway
+            self.num_appended += len(values) - self.capacity
+            values = values[-self.capacity:]
+        start = self.num_appended % self.capacity
+        first = min(len(values), self.capacity - start)
+        self.__data[start:start + first] = values[:first]
+        self.__data[:len(values) - first] = values[first:]
+        self.num_appended += len(values)
+
+    def clear(self):
+        self.num_appended = 0
+
+    def get(self):
+        """Returns a copy of the kept samples from the oldest to the latest.
+        """
+        if self.num_appended <= self.capacity:
+            return self.__data[:self.num_appended].copy()
+        start = self.num_appended % self.capacity
+        return np.concatenate([self.__data[start:], self.__data[:start]])
+
+    def get_indices(self):
+        """Returns the sample numbers (counted from 0) matching get().
+        """
+        return np.arange(self.num_appended - len(self), self.num_appended)
+
+
+def minmax_decimate(x, y, max_points):
+    """Reduces (x, y) to at most max_points points for plotting.
+
+    The trace is split into max_points // 2 bins and each bin is replaced
+    by its minimum and maximum, so the drawn envelope looks the same as the
+    full trace. Traces already short enough are returned as they are.
+
+    Parameters
+    ----------
+    x, y : np.ndarray
+        the trace
+    max_points : int or None
+        the maximum number of points returned; no decimation if None
+
+    Returns
+    -------
+    (np.ndarray, np.ndarray)
+        the decimated trace
+    """
+    if max_points is None or len(y) <= max_points:
+        return x, y
+    bin_size = -(-len(y) // (max_points // 2))  # ceil
+    starts = np.arange(0, len(y), bin_size)
+    y_min = np.minimum.reduceat(y, starts)
+    y_max = np.maximum.reduceat(y, starts)
+    return np.repeat(x[starts], 2), np.column_stack([y_min, y_max]).ravel()
+
+
+class MinMaxHistory:
+    """
+    The min/max decimation of the latest samples of a stream, kept up to date incrementally.
+
+    The samples are binned by their sample number (bin_size samples per
+    bin) and only the minimum and maximum of each bin are kept, so extend()
+    costs only the new samples and get() only the bins. The oldest bin may
+    still include a few samples which have left the history.
+
+    Attributes
+    ----------
+    capacity : int
+        the number of latest samples covered
+    bin_size : int
+        the number of samples per bin
+    num_appended : int
+        the number of samples appended since the last clear()
+
+    Methods
+    -------
+    extend      : array-like => ()
+    clear       : () => ()
+    get         : () => (np.ndarray, np.ndarray)
+    __len__     : () => int
+    """
+
+    def __init__(self, capacity, max_points):
+        """
+        Parameters
+        ----------
+        capacity : int
+            the number of latest samples covered
+        max_points : int
+            the maximum number of points returned by get(); at least 4
+        """
+        if capacity < 1 or max_points < 4:
+            raise ValueError("capacity should be positive and max_points at least 4.")
+        self.capacity = int(capacity)
+        self.bin_size = -(-self.capacity // (max_points // 2 - 1))  # ceil
+        self.__num_bins = -(-self.capacity // self.bin_size) + 1  # a partial bin at each end
+        self.__mins = np.zeros(self.__num_bins)
+        self.__maxs = np.zeros(self.__num_bins)
+        self.num_appended = 0
+        self.__first_sample = None  # the sample number of the first extend() since the last clear()
+
+    def __len__(self):
+        return min(self.num_appended - (self.__first_sample or 0), self.capacity)
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=float).ravel()
+        if len(values) == 0:
+            return
+        start, end = self.num_appended, self.num_appended + len(values)
+        if self.__first_sample is None:
+            self.__first_sample = start
+        first_bin, last_bin = start // self.bin_size, (end - 1) // self.bin_size
+        if last_bin - first_bin >= self.__num_bins:  # only the latest bins survive anyway
+            first_bin = last_bin - self.__num_bins + 1
+            values = values[first_bin * self.bin_size - start:]
+            start = first_bin * self.bin_size
+
+        bins = np.arange(first_bin, last_bin + 1)
+        splits = np.maximum(bins * self.bin_size - start, 0)
+        mins, maxs = np.minimum.reduceat(values, splits), np.maximum.reduceat(values, splits)
+        if start % self.bin_size and start > self.__first_sample:  # the first bin has older samples
+            mins[0] = min(mins[0], self.__mins[first_bin % self.__num_bins])
+            maxs[0] = max(maxs[0], self.__maxs[first_bin % self.__num_bins])
+        self.__mins[bins % self.__num_bins] = mins
+        self.__maxs[bins % self.__num_bins] = maxs
+        self.num_appended = end
+
+    def clear(self):
+        self.num_appended = 0
+        self.__first_sample = None
+
+    def get(self):
+        """Returns the decimated trace (sample numbers, counts) like minmax_decimate().
+        """
+        if len(self) == 0:
+            return np.zeros(0, dtype=int), np.zeros(0)
+        oldest = self.num_appended - len(self)
+        bins = np.arange(oldest // self.bin_size, (self.num_appended - 1) // self.bin_size + 1)
+        x = np.maximum(bins * self.bin_size, oldest)
+        y = np.column_stack([self.__mins[bins % self.__num_bins], self.__maxs[bins % self.__num_bins]])
+        return np.repeat(x, 2), y.ravel()
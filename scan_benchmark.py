@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""
+A benchmark of the scan throughput of ScanningThread.
+
+Runs scan plans over a matrix of grid sizes, step sizes, exposure times and
+orderings, and reports for each case the total scan time, the pixels per
+second, percentiles of the per-pixel latency and how the time splits into
+moving, measuring and the rest (the overhead of the scan loop). The results
+are saved as JSON, and a previous file can be given to print the changes.
+Every case is scanned once to warm up and then several times; the medians
+are reported and compared, and the spread (max - min) is saved with them.
+
+By default the devices are simulated (sim_hardware) on a virtual clock, so
+a run takes only the computing time while the reported times are modeled
+seconds; the real (wall-clock) time of every case is reported as well,
+which shows regressions of the scan loop itself. Examples:
+    python scan_benchmark.py --output before.json
+    python scan_benchmark.py --grid 10 20 --order serpentine hilbert --compare before.json
+    python scan_benchmark.py --real-time                    # simulated, in real time
+    python scan_benchmark.py --devices 27001234 27001235 COM7   # the lab devices
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+PERCENTILES = [50, 90, 99]
+# the numbers whose spread over the repetitions of a case is saved
+SPREAD_KEYS = ['total_time', 'pixels_per_second', 'latency_p50', 'latency_p99', 'real_time']
+# a case is a regression if it is this much worse than in the compared run
+REGRESSION_THRESHOLD = 0.1
+
+
+def pixel_latencies(batch):
+    """Returns the time taken by each pixel from the rows of ScanningThread.plan_result.
+
+    The latency of a pixel is the time since the previous step of the plan
+    was done, so it includes the overhead between the steps; the pixels of
+    a line (same end_time) share the time of the line.
+    """
+    end_times, first, sizes = np.unique(batch[:, 11], return_index=True, return_counts=True)
+    step_times = np.diff(end_times, prepend=end_times[0] - batch[first[0], 9:11].sum())
+    if np.isnan(step_times[0]):  # line mode: no separate move time for the first line
+        step_times[0] = batch[first[0], 10] * sizes[0]
+    return np.repeat(step_times / sizes, sizes)
+
+
+def summarize(batch, total_time, real_time):
+    """Returns the statistics of one scan as a dict of plain numbers.
+    """
+    latencies = pixel_latencies(batch)
+    move_time = float(np.nansum(batch[:, 9]))
+    measure_time = float(np.sum(batch[:, 10]))
+    summary = {'num_pixels': len(batch),
+               'total_time': total_time,
+               'pixels_per_second': len(batch) / total_time if total_time > 0 else np.inf,
+               'move_time': move_time,
+               'measure_time': measure_time,
+               'exposure_time': float(np.sum(batch[:, 8])) / 1000,
+               'other_time': total_time - move_time - measure_time,
+               'real_time': real_time}
+    for p, value in zip(PERCENTILES, np.percentile(latencies, PERCENTILES)):
+        summary['latency_p%d' % p] = float(value)
+    summary['latency_max'] = float(latencies.max())
+    return summary
+
+
+class ScanBenchmark:
+    """
+    Runs scan plans on a ScanningThread and collects the statistics.
+
+    Needs a running QCoreApplication (or QApplication) for the signals of
+    the thread.
+
+    Attributes
+    ----------
+    scanning_thread : ScanningThread
+    clock : RealClock or VirtualClock
+        the clock of the scanning thread
+    world : sim_hardware.SimWorld or None
+        the simulation, if simulated
+    timeout : float
+        real seconds to wait for a single scan
+    repeat : int
+        the number of scans of each case after the warm-up
+    warm_up : bool
+        scan each case once more before the counted scans
+
+    Methods
+    -------
+    run_case    : int, float, float, str [, int, bool] => dict
+    run_matrix  : list, list, list, list [, int, bool] => list of dict
+    close       : () => ()
+    """
+
+    def __init__(self, x_motor_serno='27001', y_motor_serno='27002', fpga_com_port='COM7',
+                 simulate=True, virtual_time=True, seed=0, timeout=600, repeat=5, warm_up=True):
+        """
+        Parameters
+        ----------
+        x_motor_serno, y_motor_serno, fpga_com_port : str
+            the devices; any names if simulated
+        simulate : bool (default True)
+            run on sim_hardware; must be decided before PMT_GUI_JJH is imported
+        virtual_time : bool (default True)
+            run the simulation on a virtual clock
+        seed : int (default 0)
+            of the simulated photon counts
+        timeout : float (default 600)
+        repeat : int (default 5)
+        warm_up : bool (default True)
+        """
+        if simulate:
+            os.environ['PMT_GUI_SIMULATE'] = 'virtual' if virtual_time else '1'
+        import PMT_GUI_JJH
+        self.world = PMT_GUI_JJH.sim_world if PMT_GUI_JJH.SIMULATE else None
+        if self.world is not None:
+            self.world.rng = np.random.default_rng(seed)
+
+        self.timeout = timeout
+        self.repeat = repeat
+        self.warm_up = warm_up
+        self.scanning_thread = PMT_GUI_JJH.ScanningThread(x_motor_serno, y_motor_serno, fpga_com_port)
+        self.clock = self.scanning_thread.clock
+        self.scanning_thread.plan_result.connect(self.__receive_plan_result)
+        self.scanning_thread.running_flag = True
+        self.scanning_thread.start()
+        self.__scan_id = 0
+        self.__batches = []
+        self.__loop = None
+
+    def run_case(self, grid, step, exposure_time, order, num_run=10, line_mode=False):
+        """Scans a grid x grid plan around the current position (the ion if simulated) repeat times.
+
+        Parameters
+        ----------
+        grid : int
+            the number of pixels along each axis
+        step : float
+            in mm
+        exposure_time : float
+            of each window in ms
+        order : str
+            a key of scan_plan.ORDERINGS
+        num_run : int (default 10)
+        line_mode : bool (default False)
+
+        Returns
+        -------
+        dict
+            the parameters of the case, the medians of the results of
+            summarize() over the repetitions, 'repeat', 'spread', {key: max -
+            min} of the SPREAD_KEYS, and 'phases', the SpanRecorder.stats()
+            of the last scan; or the parameters and 'timeout' if a scan
+            timed out
+        """
+        case = {'grid': grid, 'step': step, 'exposure_time_in_ms': exposure_time, 'order': order,
+                'num_run': num_run, 'line_mode': line_mode}
+        summaries = []
+        for _ in range(self.repeat + bool(self.warm_up)):
+            summary = self.__run_scan(grid, step, exposure_time, order, num_run, line_mode)
+            if summary is None:
+                print("timeout:", case)
+                return dict(case, timeout=True)
+            summaries.append(summary)
+        if self.warm_up:
+            summaries = summaries[1:]
+
+        result = dict(case, repeat=len(summaries))
+        for key in summaries[0]:
+            if key != 'phases':
+                result[key] = float(np.median([summary[key] for summary in summaries]))
+        result['spread'] = {key: float(np.ptp([summary[key] for summary in summaries])) for key in SPREAD_KEYS}
+        result['phases'] = summaries[-1]['phases']
+        return result
+
+    def __run_scan(self, grid, step, exposure_time, order, num_run, line_mode):
+        # the results of summarize() and the phases of a single scan, or None on timeout
+        from PyQt5.QtCore import QEventLoop, QTimer
+        from scan_plan import ScanPlan
+        from spans import get_recorder
+
+        if self.world is not None:
+            x_center, y_center = self.world.ion_x, self.world.ion_y
+        else:
+            x_center, y_center = self.scanning_thread.x_motor.get_position(), self.scanning_thread.y_motor.get_position()
+        offsets = (np.arange(grid) - (grid - 1) / 2) * step
+        plan = ScanPlan(x_center + offsets, y_center + offsets, order)
+
+        # start every case from the same corner so that the first move is comparable
+        held = self.clock.enter()  # a virtual time waits until the scanning thread has the plan
+        self.scanning_thread.x_pos, self.scanning_thread.y_pos = plan.x_pos_list[0], plan.y_pos_list[0]
+        self.scanning_thread.move_to_requested_position()
+        self.scanning_thread.set_exposure_time(exposure_time, num_run)
+
+        self.__scan_id += 1
+        self.__batches = []
+        get_recorder().clear()
+        self.__loop = QEventLoop()
+        QTimer.singleShot(int(self.timeout * 1000), self.__loop.quit)
+        start_time, real_start_time = self.clock.now(), time.perf_counter()
+        self.scanning_thread.register_plan(self.__scan_id, plan, exposure_time, line_mode)
+        if not held:
+            self.clock.leave()
+        self.__loop.exec_()
+        real_time = time.perf_counter() - real_start_time
+
+        if sum(map(len, self.__batches)) < len(plan):
+            self.scanning_thread.abort_plan()
+            return None
+        batch = np.concatenate(self.__batches)
+        total_time = batch[:, 11].max() - start_time  # the end of the last pixel, not of the event loop
+        return dict(summarize(batch, float(total_time), real_time), phases=get_recorder().stats())
+
+    def run_matrix(self, grids, steps, exposure_times, orders, num_run=10, line_mode=False):
+        results = []
+        for grid, step, exposure_time, order in itertools.product(grids, steps, exposure_times, orders):
+            result = self.run_case(grid, step, exposure_time, order, num_run, line_mode)
+            print(format_result(result))
+            results.append(result)
+        return results
+
+    def close(self):
+        self.scanning_thread.running_flag = False
+        self.scanning_thread.abort_plan()  # wakes the thread up
+        self.scanning_thread.wait()
+        self.scanning_thread.clean_up_devices()
+
+    def __receive_plan_result(self, scan_id, batch, finished):
+        if scan_id != self.__scan_id:
+            return
+        self.__batches.append(batch)
+        if finished:
+            self.__loop.quit()
+
+
+def case_key(result):
+    return (result['grid'], result['step'], result['exposure_time_in_ms'], result['order'],
+            result['num_run'], result['line_mode'])
+
+
+def format_result(result):
+    name = "%3dx%-3d step %.4f mm, %g ms x %d, %-10s%s" % (
+        result['grid'], result['grid'], result['step'], result['exposure_time_in_ms'], result['num_run'],
+        result['order'], " (line)" if result['line_mode'] else "")
+    if result.get('timeout'):
+        return name + ": timeout"
+    return (name + ": %7.3f s, %7.1f px/s, latency p50 %.1f / p90 %.1f / p99 %.1f ms, "
+            "move %.0f%% measure %.0f%% other %.0f%%, real %.2f s (spread %.2f s)" % (
+                result['total_time'], result['pixels_per_second'],
+                result['latency_p50'] * 1e3, result['latency_p90'] * 1e3, result['latency_p99'] * 1e3,
+                100 * result['move_time'] / result['total_time'], 100 * result['measure_time'] / result['total_time'],
+                100 * result['other_time'] / result['total_time'], result['real_time'],
+                result.get('spread', {}).get('real_time', np.nan)))
+
+
+def compare(results, previous_results, threshold=REGRESSION_THRESHOLD):
+    """Prints the changes from previous_results and returns the number of regressions.
+
+    Compares the medians of the cases; the real time must also grow by more
+    than its spread in both results (0.1 s for results without a spread).
+    """
+    previous = {case_key(result): result for result in previous_results if not result.get('timeout')}
+    num_regressions = 0
+    for result in results:
+        old = previous.get(case_key(result))
+        if old is None or result.get('timeout'):
+            continue
+        changes = {'pixels_per_second': result['pixels_per_second'] / old['pixels_per_second'] - 1,
+                   'latency_p99': result['latency_p99'] / old['latency_p99'] - 1,
+                   'real_time': result['real_time'] / old['real_time'] - 1}
+        # the real time of short cases is noisy, so it must also grow by more than the spread
+        noise = max(run.get('spread', {}).get('real_time', 0.1) for run in (result, old))
+        regressed = (changes['pixels_per_second'] < -threshold or changes['latency_p99'] > threshold
+                     or changes['real_time'] > threshold and result['real_time'] - old['real_time'] > noise)
+        num_regressions += regressed
+        print("%s %s: px/s %+.1f%%, p99 latency %+.1f%%, real time %+.1f%%" % (
+            "REGRESSION" if regressed else "          ", format_result(result).split(':')[0],
+            100 * changes['pixels_per_second'], 100 * changes['latency_p99'], 100 * changes['real_time']))
+    return num_regressions
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--grid', type=int, nargs='+', default=[5, 10])
+    parser.add_argument('--step', type=float, nargs='+', default=[0.002, 0.01], help='in mm')
+    parser.add_argument('--exposure', type=float, nargs='+', default=[1], help='of each window in ms')
+    parser.add_argument('--order', nargs='+', default=['serpentine', 'raster', 'hilbert'])
+    parser.add_argument('--num-run', type=int, default=10)
+    parser.add_argument('--line-mode', action='store_true')
+    parser.add_argument('--real-time', action='store_true', help='simulate without the virtual clock')
+    parser.add_argument('--devices', nargs=3, metavar=('X_SERNO', 'Y_SERNO', 'COM_PORT'),
+                        help='use the devices instead of the simulation')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5, help='scans of each case after the warm-up')
+    parser.add_argument('--no-warm-up', action='store_true')
+    parser.add_argument('--output', default='scan_benchmark_%s.json' % time.strftime('%Y%m%d_%H%M%S'))
+    parser.add_argument('--compare', help='a previous output to compare with')
+    args = parser.parse_args(argv)
+
+    from PyQt5.QtCore import QCoreApplication
+    app = QCoreApplication.instance() or QCoreApplication(sys.argv[:1])
+    if args.devices:
+        benchmark = ScanBenchmark(*args.devices, simulate=False, repeat=args.repeat, warm_up=not args.no_warm_up)
+    else:
+        benchmark = ScanBenchmark(simulate=True, virtual_time=not args.real_time, seed=args.seed,
+                                  repeat=args.repeat, warm_up=not args.no_warm_up)
+    try:
+        results = benchmark.run_matrix(args.grid, args.step, args.exposure, args.order,
+                                       args.num_run, args.line_mode)
+    finally:
+        benchmark.close()
+
+    with open(args.output, 'w') as f:
+        json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'revision': git_revision(),
+                   'platform': platform.platform(),
+                   'python': platform.python_version(),
+                   'devices': args.devices or ('simulated, real time' if args.real_time else 'simulated, virtual time'),
+                   'results': results}, f, indent=1)
+    print("saved", args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous_results = json.load(f)['results']
+        return 1 if compare(results, previous_results) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+A module for precomputed scan trajectories.
+
+A ScanPlan holds the visiting order of every pixel of a scan as preallocated
+index and position arrays. The order is given by an ordering function,
+which takes the X and Y position lists and returns the (x_index, y_index)
+arrays of the visiting order.
+"""
+
+import copy
+
+import numpy as np
+
+
+def raster_order(x_pos_list, y_pos_list):
+    """Row by row, always from the first X to the last X.
+    """
+    y_index, x_index = np.divmod(np.arange(len(x_pos_list) * len(y_pos_list)), len(x_pos_list))
+    return x_index, y_index
+
+
+def serpentine_order(x_pos_list, y_pos_list):
+    """Row by row, reversing the X direction at every row (zigzag).
+
+    This is the order PMT_GUI has been using to reduce backlash.
+    """
+    x_index, y_index = raster_order(x_pos_list, y_pos_list)
+    odd_row = y_index % 2 == 1
+    x_index[odd_row] = len(x_pos_list) - 1 - x_index[odd_row]
+    return x_index, y_index
+
+
+def spiral_order(x_pos_list, y_pos_list):
+    """Square spiral going out from the center pixel.
+
+    Good for searching a spot which is expected near the center, since
+    the center is visited first. Pixels outside the grid are skipped.
+    """
+    x_num, y_num = len(x_pos_list), len(y_pos_list)
+    x, y = (x_num - 1) // 2, (y_num - 1) // 2
+    x_index, y_index = [], []
+    directions = [(1, 0), (0, 1), (-1, 0), (0, -1)]
+    leg_length, turn = 1, 0
+    while len(x_index) < x_num * y_num:
+        for _ in range(2):  # two legs with the same length
+            dx, dy = directions[turn % 4]
+            for _ in range(leg_length):
+                if 0 <= x < x_num and 0 <= y < y_num:
+                    x_index.append(x)
+                    y_index.append(y)
+                x, y = x + dx, y + dy
+            turn += 1
+        leg_length += 1
+    return np.array(x_index[:x_num * y_num]), np.array(y_index[:x_num * y_num])
+
+
+def hilbert_order(x_pos_list, y_pos_list):
+    """Hilbert curve over the smallest power-of-two square covering the grid.
+
+    Every step is to a neighboring pixel except where the curve leaves the
+    grid, and nearby pixels are visited close in time.
+    """
+    x_num, y_num = len(x_pos_list), len(y_pos_list)
+    side = 1
+    while side < max(x_num, y_num):
+        side *= 2
+
+    # convert the distances along the curve to coordinates (vectorized d2xy)
+    d = np.arange(side * side)
+    x, y = np.zeros_like(d), np.zeros_like(d)
+    s = 1
+    while s < side:
+        rx = (d // 2) % 2
+        ry = (d ^ rx) % 2
+        flip = (ry == 0) & (rx == 1)
+        x = np.where(flip, s - 1 - x, x)
+        y = np.where(flip, s - 1 - y, y)
+        swap = ry == 0
+        x, y = np.where(swap, y, x), np.where(swap, x, y)
+        x, y = x + s * rx, y + s * ry
+        d = d // 4
+        s *= 2
+
+    inside = (x < x_num) & (y < y_num)
+    return x[inside], y[inside]
+
+
+def travel_distance(x_pos, y_pos):
+    """Returns the total of max(|dx|, |dy|) over the steps between the points in that order.
+
+    That is the time the X and Y motors moving at the same time take at a
+    constant speed, up to the speed.
+    """
+    return float(np.sum(np.maximum(abs(np.diff(x_pos)), abs(np.diff(y_pos)))))
+
+
+def min_travel_order(x_pos_list, y_pos_list, max_2opt_points=2500, max_2opt_passes=20):
+    """Short tour starting from the first pixel, never longer than the serpentine order.
+
+    The distance is max(|dx|, |dy|) in position units, since the X and Y
+    motors move at the same time. The shorter of the serpentine order and
+    a greedy nearest-neighbor tour is improved by 2-opt moves (reversing a
+    part of the tour), which helps on non-uniform step sizes and when the
+    Y step is smaller than the X step. 2-opt is skipped on
+    grids of more than max_2opt_points pixels, since each pass takes
+    quadratic time.
+    """
+    x_pos_list, y_pos_list = np.asarray(x_pos_list), np.asarray(y_pos_list)
+    x_index, y_index = raster_order(x_pos_list, y_pos_list)
+    x_pos, y_pos = x_pos_list[x_index], y_pos_list[y_index]
+
+    visited = np.zeros(len(x_index), dtype=bool)
+    order = np.empty(len(x_index), dtype=int)
+    current = 0
+    for n in range(len(order)):
+        order[n] = current
+        visited[current] = True
+        if n == len(order) - 1:
+            break
+        dx, dy = abs(x_pos - x_pos[current]), abs(y_pos - y_pos[current])
+        distance = np.maximum(dx, dy)
+        distance[visited] = np.inf
+        # break ties by the Euclidean distance to prefer straight steps
+        nearest = np.flatnonzero(distance == distance.min())
+        current = nearest[np.argmin(dx[nearest]**2 + dy[nearest]**2)]
+
+    serpentine_x_index, serpentine_y_index = serpentine_order(x_pos_list, y_pos_list)
+    serpentine = serpentine_y_index * len(x_pos_list) + serpentine_x_index  # in the raster numbering
+    if travel_distance(x_pos[serpentine], y_pos[serpentine]) <= travel_distance(x_pos[order], y_pos[order]):
+        order = serpentine
+    if len(order) <= max_2opt_points:
+        order = _improve_by_2opt(x_pos, y_pos, order, max_2opt_passes)
+    return x_index[order], y_index[order]
+
+
+def _improve_by_2opt(x_pos, y_pos, order, max_passes):
+    # reverses order[i:j + 1] while that shortens the open tour; order[0] stays the start
+    order = order.copy()
+    n = len(order)
+    for _ in range(max_passes):
+        improved = False
+        for i in range(1, n - 1):
+            x, y = x_pos[order], y_pos[order]
+            j = np.arange(i + 1, n)
+            before = (np.maximum(abs(x[i - 1] - x[i]), abs(y[i - 1] - y[i]))
+                      + np.maximum(abs(x[j] - x[np.minimum(j + 1, n - 1)]), abs(y[j] - y[np.minimum(j + 1, n - 1)])) * (j < n - 1))
+            after = (np.maximum(abs(x[i - 1] - x[j]), abs(y[i - 1] - y[j]))
+                     + np.maximum(abs(x[i] - x[np.minimum(j + 1, n - 1)]), abs(y[i] - y[np.minimum(j + 1, n - 1)])) * (j < n - 1))
+            gain = before - after
+            best = np.argmax(gain)
+            if gain[best] > 1e-12 * (1 + before[best]):  # not just the rounding
+                order[i:j[best] + 1] = order[i:j[best] + 1][::-1].copy()
+                improved = True
+        if not improved:
+            break
+    return order
+
+
+ORDERINGS = {'raster': raster_order,
+             'serpentine': serpentine_order,
+             'spiral': spiral_order,
+             'hilbert': hilbert_order,
+             'min_travel': min_travel_order}
+
+
+class ScanPlan:
+    """
+    A precomputed scan trajectory over a grid of X and Y positions.
+
+    Attributes
+    ----------
+    x_pos_list, y_pos_list : np.ndarray
+        the positions of the grid
+    order : str or callable
+        the ordering which made this plan
+    x_index, y_index : np.ndarray of int
+        the grid indices of the n-th point to visit
+    x_pos, y_pos : np.ndarray of float
+        the positions of the n-th point to visit
+
+    Methods
+    -------
+    __len__         : () => int
+    __getitem__     : int => (int, int, float, float)
+    travel_length   : [number, number] => float
+    subset          : array-like => ScanPlan
+    """
+
+    def __init__(self, x_pos_list, y_pos_list, order='serpentine'):
+        """
+        Parameters
+        ----------
+        x_pos_list, y_pos_list : array-like
+            the positions of the grid
+        order : str or callable (default 'serpentine')
+            a key of ORDERINGS, or a function which takes the X and Y
+            position lists and returns (x_index, y_index) arrays visiting
+            every pixel exactly once
+        """
+        self.x_pos_list = np.asarray(x_pos_list, dtype=float)
+        self.y_pos_list = np.asarray(y_pos_list, dtype=float)
+        self.order = order
+
+        ordering = ORDERINGS[order] if isinstance(order, str) else order
+        x_index, y_index = ordering(self.x_pos_list, self.y_pos_list)
+        self.x_index = np.asarray(x_index, dtype=int)
+        self.y_index = np.asarray(y_index, dtype=int)
+        if len(self.x_index) != len(self.x_pos_list) * len(self.y_pos_list):
+            raise ValueError("ordering '{}' does not visit every pixel once.".format(order))
+
+        self.x_pos = self.x_pos_list[self.x_index]
+        self.y_pos = self.y_pos_list[self.y_index]
+
+    def __len__(self):
+        return len(self.x_index)
+
+    def __getitem__(self, n):
+        """Returns (x_index, y_index, x_pos, y_pos) of the n-th point.
+        """
+        return (int(self.x_index[n]), int(self.y_index[n]),
+                float(self.x_pos[n]), float(self.y_pos[n]))
+
+    def travel_length(self, x_start=None, y_start=None):
+        """Returns the total motor travel of the plan.
+
+        Each step costs max(|dx|, |dy|) since both axes move at the same time.
+
+        Parameters
+        ----------
+        x_start, y_start : number (optional)
+            the position before the first point; not counted if None
+        """
+        x_pos, y_pos = self.x_pos, self.y_pos
+        if x_start is not None and y_start is not None:
+            x_pos = np.concatenate([[x_start], x_pos])
+            y_pos = np.concatenate([[y_start], y_pos])
+        return float(np.sum(np.maximum(abs(np.diff(x_pos)), abs(np.diff(y_pos)))))
+
+    def subset(self, steps):
+        """Returns a plan visiting only the given steps of this plan.
+
+        The grid (x_pos_list, y_pos_list) stays the same, so the plan no
+        longer covers every pixel; used to measure only selected points.
+
+        Parameters
+        ----------
+        steps : array-like of int or bool
+            the steps to keep, in the order to visit them
+        """
+        plan = copy.copy(self)
+        plan.x_index, plan.y_index = self.x_index[steps], self.y_index[steps]
+        plan.x_pos, plan.y_pos = self.x_pos[steps], self.y_pos[steps]
+        return plan
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+A module for saving scan results without blocking the acquisition.
+
+ScanWriter owns a background thread fed through a queue holding a bounded
+number of batches. Each scan is stored as a memory-mapped .npy array of
+shape (x_num, y_num, fields), filled with nan until measured (a failed
+pixel has its positions and dwell_time but nan statistics), plus a JSON
+sidecar holding the scan metadata and the progress. The array is flushed and the sidecar is
+rewritten atomically every flush_interval seconds, so a crash loses at
+most that much data and the files on disk are always consistent.
+
+Reading a scan back:
+    data = np.load(base + '.npy')                   # data[x_index, y_index, field]
+    meta = json.load(open(base + '.json'))          # meta['fields'] names the last axis
+"""
+
+import json
+import os
+import queue
+import time
+from threading import BoundedSemaphore, Thread
+
+import numpy as np
+
+from spans import get_recorder
+
+FIELDS = ['x_pos', 'y_pos', 'mean', 'std', 'min', 'max', 'dwell_time']
+
+
+class ScanWriter:
+    """
+    Writes scan results to .npy/.json pairs in a background thread.
+
+    begin_scan(), write() and end_scan() only enqueue and never wait for
+    the disk. If max_queue_size batches are pending, further batches are
+    dropped and counted in num_dropped rather than blocking the caller;
+    begin_scan() and end_scan() are never dropped.
+
+    Attributes
+    ----------
+    num_dropped : int
+        the number of batches dropped because the queue was full
+    last_error : Exception or None
+        the latest error of the writer thread
+
+    Methods
+    -------
+    start       : () => ()
+    stop        : [float] => ()
+    begin_scan  : str, int, array-like, array-like, dict => ()
+    write       : int, np.ndarray => ()
+    end_scan    : int, [bool] => ()
+    """
+
+    def __init__(self, max_queue_size=1000, flush_interval=1.0, recorder=None):
+        """
+        Parameters
+        ----------
+        max_queue_size : int (default 1000)
+            the number of pending batches of write() the queue holds
+        flush_interval : float (default 1.0)
+            the time between two checkpoints in seconds
+        recorder : SpanRecorder (optional)
+            times the writes and the checkpoints; get_recorder() if None
+        """
+        self.flush_interval = flush_interval
+        self.recorder = get_recorder() if recorder is None else recorder
+        self.num_dropped = 0
+        self.last_error = None
+        self.__queue = queue.Queue()  # unbounded; the batches are limited by __batch_slots
+        self.__batch_slots = BoundedSemaphore(max_queue_size)
+        self.__scans = {}  # scan_id => dict of the open scan
+        self.__thread = None
+
+    def start(self):
+        if self.__thread is None:
+            self.__thread = Thread(target=self.__run, daemon=True)
+            self.__thread.start()
+
+    def stop(self, timeout=5):
+        """Writes everything queued, closes the open scans and stops the thread.
+        """
+        if self.__thread is not None:
+            self.__queue.put(('stop',))
+            self.__thread.join(timeout)
+            self.__thread = None
+
+    def begin_scan(self, base_path, scan_id, x_pos_list, y_pos_list, metadata=None):
+        """Creates base_path + '.npy' and '.json' for a new scan.
+
+        Parameters
+        ----------
+        base_path : str
+            the path without the extension
+        scan_id : int
+            the ID used by write() and end_scan()
+        x_pos_list, y_pos_list : array-like
+            the grid of the scan
+        metadata : dict (optional)
+            JSON-serializable information saved in the sidecar
+        """
+        self.__queue.put(('begin', base_path, scan_id, np.array(x_pos_list, dtype=float),
+                          np.array(y_pos_list, dtype=float), dict(metadata or {})))
+
+    def write(self, scan_id, batch):
+        """Queues rows of (x_index, y_index, x_pos, y_pos, mean, std, min, max, dwell_time, ...).
+
+        Columns after dwell_time (e.g. the timing of the scanning thread) are not saved.
+        """
+        if not self.__batch_slots.acquire(blocking=False):
+            self.num_dropped += 1
+            print("WARNING: scan writer queue is full; dropped a batch of scan", scan_id)
+            return
+        self.__queue.put(('write', scan_id, np.array(batch, dtype=float)))
+
+    def end_scan(self, scan_id, complete=True):
+        """Closes the files of the scan, recording whether it was completed.
+
+        Does nothing if the scan is not open (e.g. already ended).
+        """
+        self.__queue.put(('end', scan_id, complete))
+
+    def __run(self):
+        last_flush_time = time.monotonic()
+        while True:
+            try:
+                message = self.__queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                message = None
+
+            if message is not None and message[0] == 'stop':
+                for scan_id in list(self.__scans):
+                    self.__handle(self.__end, scan_id, complete=False)
+                return
+            if message is not None and message[0] == 'write':
+                self.__batch_slots.release()
+            if message is not None:
+                handler = {'begin': self.__begin, 'write': self.__write, 'end': self.__end}[message[0]]
+                with self.recorder.span('writer.' + message[0]):
+                    self.__handle(handler, *message[1:])
+
+            if time.monotonic() - last_flush_time >= self.flush_interval:
+                for scan_id in list(self.__scans):
+                    with self.recorder.span('writer.checkpoint'):
+                        self.__handle(self.__checkpoint, scan_id)
+                last_flush_time = time.monotonic()
+
+    def __handle(self, handler, *args, **kwargs):
+        try:
+            handler(*args, **kwargs)
+        except Exception as e:  # keep the thread alive for the other scans
+            self.last_error = e
+            print("WARNING: scan writer failed:", e)
+
+    def __begin(self, base_path, scan_id, x_pos_list, y_pos_list, metadata):
+        directory = os.path.dirname(base_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        data = np.lib.format.open_memmap(base_path + '.npy', mode='w+', dtype=np.float64,
+                                         shape=(len(x_pos_list), len(y_pos_list), len(FIELDS)))
+        data[:] = np.nan
+        metadata.update({'scan_id': scan_id,
+                         'fields': FIELDS,
+                         'x_pos_list': x_pos_list.tolist(),
+                         'y_pos_list': y_pos_list.tolist(),
+                         'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                         'num_points_done': 0,
+                         'complete': False})
+        self.__scans[scan_id] = {'base_path': base_path, 'data': data, 'metadata': metadata, 'dirty': True}
+        self.__checkpoint(scan_id)
+
+    def __write(self, scan_id, batch):
+        scan = self.__scans.get(scan_id)
+        if scan is None:
+            return  # not begun (e.g. the begin failed) or already ended
+        x_index, y_index = batch[:, 0].astype(int), batch[:, 1].astype(int)
+        scan['data'][x_index, y_index] = batch[:, 2:2 + len(FIELDS)]
+        scan['metadata']['num_points_done'] += len(batch)
+        scan['dirty'] = True
+
+    def __end(self, scan_id, complete=True):
+        scan = self.__scans.get(scan_id)
+        if scan is None:
+            return
+        scan['metadata']['complete'] = complete
+        scan['dirty'] = True
+        self.__checkpoint(scan_id)
+        del self.__scans[scan_id]
+
+    def __checkpoint(self, scan_id):
+        # flush the data first, so that the sidecar never claims more than what is on the disk
+        scan = self.__scans[scan_id]
+        if not scan['dirty']:
+            return
+        scan['data'].flush()
+        scan['metadata']['updated'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        sidecar_path = scan['base_path'] + '.json'
+        with open(sidecar_path + '.tmp', 'w') as f:
+            json.dump(scan['metadata'], f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(sidecar_path + '.tmp', sidecar_path)
+        scan['dirty'] = False
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end checks of the acquisition threads on the simulated hardware.
+
+Each check drives the code of PMT_GUI_JJH against sim_hardware (PMT_v3 on
+a simulated sequencer, KDC101 on a simulated Kinesis library) and raises
+AssertionError if the result is wrong. They run on a virtual clock by
+default, so the whole set takes only a few seconds. Examples:
+    python sim_checks.py
+    python sim_checks.py --real-time
+"""
+
+import argparse
+import os
+import sys
+import threading
+
+import numpy as np
+
+
+def check_continuous_stream(duration=0.5, exposure_time=1, num_run=10):
+    """Runs MyPMTThread in continuous mode on PMT_v3 for duration seconds.
+
+    PMT_stream() selects the free-running program while streaming, so the
+    averaging must not depend on the num_run of the PMT during the stream.
+
+    Returns
+    -------
+    int
+        the number of samples received
+    """
+    import PMT_GUI_JJH
+
+    pmt = PMT_GUI_JJH.PMT(port='COM7')
+    pmt.open()
+    try:
+        pmt.setup_PMT_sp(N_1us=round(exposure_time // 0.001), num_run=num_run)
+        pmt_thread = PMT_GUI_JJH.MyPMTThread(pmt)
+        pmt_thread.continuous = True
+        pmt_thread.run_flag = True
+        frames = []
+
+        def receive(samples):
+            frames.append(samples)
+            pmt_thread.frame_done()
+
+        def stop():
+            pmt.clock.sleep(duration)
+            pmt_thread.run_flag = False
+
+        pmt_thread.pmt_result.connect(receive)  # direct: run() is called on this thread
+        stopper = threading.Thread(target=stop, daemon=True)
+        stopper.start()
+        pmt_thread.run()
+        stopper.join()
+    finally:
+        pmt.close()
+
+    samples = np.concatenate(frames) if frames else np.zeros(0)
+    expected = duration / (exposure_time * 1e-3 * num_run)
+    assert 0.5 * expected <= len(samples) <= 1.5 * expected, "%d samples, expected about %d" % (len(samples), expected)
+    assert np.all(np.isfinite(samples)), "non-finite samples"
+    assert pmt.num_run == num_run, "num_run is %r after streaming" % pmt.num_run
+    return len(samples)
+
+
+def check_scan_reproducible(grid=5, step=0.002, exposure_time=1, order='serpentine'):
+    """Runs the same scan twice with scan_benchmark and compares the modeled times.
+
+    Each run is a new process, so that both start from the same state of the
+    simulation. On the virtual clock, the times must not depend on how fast
+    the host runs the threads, so both runs must give the same times.
+
+    Returns
+    -------
+    float
+        the modeled time of the scan in seconds
+    """
+    import json
+    import subprocess
+    import tempfile
+
+    real_time = os.environ.get('PMT_GUI_SIMULATE') != 'virtual'
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for run in range(2):
+            output = os.path.join(directory, 'run%d.json' % run)
+            args = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scan_benchmark.py'),
+                    '--grid', str(grid), '--step', str(step), '--exposure', str(exposure_time),
+                    '--order', order, '--repeat', '1', '--output', output] + (['--real-time'] if real_time else [])
+            subprocess.run(args, check=True, stdout=subprocess.DEVNULL)
+            with open(output) as f:
+                results.append(json.load(f)['results'][0])
+
+    for result in results:
+        assert not result.get('timeout'), "timeout"
+    if real_time:  # the real time is never the same
+        return results[1]['total_time']
+    keys = ['total_time', 'move_time', 'measure_time', 'latency_max'] + ['latency_p%d' % p for p in (50, 90, 99)]
+    for key in keys:
+        # the scans start at different times after the bring-up, so only the rounding may differ
+        assert abs(results[0][key] - results[1][key]) < 1e-9, "%s is %r, then %r" % (key, results[0][key], results[1][key])
+    return results[1]['total_time']
+
+
+CHECKS = {'continuous_stream': check_continuous_stream,
+          'scan_reproducible': check_scan_reproducible}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('checks', nargs='*', default=list(CHECKS), help='some of %s' % ', '.join(CHECKS))
+    parser.add_argument('--real-time', action='store_true', help='simulate without the virtual clock')
+    args = parser.parse_args(argv)
+
+    # must be decided before PMT_GUI_JJH is imported
+    os.environ['PMT_GUI_SIMULATE'] = '1' if args.real_time else 'virtual'
+    from PyQt5.QtCore import QCoreApplication
+    app = QCoreApplication.instance() or QCoreApplication(sys.argv[:1])
+
+    num_failures = 0
+    for name in args.checks:
+        try:
+            result = CHECKS[name]()
+        except Exception as e:
+            num_failures += 1
+            print("FAILED %s: %s: %s" % (name, type(e).__name__, e))
+        else:
+            print("ok     %s: %s" % (name, result))
+    return 1 if num_failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,574 @@
+# -*- coding: utf-8 -*-
+"""
+A simulated lab for running PMT_v3, KDC101 and PMT_GUI without the hardware.
+
+The simulation sits at the lowest level, so the real drivers run unchanged:
+    - SimSequencerProgram and SimArtyS7 replace the sequencer library. The
+      program is executed clock by clock (10 ns) as the host reads, with
+      the FIFO, the running status and the PMT counter, and the timing
+      follows N_1us, T_1us and num_run like on the FPGA.
+    - SimKinesisLib replaces the Kinesis DLL under KDC101. The stages move
+      with trapezoidal velocity profiles, have backlash, report positions
+      only at the polling interval and post messages to per-device queues.
+    - SimWorld holds the stages and an ion: a Gaussian spot whose photon
+      counts are Poisson distributed, integrated along the stage motion.
+
+Usage (before importing PMT_v3 or PMT_GUI_JJH):
+    import sim_hardware
+    world = sim_hardware.install(ion_x=3.0, ion_y=4.0)
+or run the GUI with the environment variable PMT_GUI_SIMULATE=1.
+
+With install(virtual_time=True), everything runs on a clocks.VirtualClock:
+a scan takes only the computing time, while all the reported timings stay
+in modeled seconds. Use PMT_GUI_SIMULATE=virtual for the GUI.
+"""
+
+import math
+import sys
+import threading
+import types
+from collections import deque
+
+import numpy as np
+
+import clocks
+
+CLOCK_PERIOD = 1e-8  # the sequencer runs at 100 MHz
+
+# KDC101 conversions (see KDC101.KDC101)
+DEVUNIT_RATIO = 34304
+VEL_DEVUNIT_RATIO = 772981.3692
+ACC_DEVUNIT_RATIO = 263.8443072
+
+
+class SimWorld:
+    """
+    The simulated stages and ion.
+
+    The first stage opened is X and the second one is Y, like in
+    PMT_GUI; assign_axes() overrides this.
+
+    Attributes
+    ----------
+    ion_x, ion_y : float
+        the position of the ion in mm
+    spot_sigma : float
+        the standard deviation of the Gaussian spot in mm
+    peak_rate, background_rate : float
+        counts per second at the center of the spot and far from it
+    clock : RealClock or VirtualClock
+        the time of the simulation
+
+    Methods
+    -------
+    assign_axes     : str, str => ()
+    get_stage       : str => SimStage
+    count_rate      : float, float => float
+    draw_counts     : float, float => int
+    """
+
+    def __init__(self, ion_x=0.0, ion_y=0.0, spot_sigma=0.005, peak_rate=2e5,
+                 background_rate=2e3, seed=None, clock=None):
+        self.ion_x, self.ion_y = ion_x, ion_y
+        self.spot_sigma = spot_sigma
+        self.peak_rate = peak_rate
+        self.background_rate = background_rate
+        self.clock = clocks.get_clock() if clock is None else clock
+        self.rng = np.random.default_rng(seed)
+        self.stages = {}  # serial number => SimStage
+        self.x_serial = self.y_serial = None
+        self.__lock = threading.Lock()
+
+    def assign_axes(self, x_serial, y_serial):
+        self.x_serial, self.y_serial = x_serial, y_serial
+
+    def get_stage(self, serial):
+        """Returns the stage of the serial number, creating it if needed.
+        """
+        with self.__lock:
+            if serial not in self.stages:
+                self.stages[serial] = SimStage(self, serial)
+                if self.x_serial is None:
+                    self.x_serial = serial
+                elif self.y_serial is None and serial != self.x_serial:
+                    self.y_serial = serial
+            return self.stages[serial]
+
+    def count_rate(self, x, y):
+        r2 = (x - self.ion_x)**2 + (y - self.ion_y)**2
+        return self.background_rate + self.peak_rate * math.exp(-r2 / (2 * self.spot_sigma**2))
+
+    def draw_counts(self, start_time, end_time):
+        """Draws the counts of a window, following the stages during the window.
+        """
+        duration = end_time - start_time
+        if duration <= 0:
+            return 0
+        num_samples = 4
+        expected = 0
+        for n in range(num_samples):
+            t = start_time + (n + 0.5) * duration / num_samples
+            expected += self.count_rate(self.__true_position(self.x_serial, t),
+                                        self.__true_position(self.y_serial, t))
+        return int(self.rng.poisson(expected * duration / num_samples))
+
+    def __true_position(self, serial, t):
+        stage = self.stages.get(serial)
+        return 0.0 if stage is None else stage.true_position_at(t)
+
+
+def trapezoid(distance, vel, acc, tau):
+    """Returns (distance covered at tau, total duration) of a trapezoidal move.
+    """
+    if distance <= 0:
+        return 0.0, 0.0
+    acc_time = vel / acc
+    acc_distance = vel**2 / (2 * acc)
+    if distance < 2 * acc_distance:  # never reaches vel
+        half_time = math.sqrt(distance / acc)
+        duration = 2 * half_time
+        if tau < half_time:
+            return 0.5 * acc * tau**2, duration
+    else:
+        duration = 2 * acc_time + (distance - 2 * acc_distance) / vel
+        if tau < acc_time:
+            return 0.5 * acc * tau**2, duration
+        if tau < duration - acc_time:
+            return acc_distance + vel * (tau - acc_time), duration
+    if tau >= duration:
+        return distance, duration
+    return distance - 0.5 * acc * (duration - tau)**2, duration
+
+
+class SimStage:
+    """
+    A simulated KDC101 with a Z8 stage, in mm and seconds.
+
+    The encoder position follows the motion profile; the true position of
+    the platform lags behind it by up to backlash after a reversal.
+    """
+
+    def __init__(self, world, serial, vel=2.0, acc=1.5, backlash=0.001):
+        self.world = world
+        self.serial = serial
+        self.vel, self.acc = vel, acc
+        self.backlash = backlash
+        self.polling_interval = 0  # in seconds
+        self.status_time = None  # when the first status arrives after starting polling
+        self.lock = threading.RLock()
+        self.messages = deque()
+        self.homed = True
+
+        now = world.clock.now()
+        self.__move = (now, 0.0, 0.0)  # (start time, start position, target)
+        self.__true_start = 0.0  # true position at the start of the move
+        self.__end_message = None  # (time, message) to post when the move ends
+        self.__polled = (now, 0.0)  # (time, encoder position) of the last poll
+
+    def position_at(self, t):
+        start_time, start, target = self.__move
+        covered, _ = trapezoid(abs(target - start), self.vel, self.acc, t - start_time)
+        return start + math.copysign(covered, target - start)
+
+    def true_position_at(self, t):
+        encoder = self.position_at(t)
+        return min(max(self.__true_start, encoder - self.backlash / 2), encoder + self.backlash / 2)
+
+    def reported_position(self):
+        """Returns the encoder position at the last status poll, like the DLL.
+        """
+        with self.lock:
+            now = self.world.clock.now()
+            last_time, _ = self.__polled
+            if self.polling_interval > 0 and now - last_time >= self.polling_interval:
+                poll_time = last_time + (now - last_time) // self.polling_interval * self.polling_interval
+                self.__polled = (poll_time, self.position_at(poll_time))
+            return self.__polled[1]
+
+    def start_polling(self, interval):
+        with self.lock:
+            now = self.world.clock.now()
+            self.polling_interval = interval
+            self.status_time = now + interval
+            self.__polled = (now, self.position_at(now))
+
+    def status_bits(self):
+        # only 'enabled' (0x80000000) after the first poll; the DLL gives 0 before any status
+        if self.status_time is None or self.world.clock.now() < self.status_time:
+            return 0
+        return 0x80000000
+
+    def move_to(self, target, message=(2, 1)):
+        with self.lock:
+            now = self.world.clock.now()
+            self.update()
+            position = self.position_at(now)
+            self.__true_start = self.true_position_at(now)
+            self.__move = (now, position, target)
+            _, duration = trapezoid(abs(target - position), self.vel, self.acc, 0)
+            self.__end_message = (now + duration, message)
+
+    def stop(self):
+        with self.lock:
+            now = self.world.clock.now()
+            position = self.position_at(now)
+            self.__true_start = self.true_position_at(now)
+            self.__move = (now, position, position)
+            self.__end_message = (now, (2, 2))
+            self.update()
+
+    def update(self):
+        """Posts the end message of the move if it is over.
+        """
+        with self.lock:
+            if self.__end_message is not None and self.world.clock.now() >= self.__end_message[0]:
+                mtype, mid = self.__end_message[1]
+                self.messages.append((mtype, mid, int(self.position_at(self.__end_message[0]) * DEVUNIT_RATIO)))
+                self.__end_message = None
+
+    def time_to_next_message(self):
+        with self.lock:
+            if self.__end_message is None:
+                return None
+            return max(self.__end_message[0] - self.world.clock.now(), 0)
+
+
+class SimKinesisLib:
+    """
+    The CC_ functions of the KCube DCServo DLL used by KDC101, on SimStages.
+
+    Pass it to KDC101.use_library(). Serial numbers come as c_char_p and
+    the values as ctypes objects or pointers, like with the real DLL.
+    """
+
+    def __init__(self, world, open_time=0.3):
+        """open_time is the time CC_Open takes, in seconds."""
+        self.world = world
+        self.open_time = open_time
+
+    def __stage(self, serno):
+        return self.world.get_stage(serno.value.decode())
+
+    def TLI_BuildDeviceList(self):
+        return 0
+
+    def CC_Open(self, serno):
+        self.__stage(serno)
+        self.world.clock.sleep(self.open_time)
+        return 0
+
+    def CC_Close(self, serno):
+        pass
+
+    def CC_StartPolling(self, serno, interval):
+        self.__stage(serno).start_polling(interval.value / 1000)
+        return 1
+
+    def CC_StopPolling(self, serno):
+        stage = self.__stage(serno)
+        stage.polling_interval = 0
+        stage.status_time = None
+
+    def CC_GetStatusBits(self, serno):
+        return self.__stage(serno).status_bits()
+
+    def CC_PollingDuration(self, serno):
+        return int(self.__stage(serno).polling_interval * 1000)
+
+    def CC_CanMoveWithoutHomingFirst(self, serno):
+        return 1
+
+    def CC_GetVelParams(self, serno, acc, vel):
+        stage = self.__stage(serno)
+        acc.contents.value = int(stage.acc * ACC_DEVUNIT_RATIO)
+        vel.contents.value = int(stage.vel * VEL_DEVUNIT_RATIO)
+        return 0
+
+    def CC_SetVelParams(self, serno, acc, vel):
+        stage = self.__stage(serno)
+        stage.acc, stage.vel = acc.value / ACC_DEVUNIT_RATIO, vel.value / VEL_DEVUNIT_RATIO
+        return 0
+
+    def CC_GetPosition(self, serno):
+        return int(round(self.__stage(serno).reported_position() * DEVUNIT_RATIO))
+
+    def CC_MoveToPosition(self, serno, pos):
+        self.__stage(serno).move_to(pos.value / DEVUNIT_RATIO)
+        return 0
+
+    def CC_MoveRelative(self, serno, disp):
+        stage = self.__stage(serno)
+        with stage.lock:
+            stage.move_to(stage.position_at(self.world.clock.now()) + disp.value / DEVUNIT_RATIO)
+        return 0
+
+    def CC_Home(self, serno):
+        self.__stage(serno).move_to(0.0, message=(2, 0))
+        return 0
+
+    def CC_StopProfiled(self, serno):
+        self.__stage(serno).stop()
+        return 0
+
+    def CC_ClearMessageQueue(self, serno):
+        stage = self.__stage(serno)
+        with stage.lock:
+            stage.update()
+            stage.messages.clear()
+
+    def CC_MessageQueueSize(self, serno):
+        stage = self.__stage(serno)
+        with stage.lock:
+            stage.update()
+            return len(stage.messages)
+
+    def CC_GetNextMessage(self, serno, mtype, mid, mdata):
+        stage = self.__stage(serno)
+        with stage.lock:
+            stage.update()
+            if not stage.messages:
+                return False
+            mtype.contents.value, mid.contents.value, mdata.contents.value = stage.messages.popleft()
+            return True
+
+    def CC_WaitForMessage(self, serno, mtype, mid, mdata):
+        stage = self.__stage(serno)
+        while not self.CC_GetNextMessage(serno, mtype, mid, mdata):
+            wait_time = stage.time_to_next_message()
+            self.world.clock.sleep(0.01 if wait_time is None else min(wait_time, 0.01) + 1e-6)
+        return True
+
+
+class SimSequencerProgram:
+    """
+    Records the instructions of a sequencer program for SimArtyS7.
+
+    Only the instructions used by PMT_v3 are supported. Each returns its
+    index, so that labels can be set as attributes like with the real
+    SequencerProgram (e.g. sp.repeat_run = sp.load_immediate(...)).
+    """
+
+    def __init__(self):
+        self.instructions = []
+
+    def __add(self, *instruction):
+        self.instructions.append(instruction)
+        return len(self.instructions) - 1
+
+    def load_immediate(self, register, value, comment=''):
+        return self.__add('load_immediate', register, value)
+
+    def add(self, register, source, value, comment=''):
+        return self.__add('add', register, source, value)
+
+    def wait_n_clocks(self, n, comment=''):
+        return self.__add('wait_n_clocks', n)
+
+    def branch_if_less_than(self, label, register, value, comment=''):
+        return self.__add('branch_if_less_than', label, register, value)
+
+    def trigger_out(self, channels, comment=''):
+        return self.__add('trigger_out', list(channels))
+
+    def set_output_port(self, port, channel_values, comment=''):
+        return self.__add('set_output_port', port, list(channel_values))
+
+    def read_counter(self, register, counter, comment=''):
+        return self.__add('read_counter', register, counter)
+
+    def write_to_fifo(self, register_a, register_b, register_c, value, comment=''):
+        return self.__add('write_to_fifo', register_a, register_b, register_c, value)
+
+    def stop(self, comment=''):
+        return self.__add('stop')
+
+    def program(self, show=False, target=None):
+        target.load_program(self)
+
+
+class SimArtyS7:
+    """
+    The ArtyS7 calls used by PMT_v3, running a SimSequencerProgram.
+
+    The program advances to the current time whenever the host talks to
+    the board, so it behaves like running in parallel. Every call costs
+    command_latency, like a round trip over the serial port.
+    """
+
+    def __init__(self, world, port='COM7', command_latency=2e-4, upload_time_per_instruction=2e-5,
+                 fifo_depth=8192, open_time=0.5):
+        world.clock.sleep(open_time)  # connecting to the serial port
+        self.world = world
+        self.port = port
+        self.command_latency = command_latency
+        self.upload_time_per_instruction = upload_time_per_instruction
+        self.fifo_depth = fifo_depth
+        self.num_overflows = 0  # FIFO entries lost because it was full
+        self.fifo = deque()
+        self.__program = None
+        self.__instructions = []
+        self.__running = False
+        self.__registers = [0] * 32
+        self.__pc = 0
+        self.__clocks = 0  # clocks since the start
+        self.__start_time = 0
+        self.__counter = 0
+        self.__counter_enabled_at = None  # clocks
+
+    def check_version(self, version):
+        self.__latency()
+
+    def close(self):
+        pass
+
+    def auto_mode(self):
+        self.__latency()
+
+    def load_program(self, program):
+        self.__latency()
+        self.world.clock.sleep(self.upload_time_per_instruction * len(program.instructions))
+        self.__program = program
+        self.__instructions = program.instructions
+
+    def send_command(self, command):
+        self.__latency()
+        if command == 'START SEQUENCER':
+            self.__registers = [0] * 32
+            self.__pc = 0
+            self.__clocks = 0
+            self.__start_time = self.world.clock.now()
+            self.__running = True
+        elif command == 'STOP SEQUENCER':
+            self.__advance()
+            self.__running = False
+
+    def sequencer_running_status(self):
+        self.__latency()
+        self.__advance()
+        return 'running' if self.__running else 'stopped'
+
+    def fifo_data_length(self):
+        self.__latency()
+        self.__advance()
+        return len(self.fifo)
+
+    def read_fifo_data(self, data_count):
+        self.__latency()
+        self.__advance()
+        return [list(self.fifo.popleft()) for _ in range(min(data_count, len(self.fifo)))]
+
+    def __latency(self):
+        if self.command_latency:
+            self.world.clock.sleep(self.command_latency)
+
+    def __advance(self):
+        if not self.__running:
+            return
+        target = (self.world.clock.now() - self.__start_time) / CLOCK_PERIOD
+        registers, instructions = self.__registers, self.__instructions
+        while self.__running and self.__clocks < target:
+            instruction = instructions[self.__pc]
+            name = instruction[0]
+            if name == 'branch_if_less_than':
+                _, label, register, value = instruction
+                destination = getattr(self.__program, label)
+                if registers[register] < value:
+                    self.__fast_forward(destination, register, value, target)
+                    self.__pc = destination
+                else:
+                    self.__pc += 1
+                self.__clocks += 1
+                continue
+
+            if name == 'wait_n_clocks':
+                self.__clocks += instruction[1] + 3
+            else:
+                self.__clocks += 1
+            if name == 'load_immediate':
+                registers[instruction[1]] = instruction[2]
+            elif name == 'add':
+                registers[instruction[1]] = registers[instruction[2]] + instruction[3]
+            elif name == 'trigger_out':
+                self.__counter = 0  # the only trigger is the counter reset
+            elif name == 'set_output_port':
+                self.__set_counter(dict(instruction[2]))
+            elif name == 'read_counter':
+                registers[instruction[1]] = self.__counter
+            elif name == 'write_to_fifo':
+                if len(self.fifo) < self.fifo_depth:
+                    self.fifo.append((registers[instruction[1]], registers[instruction[2]],
+                                      registers[instruction[3]], instruction[4]))
+                else:
+                    self.num_overflows += 1
+            elif name == 'stop':
+                self.__running = False
+            self.__pc += 1
+
+    def __set_counter(self, channel_values):
+        enable = any(channel_values.values())
+        if enable and self.__counter_enabled_at is None:
+            self.__counter_enabled_at = self.__clocks
+        elif not enable and self.__counter_enabled_at is not None:
+            self.__counter += self.world.draw_counts(self.__start_time + self.__counter_enabled_at * CLOCK_PERIOD,
+                                                     self.__start_time + self.__clocks * CLOCK_PERIOD)
+            self.__counter_enabled_at = None
+
+    def __fast_forward(self, destination, register, value, target):
+        # skip whole iterations of a pure waiting loop (waits and register += 1 only) up to the target time
+        body = self.__instructions[destination:self.__pc]
+        if not all(i[0] == 'wait_n_clocks' or i[0] == 'add' and i[1] == i[2] == register and i[3] == 1
+                   for i in body):
+            return
+        loop_clocks = sum(i[1] + 3 if i[0] == 'wait_n_clocks' else 1 for i in body) + 1
+        num_iterations = min(value - self.__registers[register] - 1, int((target - self.__clocks) // loop_clocks))
+        if num_iterations > 0:
+            self.__registers[register] += num_iterations
+            self.__clocks += num_iterations * loop_clocks
+
+
+def install(world=None, virtual_time=False, **world_settings):
+    """Replaces the sequencer library and the Kinesis DLL by the simulation.
+
+    Call this before importing PMT_v3 or PMT_GUI_JJH; the simulated
+    modules are registered under the names of the real ones.
+
+    Parameters
+    ----------
+    world : SimWorld (optional)
+        a new SimWorld(**world_settings) if None
+    virtual_time : bool (default False)
+        sets a clocks.VirtualClock as the default clock, so that the
+        drivers and the GUI created afterwards share it with the world
+
+    Returns
+    -------
+    SimWorld
+    """
+    if virtual_time:
+        clocks.set_clock(clocks.VirtualClock())
+    if world is None:
+        world = SimWorld(**world_settings)
+
+    sequencer_program = types.ModuleType('SequencerProgram_v1_07')
+    sequencer_program.SequencerProgram = SimSequencerProgram
+    sequencer_program.reg = list(range(32))
+
+    arty = types.ModuleType('ArtyS7_v1_02')
+    arty.ArtyS7 = lambda port, *args, **kwargs: SimArtyS7(world, port, *args, **kwargs)
+
+    hardware_definition = types.ModuleType('HardwareDefinition_sim')
+    hardware_definition.HW_VERSION = 'sim'
+    hardware_definition.counter_control_port = 'counter_control_port'
+    hardware_definition.PMT1_counter_enable = 'PMT1_counter_enable'
+    hardware_definition.PMT1_counter_reset = 'PMT1_counter_reset'
+    hardware_definition.PMT1_counter_result = 'PMT1_counter_result'
+
+    sys.modules['SequencerProgram_v1_07'] = sequencer_program
+    sys.modules['ArtyS7_v1_02'] = arty
+    sys.modules['SequencerUtility_v1_01'] = types.ModuleType('SequencerUtility_v1_01')
+    sys.modules['HardwareDefinition_1S_test'] = hardware_definition
+    sys.modules['HardwareDefinition_SNU_v4_01'] = hardware_definition
+
+    from KDC101 import KDC101
+    KDC101.use_library(SimKinesisLib(world))
+    return world
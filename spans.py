@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+A module for timing the phases of the scan loop.
+
+A SpanRecorder times named phases (spans) with a context manager:
+    with recorder.span('pmt.drain'):
+        ...
+For every name it keeps the latest durations in a RingBuffer, so the
+statistics and histograms always describe the recent behavior, and it
+keeps the latest spans as events which can be exported in the Chrome
+trace format (open with chrome://tracing or https://ui.perfetto.dev).
+
+Recording a span costs two clock readings and two appends; with enabled
+False, span() returns a shared no-op context.
+
+The components take the recorder at construction; if not given, the
+default one of get_recorder() is used. The spans are timed by the clock of
+the recorder, so on a clocks.VirtualClock only the threads which sleep on
+it (the scanning thread, the hardware drivers) get meaningful durations.
+"""
+
+import json
+import os
+import threading
+from collections import deque
+
+import numpy as np
+
+from clocks import get_clock
+from ring_buffer import RingBuffer
+
+
+class _Span:
+    __slots__ = ('recorder', 'name', 'start_time')
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.start_time = self.recorder.clock.now()
+        return self
+
+    def __exit__(self, *exc):
+        self.recorder.record(self.name, self.start_time, self.recorder.clock.now())
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+class SpanRecorder:
+    """
+    Records the durations of named phases.
+
+    Attributes
+    ----------
+    enabled : bool
+        span() and record() do nothing if False
+    history_length : int
+        the number of durations kept for each name
+    clock : RealClock or VirtualClock
+        the times of the spans
+
+    Methods
+    -------
+    span                : str => context manager
+    record              : str, float, float => ()
+    names               : () => list of str
+    durations           : str => np.ndarray
+    stats               : () => dict
+    histogram           : str [, int] => (np.ndarray, np.ndarray)
+    format_stats        : () => str
+    export_chrome_trace : str => int
+    clear               : () => ()
+    """
+
+    def __init__(self, history_length=1000, max_events=100000, clock=None):
+        """
+        Parameters
+        ----------
+        history_length : int (default 1000)
+            the number of durations kept for each name
+        max_events : int (default 100000)
+            the number of the latest spans kept for export_chrome_trace()
+        clock : RealClock or VirtualClock (optional)
+            get_clock() if None
+        """
+        self.enabled = True
+        self.history_length = history_length
+        self.clock = get_clock() if clock is None else clock
+        self.__lock = threading.Lock()
+        self.__durations = {}  # name => RingBuffer of the latest durations in seconds
+        self.__counts = {}  # name => number of spans since clear()
+        self.__events = deque(maxlen=max_events)  # (name, start time, end time, thread ident)
+
+    def span(self, name):
+        """Returns a context manager which records its duration under name.
+        """
+        if not self.enabled:
+            return _NO_SPAN
+        return _Span(self, name)
+
+    def record(self, name, start_time, end_time):
+        """Records a span measured elsewhere, e.g. across threads, in clock times.
+        """
+        if not self.enabled:
+            return
+        with self.__lock:
+            durations = self.__durations.get(name)
+            if durations is None:
+                durations = self.__durations[name] = RingBuffer(self.history_length)
+                self.__counts[name] = 0
+            durations.append(end_time - start_time)
+            self.__counts[name] += 1
+            self.__events.append((name, start_time, end_time, threading.get_ident()))
+
+    def names(self):
+        with self.__lock:
+            return sorted(self.__durations)
+
+    def durations(self, name):
+        """Returns the latest durations of name in seconds, from the oldest.
+        """
+        with self.__lock:
+            return self.__durations[name].get() if name in self.__durations else np.zeros(0)
+
+    def stats(self):
+        """Returns {name: dict} of the count since clear() and the mean,
+        p50, p90, p99 and max of the latest durations, in seconds.
+        """
+        with self.__lock:
+            durations = {name: (buffer.get(), self.__counts[name]) for name, buffer in self.__durations.items()}
+        stats = {}
+        for name, (values, count) in sorted(durations.items()):
+            p50, p90, p99 = np.percentile(values, [50, 90, 99])
+            stats[name] = {'count': count, 'mean': float(values.mean()),
+                           'p50': float(p50), 'p90': float(p90), 'p99': float(p99), 'max': float(values.max())}
+        return stats
+
+    def histogram(self, name, num_bins=20):
+        """Returns (counts, bin edges in seconds) of the latest durations of name, with log-spaced bins.
+        """
+        values = self.durations(name)
+        positive = values[values > 0]
+        if len(positive) == 0:
+            return np.histogram(values, bins=1)
+        edges = np.geomspace(positive.min(), positive.max() * (1 + 1e-9), num_bins + 1)
+        edges[0] = 0  # zero durations go to the first bin
+        return np.histogram(values, bins=edges)
+
+    def format_stats(self):
+        """Returns a table of stats() in ms, one line per name.
+        """
+        lines = ["%-22s %8s %9s %9s %9s %9s %9s" % ('phase', 'count', 'mean', 'p50', 'p90', 'p99', 'max')]
+        for name, s in self.stats().items():
+            lines.append("%-22s %8d %9.3f %9.3f %9.3f %9.3f %9.3f" % (
+                name, s['count'], 1e3 * s['mean'], 1e3 * s['p50'], 1e3 * s['p90'], 1e3 * s['p99'], 1e3 * s['max']))
+        return "\n".join(lines)
+
+    def export_chrome_trace(self, path):
+        """Writes the kept spans to path in the Chrome trace event format.
+
+        Returns
+        -------
+        int
+            the number of spans written
+        """
+        with self.__lock:
+            events = list(self.__events)
+        thread_ids = {}  # small numbers are easier to read than thread idents
+        trace = [{'name': name, 'cat': name.split('.')[0], 'ph': 'X',
+                  'ts': 1e6 * start_time, 'dur': 1e6 * (end_time - start_time),
+                  'pid': os.getpid(), 'tid': thread_ids.setdefault(ident, len(thread_ids))}
+                 for name, start_time, end_time, ident in events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+        return len(trace)
+
+    def clear(self):
+        with self.__lock:
+            self.__durations.clear()
+            self.__counts.clear()
+            self.__events.clear()
+
+
+_default_recorder = None
+
+
+def get_recorder():
+    """Returns the default recorder shared by the components.
+
+    It is created at the first call, on the default clock at that time.
+    """
+    global _default_recorder
+    if _default_recorder is None:
+        _default_recorder = SpanRecorder()
+    return _default_recorder
+
+
+def set_recorder(recorder):
+    """Sets the default recorder used by the components created afterwards.
+    """
+    global _default_recorder
+    _default_recorder = recorder